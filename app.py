@@ -1,8 +1,44 @@
+import time
+_INICIO_EXECUCAO = time.perf_counter()  # partida: importações + primeira tela
+
 import streamlit as st
-import pandas as pd
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 from datetime import datetime, date
-from pyairtable import Table
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta, timezone
+import csv
+import functools
+import glob
+import hashlib
+import hmac
+import importlib
+import json
+import math
+import os
 import re
+import requests
+import sqlite3
+import sys
+import tempfile
+import threading
+import uuid
+
+from fila_escrita import MAX_TENTATIVAS_ESCRITA, FilaEscrita
+
+# pandas e pyairtable somam ~0,6 s à partida; só são importados quando uma tela usa tabelas
+# (pandas) ou quando sai a primeira requisição ao Airtable (pyairtable, em criar_api).
+class ModuloSobDemanda:
+    def __init__(self, nome):
+        self._nome = nome
+
+    def __getattr__(self, atributo):
+        return getattr(importlib.import_module(self._nome), atributo)
+
+pd = ModuloSobDemanda("pandas")
+
+DURACAO_IMPORTACOES_MS = (time.perf_counter() - _INICIO_EXECUCAO) * 1000
 
 # ---------------- Configuração Airtable ----------------
 API_KEY = st.secrets["connections"]["airtable"]["personal_access_token"]
@@ -23,17 +59,1003 @@ ABASTECIMENTOS_TABLE_ID = (
     if has_abastecimentos else None
 )
 
-usuarios_table   = Table(API_KEY, BASE_ID, USUARIOS_TABLE_ID)
-checklists_table = Table(API_KEY, BASE_ID, CHECKLISTS_TABLE_ID)
-trocaoleo_table  = Table(API_KEY, BASE_ID, TROCAOLEO_TABLE_ID)
-viaturas_table   = Table(API_KEY, BASE_ID, VIATURAS_TABLE_ID)
-abastecimentos_table = Table(API_KEY, BASE_ID, ABASTECIMENTOS_TABLE_ID) if has_abastecimentos else None
+# Permite apontar para um Airtable local (mock_airtable.py) em testes de desempenho
+ENDPOINT_URL = st.secrets["connections"]["airtable"].get("endpoint_url", "https://api.airtable.com")
+
+# ---------------- Conexão Airtable ----------------
+# O Airtable aceita 5 requisições/s por base; tela, leituras paralelas, réplica e fila
+# passam pelo mesmo limitador antes de cada envio (0 desliga, p.ex. contra o mock).
+LIMITE_REQUISICOES_POR_SEGUNDO = st.secrets["connections"]["airtable"].get("limite_requisicoes", 5)
+
+class LimitadorTaxa:
+    def __init__(self, por_segundo):
+        # 10% de folga: o instante de chegada no Airtable varia com a rede
+        self.intervalo = 1.1 / por_segundo if por_segundo else 0.0
+        self._proximo = 0.0
+        self._lock = threading.Lock()
+
+    def aguardar(self):
+        if not self.intervalo: return
+        with self._lock:
+            agora = time.monotonic()
+            espera = max(0.0, self._proximo - agora)
+            self._proximo = max(agora, self._proximo) + self.intervalo
+        if espera: time.sleep(espera)
+
+@st.cache_resource
+def obter_limitador(base_id):
+    return LimitadorTaxa(LIMITE_REQUISICOES_POR_SEGUNDO)
+
+class AdaptadorLimitado(requests.adapters.HTTPAdapter):
+    def __init__(self, limitador, **kwargs):
+        self.limitador = limitador
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.limitador.aguardar()
+        return super().send(request, **kwargs)
+
+def criar_api(com_retry=True):
+    from pyairtable import Api, retry_strategy
+    api = Api(API_KEY, endpoint_url=ENDPOINT_URL, retry_strategy=None)
+    adaptador = AdaptadorLimitado(obter_limitador(BASE_ID), max_retries=retry_strategy() if com_retry else 0)
+    api.session.mount("https://", adaptador)
+    api.session.mount("http://", adaptador)
+    return api
+
+# Importar o pyairtable compila código (modelos pydantic); numa thread de segundo plano, ao
+# mesmo tempo que o Streamlit compila o script de outra sessão, o Python 3.11 quebra com
+# "SystemError: AST constructor recursion depth mismatch". O import fica sempre na thread do
+# script (na primeira requisição ou ao fim da primeira tela) e réplica, agregados, fila e
+# arquivo esperam por ele.
+ESPERA_IMPORTACAO_PYAIRTABLE = 60  # segundos
+
+@st.cache_resource
+def obter_pyairtable_importado():
+    return threading.Event()
+
+def importar_pyairtable():
+    importlib.import_module("pyairtable")
+    obter_pyairtable_importado().set()
+
+class TabelaSobDemanda:
+    def __init__(self, cliente, base_id, tabela_id):
+        self._cliente = cliente
+        self._base_id = base_id
+        self._tabela_id = tabela_id
+        self._tabela = None
+
+    def __getattr__(self, atributo):
+        if self._tabela is None: self._tabela = self._cliente.obter().table(self._base_id, self._tabela_id)
+        return getattr(self._tabela, atributo)
+
+class ClienteSobDemanda:
+    # Adia o import do pyairtable e a sessão HTTP até a primeira chamada a uma tabela,
+    # feita na thread (tela, réplica, agregados ou fila) que precisar primeiro
+    def __init__(self, criar, importado):
+        self._criar = criar
+        self._importado = importado
+        self._api = None
+        self._lock = threading.Lock()
+
+    def obter(self):
+        if self._api is None:
+            if get_script_run_ctx(suppress_warning=True) is not None: importar_pyairtable()
+            else: self._importado.wait(ESPERA_IMPORTACAO_PYAIRTABLE)
+            with self._lock:
+                if self._api is None: self._api = self._criar()
+        return self._api
+
+    def table(self, base_id, tabela_id):
+        return TabelaSobDemanda(self, base_id, tabela_id)
+
+# ---------------- Instrumentação ----------------
+# Cada chamada às tabelas registra tabela, método, páginas, registros, bytes e tempo,
+# agrupadas pela seção da tela que a disparou.
+METRICAS_JSONL = st.secrets["connections"]["airtable"].get("metricas_jsonl")
+MAX_CHAMADAS_METRICAS = 5000
+
+chamadas_airtable = []                # chamadas desta execução do script
+secao_atual = {"nome": "inicio"}
+
+@st.cache_resource
+def obter_api_airtable():
+    # Uma sessão (e um pool de conexões) para as tabelas da tela em todas as sessões;
+    # o hook soma páginas/bytes à chamada em andamento na thread que fez a requisição.
+    contexto = threading.local()
+    def contar_requisicao(resposta, *args, **kwargs):
+        chamada = getattr(contexto, "valor", None)
+        if chamada is not None:
+            chamada["paginas"] += 1
+            chamada["bytes"] += len(resposta.content or b"")
+    def criar():
+        api = criar_api()
+        api.session.hooks["response"].append(contar_requisicao)
+        return api
+    cliente = ClienteSobDemanda(criar, obter_pyairtable_importado())
+    cliente.contexto = contexto
+    return cliente
+
+api_airtable = obter_api_airtable()
+_chamada_atual = api_airtable.contexto
+
+def marcar_secao(nome):
+    secao_atual["nome"] = nome
+
+def total_requisicoes():
+    return sum(c["paginas"] for c in chamadas_airtable)
+
+def _contar_registros(resultado):
+    if isinstance(resultado, list): return len(resultado)
+    return 1 if resultado else 0
+
+@contextmanager
+def _medir(tabela, metodo):
+    chamada = {
+        "quando": datetime.now().isoformat(timespec="seconds"), "secao": secao_atual["nome"],
+        "tabela": tabela, "metodo": metodo, "paginas": 0, "registros": 0, "bytes": 0, "ms": 0.0,
+    }
+    anterior = getattr(_chamada_atual, "valor", None)
+    _chamada_atual.valor = chamada
+    inicio = time.perf_counter()
+    try:
+        yield chamada
+    finally:
+        chamada["ms"] = round((time.perf_counter() - inicio) * 1000, 1)
+        _chamada_atual.valor = anterior
+        if chamada["paginas"]: chamadas_airtable.append(chamada)
+
+class TabelaInstrumentada:
+    def __init__(self, nome, tabela):
+        self.nome = nome
+        self.tabela = tabela
+
+    def __getattr__(self, atributo):
+        valor = getattr(self.tabela, atributo)
+        if atributo.startswith("_") or not callable(valor): return valor
+        if atributo == "iterate": return self._iterar
+        def medido(*args, **kwargs):
+            with _medir(self.nome, atributo) as chamada:
+                resultado = valor(*args, **kwargs)
+                chamada["registros"] = _contar_registros(resultado)
+            return resultado
+        return medido
+
+    def _iterar(self, *args, **kwargs):
+        paginas = self.tabela.iterate(*args, **kwargs)
+        while True:
+            with _medir(self.nome, "iterate") as chamada:
+                pagina = next(paginas, None)
+                if pagina is not None: chamada["registros"] = len(pagina)
+            if pagina is None: return
+            yield pagina
+
+def _percentil(valores, p):
+    if not valores: return None
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, math.ceil(p * len(ordenados)) - 1)]
+
+class MetricasAirtable:
+    def __init__(self, max_chamadas, arquivo_jsonl=None):
+        self.chamadas = deque(maxlen=max_chamadas)
+        self.tempo_por_secao = {}   # seção -> ms de Airtable por execução
+        self.tempo_execucao = deque(maxlen=500)  # ms de cada execução do script
+        self.partida = None         # primeira execução do processo (partida a frio)
+        self.arquivo_jsonl = arquivo_jsonl
+        self._lock = threading.Lock()
+
+    def registrar_execucao(self, chamadas):
+        if not chamadas: return
+        por_secao = {}
+        for c in chamadas: por_secao[c["secao"]] = por_secao.get(c["secao"], 0.0) + c["ms"]
+        with self._lock:
+            self.chamadas.extend(chamadas)
+            for secao, ms in por_secao.items():
+                self.tempo_por_secao.setdefault(secao, deque(maxlen=500)).append(ms)
+            if self.arquivo_jsonl:
+                with open(self.arquivo_jsonl, "a", encoding="utf-8") as arquivo:
+                    arquivo.writelines(json.dumps(c, ensure_ascii=False) + "\n" for c in chamadas)
+
+    def registrar_tempo_execucao(self, importacoes_ms, execucao_ms):
+        with self._lock:
+            self.tempo_execucao.append(execucao_ms)
+            if self.partida is not None: return
+            self.partida = {
+                "tipo": "partida", "quando": datetime.now().isoformat(timespec="seconds"),
+                "importacoes_ms": round(importacoes_ms, 1), "primeira_tela_ms": round(execucao_ms, 1),
+                "modulos_carregados": [m for m in ("pandas", "pyairtable") if m in sys.modules],
+            }
+            if self.arquivo_jsonl:
+                with open(self.arquivo_jsonl, "a", encoding="utf-8") as arquivo:
+                    arquivo.write(json.dumps(self.partida, ensure_ascii=False) + "\n")
+
+    def percentis_execucao(self):
+        with self._lock:
+            return _percentil(self.tempo_execucao, 0.5), _percentil(self.tempo_execucao, 0.95)
+
+    def percentis_por_secao(self):
+        with self._lock:
+            return [
+                {"Seção": secao, "Execuções": len(ms), "p50 (ms)": _percentil(ms, 0.5), "p95 (ms)": _percentil(ms, 0.95)}
+                for secao, ms in sorted(self.tempo_por_secao.items())
+            ]
+
+    def percentis_por_chamada(self):
+        with self._lock:
+            grupos = {}
+            for c in self.chamadas: grupos.setdefault((c["tabela"], c["metodo"]), []).append(c["ms"])
+        return [
+            {"Tabela": t, "Método": m, "Chamadas": len(ms), "p50 (ms)": _percentil(ms, 0.5), "p95 (ms)": _percentil(ms, 0.95)}
+            for (t, m), ms in sorted(grupos.items())
+        ]
+
+    def jsonl(self):
+        with self._lock:
+            return "".join(json.dumps(c, ensure_ascii=False) + "\n" for c in self.chamadas)
+
+@st.cache_resource
+def obter_metricas_airtable():
+    return MetricasAirtable(MAX_CHAMADAS_METRICAS, METRICAS_JSONL)
+
+_execucao = {"inicio": _INICIO_EXECUCAO, "registradas": 0, "concluida": False}
+
+def registrar_fim_execucao():
+    metricas = obter_metricas_airtable()
+    metricas.registrar_execucao(chamadas_airtable[_execucao["registradas"]:])
+    _execucao["registradas"] = len(chamadas_airtable)
+    metricas.registrar_tempo_execucao(DURACAO_IMPORTACOES_MS, (time.perf_counter() - _execucao["inicio"]) * 1000)
+    _execucao["concluida"] = True
+    # Primeira tela já montada: importa o pyairtable e libera as threads de segundo plano
+    if not obter_pyairtable_importado().is_set(): importar_pyairtable()
+
+def fragmento(funcao):
+    # Trecho da tela que reexecuta sozinho quando um widget dele muda (st.fragment). Essas
+    # reexecuções não passam pelo início nem pelo fim do script: o estado por execução é
+    # zerado aqui e as chamadas ao Airtable feitas dentro dele entram nas métricas.
+    @st.fragment
+    @functools.wraps(funcao)
+    def executar(*args, **kwargs):
+        if not _execucao["concluida"]: return funcao(*args, **kwargs)
+        _execucao["inicio"] = time.perf_counter()
+        _leituras_execucao.clear()
+        invalidar_snapshot_frota()
+        resultado = funcao(*args, **kwargs)
+        registrar_fim_execucao()
+        return resultado
+    return executar
+
+def reexecutar():
+    # st.rerun() interrompe o script antes do registro feito no final dele
+    registrar_fim_execucao()
+    st.rerun()
+
+def _tabela(nome, tabela_id):
+    return TabelaInstrumentada(nome, api_airtable.table(BASE_ID, tabela_id))
+
+usuarios_table   = _tabela("usuarios", USUARIOS_TABLE_ID)
+checklists_table = _tabela("checklists", CHECKLISTS_TABLE_ID)
+trocaoleo_table  = _tabela("trocaoleo", TROCAOLEO_TABLE_ID)
+viaturas_table   = _tabela("viaturas", VIATURAS_TABLE_ID)
+abastecimentos_table = _tabela("abastecimentos", ABASTECIMENTOS_TABLE_ID) if has_abastecimentos else None
+
+TABELAS_IDS = {
+    "usuarios": USUARIOS_TABLE_ID,
+    "checklists": CHECKLISTS_TABLE_ID,
+    "trocaoleo": TROCAOLEO_TABLE_ID,
+    "viaturas": VIATURAS_TABLE_ID,
+    "abastecimentos": ABASTECIMENTOS_TABLE_ID,
+}
+
+tabelas_airtable = {
+    "usuarios": usuarios_table,
+    "checklists": checklists_table,
+    "trocaoleo": trocaoleo_table,
+    "viaturas": viaturas_table,
+    "abastecimentos": abastecimentos_table,
+}
+
+# ---------------- Cache de leitura ----------------
+# Compartilhado por todas as sessões do processo; cada save invalida a tabela que escreveu.
+TTL_CACHE_SEGUNDOS = {
+    "usuarios": 300,
+    "viaturas": 600,
+    "checklists": 60,
+    "trocaoleo": 300,
+    "abastecimentos": 60,
+}
+MAX_ENTRADAS_CACHE = 128          # mínimo; cresce com a frota em indice_viaturas
+ENTRADAS_CACHE_POR_VIATURA = 6    # 3 consultas de último registro por placa (checklist, troca, abastecimento) + folga
+
+class CacheAirtable:
+    def __init__(self, ttls, max_entradas):
+        self.ttls = ttls
+        self.max_entradas = max_entradas
+        self.acertos = 0
+        self.falhas = 0
+        self.invalidacoes = 0
+        self._entradas = OrderedDict()  # (tabela, consulta) -> (expira_em, registros)
+        self._geracao = {}              # tabela -> nº de invalidações, evita gravar leitura anterior a um save
+        self._lock = threading.Lock()
+
+    def obter(self, tabela, consulta, carregar):
+        chave = (tabela, consulta)
+        with self._lock:
+            entrada = self._entradas.get(chave)
+            if entrada and entrada[0] > time.monotonic():
+                self._entradas.move_to_end(chave)
+                self.acertos += 1
+                return entrada[1]
+            self.falhas += 1
+            geracao = self._geracao.get(tabela, 0)
+        registros = carregar()
+        with self._lock:
+            if self._geracao.get(tabela, 0) == geracao:
+                self._entradas[chave] = (time.monotonic() + self.ttls.get(tabela, 60), registros)
+                self._entradas.move_to_end(chave)
+                while len(self._entradas) > self.max_entradas:
+                    self._entradas.popitem(last=False)
+        return registros
+
+    def dimensionar(self, max_entradas):
+        with self._lock:
+            self.max_entradas = max_entradas
+
+    def invalidar(self, tabela):
+        with self._lock:
+            self._geracao[tabela] = self._geracao.get(tabela, 0) + 1
+            for chave in [c for c in self._entradas if c[0] == tabela]:
+                del self._entradas[chave]
+            self.invalidacoes += 1
+
+    def estatisticas(self):
+        with self._lock:
+            total = self.acertos + self.falhas
+            return {
+                "acertos": self.acertos,
+                "falhas": self.falhas,
+                "taxa_acerto": (self.acertos / total) if total else 0.0,
+                "invalidacoes": self.invalidacoes,
+                "entradas": len(self._entradas),
+            }
+
+@st.cache_resource
+def obter_cache_airtable():
+    # cache_leitura = false nos secrets desliga o cache (útil para comparar estratégias no benchmark)
+    if not st.secrets["connections"]["airtable"].get("cache_leitura", True):
+        return CacheAirtable({nome: 0 for nome in TTL_CACHE_SEGUNDOS}, MAX_ENTRADAS_CACHE)
+    return CacheAirtable(TTL_CACHE_SEGUNDOS, MAX_ENTRADAS_CACHE)
+
+cache_airtable = obter_cache_airtable()
+
+def _chave_consulta(opcoes):
+    return tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in opcoes.items()))
+
+# Leituras já feitas nesta execução do script (inclusive as antecipadas em paralelo),
+# para não repetir a requisição quando o cache está desligado ou expira no meio da tela
+_leituras_execucao = {}
+
+def ler_tabela(nome, **opcoes):
+    chave = (nome, _chave_consulta(opcoes))
+    if chave in _leituras_execucao: return _leituras_execucao[chave]
+    tabela = tabelas_airtable[nome]
+    def carregar():
+        if replica_pronta(nome) and "formula" not in opcoes:
+            ordem = (opcoes.get("sort") or [None])[0]
+            return replica.listar(nome, ordem=ordem, limite=opcoes.get("max_records"))
+        return tabela.all(**opcoes)
+    registros = _leituras_execucao[chave] = cache_airtable.obter(nome, chave[1], carregar)
+    return registros
+
+# ---------------- Consultas filtradas ----------------
+# Filtros de placa/matrícula/data vão para o Airtable (filterByFormula) em vez de varrer a tabela aqui.
+def montar_formula(filtros=None, campo_data=None, desde=None, ate=None):
+    from pyairtable import formulas
+    condicoes = [str(formulas.match({campo: valor})) for campo, valor in (filtros or {}).items()]
+    if campo_data and desde:
+        condicoes.append(f"NOT(IS_BEFORE({{{campo_data}}}, '{desde.isoformat()}'))")
+    if campo_data and ate:
+        condicoes.append(f"IS_BEFORE({{{campo_data}}}, '{ate.isoformat()}')")
+    if not condicoes: return None
+    return condicoes[0] if len(condicoes) == 1 else f"AND({', '.join(condicoes)})"
+
+def buscar_ultimo(nome, filtros, campo_data, campos=None, desde=None):
+    opcoes = {
+        "formula": montar_formula(filtros, campo_data, desde),
+        "sort": [f"-{campo_data}"],
+        "max_records": 1,
+    }
+    if campos: opcoes["fields"] = campos
+    def carregar():
+        if replica_pronta(nome):
+            return replica.listar(nome, filtros, campo_data, desde, ordem=f"-{campo_data}", limite=1)
+        return tabelas_airtable[nome].all(**opcoes)
+    registros = cache_airtable.obter(nome, _chave_consulta(opcoes), carregar)
+    atual = registros[0].get("fields", {}) if registros else None
+    # Gravações ainda na fila local também contam como "último registro"
+    for f in fila_escrita.pendentes(nome, filtros):
+        if atual is None or str(f.get(campo_data, "")) >= str(atual.get(campo_data, "")): atual = f
+    return atual
+
+# ---------------- Réplica local (SQLite) ----------------
+# Opcional: com "replica_sqlite" nos secrets, as leituras saem de um espelho local
+# mantido por uma thread que só busca registros modificados desde a última marca d'água.
+# Usuários e viaturas ficam de fora: já são servidos pelos índices em memória de
+# DiretorioUsuarios e RegistroViaturas, e o espelho de usuários guardaria os hashes de senha em disco.
+REPLICA_SQLITE = st.secrets["connections"]["airtable"].get("replica_sqlite")
+INTERVALO_SYNC_REPLICA = int(st.secrets["connections"]["airtable"].get("replica_intervalo", 30))
+INTERVALO_RECONCILIACAO_REPLICA = 3600  # varredura de ids para detectar registros apagados
+TABELAS_REPLICA = ["checklists", "trocaoleo", "abastecimentos"]
+
+CAMPO_DATA = {"checklists": "Data", "abastecimentos": "Data", "trocaoleo": "data"}
+CAMPO_MATRICULA = {"checklists": "Matricula", "abastecimentos": "Matricula"}
+
+SQL_REPLICA = """
+CREATE TABLE IF NOT EXISTS registros (
+    tabela TEXT NOT NULL,
+    id TEXT NOT NULL,
+    placa TEXT,
+    matricula TEXT,
+    data TEXT,
+    criado TEXT,
+    campos TEXT NOT NULL,
+    PRIMARY KEY (tabela, id)
+);
+CREATE INDEX IF NOT EXISTS idx_registros_placa ON registros (tabela, placa, data);
+CREATE INDEX IF NOT EXISTS idx_registros_matricula ON registros (tabela, matricula, data);
+CREATE INDEX IF NOT EXISTS idx_registros_data ON registros (tabela, data);
+CREATE TABLE IF NOT EXISTS marcas (
+    tabela TEXT PRIMARY KEY,
+    marca TEXT NOT NULL,
+    reconciliado REAL NOT NULL DEFAULT 0
+);
+"""
+
+class ReplicaLocal:
+    def __init__(self, caminho, tabelas, intervalo):
+        self.tabelas = tabelas
+        self.intervalo = intervalo
+        self.ultima_sync = {}
+        self.erros = 0
+        self.ultimo_erro = None
+        self._conexao = sqlite3.connect(caminho, check_same_thread=False)
+        self._conexao.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._conexao:
+            self._conexao.execute("PRAGMA journal_mode=WAL")
+            self._conexao.executescript(SQL_REPLICA)
+            # Espelhos criados antes de uma tabela sair da réplica (p.ex. usuários, com hashes de
+            # senha): apagados com secure_delete, que zera o conteúdo no arquivo
+            antigas = {r["tabela"] for r in self._conexao.execute("SELECT tabela FROM marcas UNION SELECT tabela FROM registros")}
+            for tabela in antigas - set(tabelas):
+                self._conexao.execute("PRAGMA secure_delete=ON")
+                self._conexao.execute("DELETE FROM registros WHERE tabela = ?", (tabela,))
+                self._conexao.execute("DELETE FROM marcas WHERE tabela = ?", (tabela,))
+            self._prontas = {r["tabela"] for r in self._conexao.execute("SELECT tabela FROM marcas")}
+
+    def pronta(self, nome):
+        return nome in self._prontas
+
+    def _linha(self, nome, registro):
+        f = registro.get("fields", {})
+        campo_data = CAMPO_DATA.get(nome)
+        campo_matricula = CAMPO_MATRICULA.get(nome)
+        return (
+            nome, registro["id"], f.get("Placa"),
+            f.get(campo_matricula) if campo_matricula else None,
+            f.get(campo_data) if campo_data else None,
+            registro.get("createdTime"), json.dumps(f, ensure_ascii=False),
+        )
+
+    def gravar(self, nome, registros):
+        linhas = [self._linha(nome, r) for r in registros]
+        with self._lock, self._conexao:
+            self._conexao.executemany("INSERT OR REPLACE INTO registros VALUES (?, ?, ?, ?, ?, ?, ?)", linhas)
+
+    def remover(self, nome, ids):
+        with self._lock, self._conexao:
+            self._conexao.executemany("DELETE FROM registros WHERE tabela = ? AND id = ?", [(nome, i) for i in ids])
+
+    def sincronizar(self, nome):
+        tabela = self.tabelas[nome]
+        with self._lock:
+            linha = self._conexao.execute("SELECT marca, reconciliado FROM marcas WHERE tabela = ?", (nome,)).fetchone()
+        inicio = datetime.now(timezone.utc)
+        if linha is None:
+            registros = tabela.all()
+        else:
+            desde = (datetime.fromisoformat(linha["marca"]) - timedelta(seconds=5)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+            registros = tabela.all(formula=f"IS_AFTER(LAST_MODIFIED_TIME(), '{desde}')")
+        self.gravar(nome, registros)
+        reconciliado = linha["reconciliado"] if linha else time.time()
+        if linha is not None and time.time() - reconciliado > INTERVALO_RECONCILIACAO_REPLICA:
+            ids = [r["id"] for r in tabela.all(fields=["Placa"])]
+            with self._lock, self._conexao:
+                self._conexao.execute("CREATE TEMP TABLE IF NOT EXISTS ids_vivos (id TEXT PRIMARY KEY)")
+                self._conexao.execute("DELETE FROM ids_vivos")
+                self._conexao.executemany("INSERT OR IGNORE INTO ids_vivos VALUES (?)", [(i,) for i in ids])
+                self._conexao.execute(
+                    "DELETE FROM registros WHERE tabela = ? AND id NOT IN (SELECT id FROM ids_vivos)", (nome,)
+                )
+            reconciliado = time.time()
+        with self._lock, self._conexao:
+            self._conexao.execute(
+                "INSERT OR REPLACE INTO marcas VALUES (?, ?, ?)", (nome, inicio.isoformat(), reconciliado)
+            )
+        self._prontas.add(nome)
+        self.ultima_sync[nome] = time.time()
+
+    def listar(self, nome, filtros=None, campo_data=None, desde=None, ate=None, ordem=None, limite=None, deslocamento=0):
+        condicoes, params = ["tabela = ?"], [nome]
+        for campo, valor in (filtros or {}).items():
+            if campo == "Placa": coluna = "placa"
+            elif campo == CAMPO_MATRICULA.get(nome): coluna = "matricula"
+            else: coluna = f"json_extract(campos, '$.\"{campo}\"')"
+            condicoes.append(f"{coluna} = ?"); params.append(valor)
+        if campo_data and desde:
+            condicoes.append("data >= ?"); params.append(desde.isoformat())
+        if campo_data and ate:
+            condicoes.append("data < ?"); params.append(ate.isoformat())
+        sql = f"SELECT id, criado, campos FROM registros WHERE {' AND '.join(condicoes)}"
+        if ordem:
+            campo = ordem.lstrip("-")
+            coluna = "data" if campo == CAMPO_DATA.get(nome) else f"json_extract(campos, '$.\"{campo}\"')"
+            sql += f" ORDER BY {coluna} {'DESC' if ordem.startswith('-') else 'ASC'}"
+        if limite:
+            sql += " LIMIT ? OFFSET ?"; params += [int(limite), int(deslocamento)]
+        with self._lock:
+            linhas = self._conexao.execute(sql, params).fetchall()
+        return [{"id": l["id"], "createdTime": l["criado"], "fields": json.loads(l["campos"])} for l in linhas]
+
+    def executar(self):
+        while True:
+            for nome in self.tabelas:
+                try:
+                    self.sincronizar(nome)
+                except Exception as e:
+                    self.erros += 1
+                    self.ultimo_erro = f"{nome}: {e}"
+            time.sleep(self.intervalo)
+
+@st.cache_resource
+def obter_replica():
+    if not REPLICA_SQLITE: return None
+    tabelas = {
+        nome: api_airtable.table(BASE_ID, TABELAS_IDS[nome])
+        for nome in TABELAS_REPLICA if TABELAS_IDS.get(nome)
+    }
+    replica = ReplicaLocal(REPLICA_SQLITE, tabelas, INTERVALO_SYNC_REPLICA)
+    threading.Thread(target=replica.executar, name="replica-sync", daemon=True).start()
+    return replica
+
+replica = obter_replica()
+
+def replica_pronta(nome):
+    return replica is not None and replica.pronta(nome)
+
+def registrar_escrita(nome, registros):
+    # Leitura das próprias escritas: descarta o cache e já grava na réplica sem esperar a sync
+    cache_airtable.invalidar(nome)
+    for chave in [c for c in _leituras_execucao if c[0] == nome]:
+        _leituras_execucao.pop(chave, None)
+    if replica is not None and nome in replica.tabelas and registros:
+        replica.gravar(nome, registros)
+    if agregados is not None and nome in CAMPOS_AGREGADOS and registros:
+        agregados.aplicar(nome, registros)
+
+def registrar_remocao(nome, ids):
+    # Registros que saíram do Airtable (p.ex. para o arquivo histórico); os agregados ficam
+    cache_airtable.invalidar(nome)
+    for chave in [c for c in _leituras_execucao if c[0] == nome]:
+        _leituras_execucao.pop(chave, None)
+    if replica is not None and nome in replica.tabelas and ids:
+        replica.remover(nome, ids)
+
+# ---------------- Arquivo histórico (Parquet) ----------------
+# Opcional: com "arquivo_historico" nos secrets (uma pasta em disco persistente), checklists e
+# abastecimentos de meses fechados há mais de 12 meses saem do Airtable (a pedido do admin)
+# para arquivos Parquet locais, um por mês e placa: <tabela>/mes=AAAA-MM/placa=XXX/.
+# As leituras usam memory map; histórico, exportação, consumo e agregados somam os dois lados.
+ARQUIVO_HISTORICO = st.secrets["connections"]["airtable"].get("arquivo_historico")
+MESES_ARQUIVO = 12
+TABELAS_ARQUIVO = ["checklists", "abastecimentos"]
+TIPOS_ARQUIVO = {  # demais campos são gravados como texto
+    "Quilometragem": int, "Km": int,
+    "Oxigenio Grande 1": int, "Oxigenio Grande 2": int, "Oxigenio Portatil": int,
+    "Litros": float, "Valor": float,
+}
+
+def corte_arquivo(hoje=None):
+    # Primeiro dia do mês de 12 meses atrás: só meses inteiros vão para o arquivo
+    hoje = hoje or date.today()
+    meses = hoje.year * 12 + hoje.month - 1 - MESES_ARQUIVO
+    return date(meses // 12, meses % 12 + 1, 1)
+
+def _particao(valor):
+    return re.sub(r"[^\w-]", "_", str(valor or "")) or "_"
+
+class ArquivoHistorico:
+    def __init__(self, pasta, tabelas, ao_remover):
+        self.pasta = pasta
+        self.tabelas = tabelas
+        self.ao_remover = ao_remover
+        self.progresso = None       # situação do último arquivamento, exibida ao admin
+        self.em_andamento = False
+        self._completas = {}        # tabela -> pyarrow.Table de todas as partições
+        self._lock = threading.Lock()
+
+    def _arquivos(self, nome, placa=None, desde=None, ate=None):
+        padrao = os.path.join(self.pasta, nome, "mes=*", f"placa={_particao(placa) if placa else '*'}", "*.parquet")
+        arquivos = []
+        for arquivo in sorted(glob.glob(padrao)):
+            mes = os.path.basename(os.path.dirname(os.path.dirname(arquivo)))[4:]
+            if desde and mes < desde.strftime("%Y-%m"): continue
+            if ate and mes > ate.strftime("%Y-%m"): continue
+            arquivos.append(arquivo)
+        return arquivos
+
+    @staticmethod
+    def _ler(arquivos):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        partes = [pq.read_table(a, memory_map=True) for a in arquivos]
+        return pa.concat_tables(partes, promote_options="default") if partes else None
+
+    def tabela(self, nome):
+        # Todas as placas (consumo da frota); refeita só quando um arquivamento grava algo
+        with self._lock:
+            if nome not in self._completas: self._completas[nome] = self._ler(self._arquivos(nome))
+            return self._completas[nome]
+
+    @staticmethod
+    def _registros(tabela):
+        # Mesmo formato devolvido pelo Airtable e pela réplica
+        return [
+            {"id": l.pop("id"), "createdTime": l.pop("criado"), "fields": {k: v for k, v in l.items() if v is not None}}
+            for l in tabela.to_pylist()
+        ]
+
+    def paginas(self, nome, placa=None, desde=None, ate=None, tamanho=100):
+        # Do mês mais recente para o mais antigo, uma partição (mês + placa) por vez: histórico e
+        # exportação nunca têm mais que uma partição em memória
+        import pyarrow.compute as pc
+        campo = CAMPO_DATA[nome]
+        por_particao = {}
+        for arquivo in self._arquivos(nome, placa, desde, ate):
+            por_particao.setdefault(os.path.dirname(arquivo), []).append(arquivo)
+        for particao in sorted(por_particao, reverse=True):
+            tabela = self._ler(por_particao[particao])
+            if desde: tabela = tabela.filter(pc.field(campo) >= desde.isoformat())
+            if ate: tabela = tabela.filter(pc.field(campo) < ate.isoformat())
+            if placa: tabela = tabela.filter(pc.field("Placa") == placa)
+            tabela = tabela.sort_by([(campo, "descending")])
+            for inicio in range(0, tabela.num_rows, tamanho):
+                yield self._registros(tabela.slice(inicio, tamanho))
+
+    def lotes(self, nome):
+        for arquivo in self._arquivos(nome):
+            yield self._registros(self._ler([arquivo]))
+
+    def _ids_do_mes(self, nome, mes):
+        import pyarrow.parquet as pq
+        ids = set()
+        for arquivo in glob.glob(os.path.join(self.pasta, nome, f"mes={mes}", "placa=*", "*.parquet")):
+            ids.update(pq.read_table(arquivo, columns=["id"], memory_map=True)["id"].to_pylist())
+        return ids
+
+    @staticmethod
+    def _linha(registro):
+        linha = {"id": registro["id"], "criado": registro.get("createdTime")}
+        for campo, valor in registro.get("fields", {}).items():
+            tipo = TIPOS_ARQUIVO.get(campo)
+            if tipo is None:
+                linha[campo] = None if valor is None else str(valor)
+                continue
+            try: linha[campo] = tipo(float(valor))
+            except (TypeError, ValueError): linha[campo] = None
+        return linha
+
+    def _gravar(self, nome, mes, registros):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        por_placa = {}
+        for r in registros: por_placa.setdefault(_particao(r.get("fields", {}).get("Placa")), []).append(self._linha(r))
+        for placa, linhas in por_placa.items():
+            colunas = list(dict.fromkeys(c for l in linhas for c in l))
+            esquema = pa.schema([
+                (c, {int: pa.int64(), float: pa.float64()}.get(TIPOS_ARQUIVO.get(c), pa.string())) for c in colunas
+            ])
+            pasta = os.path.join(self.pasta, nome, f"mes={mes}", f"placa={placa}")
+            os.makedirs(pasta, exist_ok=True)
+            destino = os.path.join(pasta, f"parte-{datetime.now():%Y%m%d%H%M%S%f}.parquet")
+            pq.write_table(pa.Table.from_pylist(linhas, schema=esquema), destino + ".tmp")
+            os.replace(destino + ".tmp", destino)  # leitores nunca veem um arquivo pela metade
+
+    def arquivar(self, nome, corte):
+        # Mês a mês: grava o Parquet e só então apaga do Airtable. Se parar no meio, a próxima
+        # execução pula os ids já arquivados e termina de apagar.
+        tabela, campo = self.tabelas[nome], CAMPO_DATA[nome]
+        limite = datetime.combine(corte, datetime.min.time())
+        primeiro = tabela.all(formula=montar_formula(campo_data=campo, ate=limite), sort=[campo], max_records=1, fields=[campo])
+        mes = parse_iso_datetime(str(primeiro[0].get("fields", {}).get(campo, ""))) if primeiro else None
+        if mes is None: return 0
+        mes, movidos = mes.date().replace(day=1), 0
+        while mes < corte:
+            proximo = (mes + timedelta(days=32)).replace(day=1)
+            registros = tabela.all(formula=montar_formula(
+                campo_data=campo, desde=datetime.combine(mes, datetime.min.time()), ate=datetime.combine(proximo, datetime.min.time()),
+            ))
+            if registros:
+                ja_arquivados = self._ids_do_mes(nome, mes.strftime("%Y-%m"))
+                self._gravar(nome, mes.strftime("%Y-%m"), [r for r in registros if r["id"] not in ja_arquivados])
+                with self._lock: self._completas.pop(nome, None)
+                ids = [r["id"] for r in registros]
+                tabela.batch_delete(ids)
+                self.ao_remover(nome, ids)
+                movidos += len(ids)
+                self.progresso = f"{nome}: {movidos} registro(s) movidos, até {mes:%m/%Y}"
+            mes = proximo
+        return movidos
+
+    def executar(self, corte):
+        try:
+            for nome in self.tabelas:
+                self.arquivar(nome, corte)
+            self.progresso = f"Concluído em {datetime.now():%d/%m %H:%M}: registros anteriores a {corte:%d/%m/%Y} arquivados"
+        except Exception as e:
+            self.progresso = f"Interrompido ({e}); arquive de novo para continuar de onde parou"
+        finally:
+            self.em_andamento = False
+
+    def iniciar(self, corte):
+        with self._lock:
+            if self.em_andamento: return
+            self.em_andamento = True
+        self.progresso = "Arquivamento em andamento..."
+        threading.Thread(target=self.executar, args=(corte,), name="arquivo-historico", daemon=True).start()
+
+    def resumo(self):
+        import pyarrow.parquet as pq
+        resumo = {}
+        for nome in self.tabelas:
+            arquivos = self._arquivos(nome)
+            meses = sorted({os.path.basename(os.path.dirname(os.path.dirname(a)))[4:] for a in arquivos})
+            resumo[nome] = {
+                "registros": sum(pq.read_metadata(a).num_rows for a in arquivos),
+                "meses": (meses[0], meses[-1]) if meses else None,
+            }
+        return resumo
+
+@st.cache_resource
+def obter_arquivo_historico():
+    if not ARQUIVO_HISTORICO: return None
+    tabelas = {nome: api_airtable.table(BASE_ID, TABELAS_IDS[nome]) for nome in TABELAS_ARQUIVO if TABELAS_IDS.get(nome)}
+    return ArquivoHistorico(ARQUIVO_HISTORICO, tabelas, registrar_remocao)
+
+arquivo_historico = obter_arquivo_historico()
+
+# ---------------- Agregados diários ----------------
+# km rodados, litros, valor e nº de checklists/abastecimentos por dia e viatura, materializados
+# em SQLite a partir dos registros novos; o relatório da frota só soma os dias do período.
+# "agregados_sqlite" vazio nos secrets desliga.
+AGREGADOS_SQLITE = st.secrets["connections"]["airtable"].get("agregados_sqlite", "agregados_diarios.db")
+INTERVALO_SYNC_AGREGADOS = 60
+CAMPOS_AGREGADOS = {
+    "checklists": ["Data", "Placa", "Quilometragem"],
+    "abastecimentos": ["Data", "Placa", "Km", "Litros", "Valor"],
+}
+
+SQL_AGREGADOS = """
+CREATE TABLE IF NOT EXISTS diario (
+    dia TEXT NOT NULL,
+    placa TEXT NOT NULL,
+    km_min INTEGER,
+    km_max INTEGER,
+    km_rodados INTEGER NOT NULL DEFAULT 0,
+    checklists INTEGER NOT NULL DEFAULT 0,
+    abastecimentos INTEGER NOT NULL DEFAULT 0,
+    litros REAL NOT NULL DEFAULT 0,
+    valor REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (placa, dia)
+);
+CREATE INDEX IF NOT EXISTS idx_diario_dia ON diario (dia);
+CREATE TABLE IF NOT EXISTS aplicados (
+    tabela TEXT NOT NULL,
+    id TEXT NOT NULL,
+    PRIMARY KEY (tabela, id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS marcas (
+    tabela TEXT PRIMARY KEY,
+    marca TEXT NOT NULL
+);
+"""
+
+SQL_SOMAR_DIA = """
+INSERT INTO diario (dia, placa, km_min, km_max, checklists, abastecimentos, litros, valor)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (placa, dia) DO UPDATE SET
+    km_min = COALESCE(MIN(km_min, excluded.km_min), km_min, excluded.km_min),
+    km_max = COALESCE(MAX(km_max, excluded.km_max), km_max, excluded.km_max),
+    checklists = checklists + excluded.checklists,
+    abastecimentos = abastecimentos + excluded.abastecimentos,
+    litros = litros + excluded.litros,
+    valor = valor + excluded.valor
+"""
+
+# km rodados no dia = maior km do dia - maior km do dia anterior com leitura (no primeiro dia,
+# a variação dentro do próprio dia); recalculado para o dia tocado e o seguinte
+SQL_KM_RODADOS = """
+UPDATE diario SET km_rodados = MAX(0, km_max - COALESCE(
+    (SELECT a.km_max FROM diario AS a
+     WHERE a.placa = diario.placa AND a.dia < diario.dia AND a.km_max IS NOT NULL
+     ORDER BY a.dia DESC LIMIT 1),
+    km_min))
+WHERE placa = ? AND km_max IS NOT NULL AND (
+    dia = ? OR dia = (SELECT MIN(b.dia) FROM diario AS b WHERE b.placa = ? AND b.dia > ? AND b.km_max IS NOT NULL)
+)
+"""
+
+class AgregadosDiarios:
+    def __init__(self, caminho, tabelas, intervalo, arquivo=None):
+        self.tabelas = tabelas
+        self.arquivo = arquivo
+        self.intervalo = intervalo
+        self.ultima_sync = None
+        self.erros = 0
+        self.ultimo_erro = None
+        self._conexao = sqlite3.connect(caminho, check_same_thread=False)
+        self._conexao.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        self._acordar = threading.Event()
+        self._geracao = 0  # muda a cada reconstrução; sincronizações de antes dela são descartadas
+        with self._lock, self._conexao:
+            self._conexao.execute("PRAGMA journal_mode=WAL")
+            self._conexao.executescript(SQL_AGREGADOS)
+            self._prontas = {r["tabela"] for r in self._conexao.execute("SELECT tabela FROM marcas")}
+
+    def pronto(self):
+        return all(nome in self._prontas for nome in self.tabelas)
+
+    @staticmethod
+    def _numero(f, campo):
+        try: return float(f.get(campo) or 0)
+        except (TypeError, ValueError): return 0.0
+
+    def aplicar(self, nome, registros, geracao=None):
+        # Cada registro entra uma vez só (a thread e a fila de gravação podem entregar o mesmo).
+        # Com `geracao`, devolve False sem aplicar se houve uma reconstrução desde então.
+        abastecimento = nome == "abastecimentos"
+        campo_km = "Km" if abastecimento else "Quilometragem"
+        with self._lock, self._conexao:
+            if geracao is not None and geracao != self._geracao: return False
+            for r in registros:
+                novo = self._conexao.execute("INSERT OR IGNORE INTO aplicados VALUES (?, ?)", (nome, r["id"])).rowcount
+                f = r.get("fields", {})
+                dia, placa = str(f.get("Data") or "")[:10], f.get("Placa")
+                if not novo or len(dia) != 10 or not placa: continue
+                km = int(self._numero(f, campo_km)) or None
+                self._conexao.execute(SQL_SOMAR_DIA, (
+                    dia, placa, km, km, int(not abastecimento), int(abastecimento),
+                    self._numero(f, "Litros") if abastecimento else 0.0,
+                    self._numero(f, "Valor") if abastecimento else 0.0,
+                ))
+                if km: self._conexao.execute(SQL_KM_RODADOS, (placa, dia, placa, dia))
+        return True
+
+    def sincronizar(self, nome):
+        # Checklists e abastecimentos só são criados, então basta a marca de CREATED_TIME
+        with self._lock:
+            linha = self._conexao.execute("SELECT marca FROM marcas WHERE tabela = ?", (nome,)).fetchone()
+            geracao = self._geracao
+        inicio = datetime.now(timezone.utc)
+        opcoes = {"fields": CAMPOS_AGREGADOS[nome]}
+        if linha is not None:
+            desde = (datetime.fromisoformat(linha["marca"]) - timedelta(seconds=5)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+            opcoes["formula"] = f"IS_AFTER(CREATED_TIME(), '{desde}')"
+        elif self.arquivo is not None and nome in TABELAS_ARQUIVO:
+            # Carga inicial (ou reconstrução): os meses já arquivados não estão mais no Airtable
+            for lote in self.arquivo.lotes(nome):
+                if not self.aplicar(nome, lote, geracao): return
+        for pagina in self.tabelas[nome].iterate(**opcoes):
+            # Reconstruído no meio do caminho: a próxima passada recomeça do zero
+            if not self.aplicar(nome, pagina, geracao): return
+        with self._lock, self._conexao:
+            if geracao != self._geracao: return
+            self._conexao.execute("INSERT OR REPLACE INTO marcas VALUES (?, ?)", (nome, inicio.isoformat()))
+            self._prontas.add(nome)
+
+    def reconstruir(self):
+        # Para refletir registros editados ou apagados no Airtable
+        with self._lock, self._conexao:
+            for tabela in ("diario", "aplicados", "marcas"): self._conexao.execute(f"DELETE FROM {tabela}")
+            self._prontas = set()
+            self._geracao += 1
+        self._acordar.set()
+
+    def totais_por_placa(self, desde, ate):
+        with self._lock:
+            linhas = self._conexao.execute(
+                "SELECT placa, SUM(km_rodados) AS km, SUM(litros) AS litros, SUM(valor) AS valor, "
+                "SUM(checklists) AS checklists, SUM(abastecimentos) AS abastecimentos "
+                "FROM diario WHERE dia BETWEEN ? AND ? GROUP BY placa",
+                (desde.isoformat(), ate.isoformat()),
+            ).fetchall()
+        return [dict(l) for l in linhas]
+
+    def totais_por_dia(self, desde, ate):
+        with self._lock:
+            linhas = self._conexao.execute(
+                "SELECT dia, SUM(km_rodados) AS km, SUM(litros) AS litros, SUM(valor) AS valor "
+                "FROM diario WHERE dia BETWEEN ? AND ? GROUP BY dia ORDER BY dia",
+                (desde.isoformat(), ate.isoformat()),
+            ).fetchall()
+        return [dict(l) for l in linhas]
+
+    def executar(self):
+        while True:
+            for nome in self.tabelas:
+                try:
+                    self.sincronizar(nome)
+                except Exception as e:
+                    self.erros += 1
+                    self.ultimo_erro = f"{nome}: {e}"
+            self.ultima_sync = time.time()
+            self._acordar.wait(self.intervalo)
+            self._acordar.clear()
+
+@st.cache_resource
+def obter_agregados():
+    if not AGREGADOS_SQLITE: return None
+    tabelas = {
+        nome: api_airtable.table(BASE_ID, TABELAS_IDS[nome])
+        for nome in CAMPOS_AGREGADOS if TABELAS_IDS.get(nome)
+    }
+    agregados = AgregadosDiarios(AGREGADOS_SQLITE, tabelas, INTERVALO_SYNC_AGREGADOS, arquivo_historico)
+    threading.Thread(target=agregados.executar, name="agregados-diarios", daemon=True).start()
+    return agregados
+
+agregados = obter_agregados()
+
+# ---------------- Fila de gravação ----------------
+# Checklists, abastecimentos e trocas de óleo são confirmados assim que entram nesta fila
+# local (SQLite); uma thread envia ao Airtable em lotes com batch_create (fila_escrita.py).
+FILA_ESCRITA = st.secrets["connections"]["airtable"].get("fila_escrita", "fila_escrita.db")
+
+@st.cache_resource
+def obter_fila_escrita():
+    # Sem retry do urllib3: o backoff fica por conta do laço da fila
+    api = ClienteSobDemanda(lambda: criar_api(com_retry=False), obter_pyairtable_importado())
+    tabelas = {nome: api.table(BASE_ID, tabela_id) for nome, tabela_id in TABELAS_IDS.items() if tabela_id}
+    fila = FilaEscrita(FILA_ESCRITA, tabelas, registrar_escrita)
+    threading.Thread(target=fila.executar, name="fila-escrita", daemon=True).start()
+    return fila
+
+fila_escrita = obter_fila_escrita()
+
+# ---------------- Leituras em paralelo ----------------
+# Tabelas independentes de uma mesma tela são lidas ao mesmo tempo; o limitador da base
+# continua valendo, então o pool só sobrepõe a latência de cada requisição.
+MAX_LEITURAS_PARALELAS = 4
+
+@st.cache_resource
+def obter_executor_leituras():
+    return ThreadPoolExecutor(max_workers=MAX_LEITURAS_PARALELAS, thread_name_prefix="leituras")
+
+def ler_tabelas_em_paralelo(consultas):
+    # consultas: tabela -> opções de ler_tabela; tabelas não configuradas ficam de fora
+    executor = obter_executor_leituras()
+    api_airtable.obter()  # sessão criada na thread do script, antes das threads de leitura
+    futuros = {
+        nome: executor.submit(ler_tabela, nome, **opcoes)
+        for nome, opcoes in consultas.items() if tabelas_airtable.get(nome) is not None
+    }
+    return {nome: futuro.result() for nome, futuro in futuros.items()}
 
 # ---------------- Constantes ----------------
 TOLERANCIA_ALERTA  = 500
 OPCOES_COMBUSTIVEL = ["1/4", "1/2", "3/4", "Cheio"]
 TIPOS_SERVICO      = ["SAMU", "Remocao", "Van Hemodialise", "Moto"]
 OXIGENIO_MIN_PSI   = 50
+CAMPOS_OXIGENIO    = {"Oxigenio Grande 1": "Oxigênio Grande 1", "Oxigenio Grande 2": "Oxigênio Grande 2", "Oxigenio Portatil": "Oxigênio Portátil"}
 
 INTERVALOS_TROCA = {
     "SAMU": 10000,
@@ -49,6 +1071,10 @@ def parse_iso_datetime(dt_str: str):
     except Exception:
         return None
 
+def km_do_registro(f, campo):
+    try: return int(f.get(campo, 0))
+    except Exception: return 0
+
 def tocar_alerta():
     sound = """
     <audio autoplay>
@@ -57,18 +1083,155 @@ def tocar_alerta():
     """
     st.markdown(sound, unsafe_allow_html=True)
 
+JANELA_ENVIO_REPETIDO = 120  # segundos em que o mesmo conteúdo conta como toque duplo
+
+def chave_idempotencia(formulario, dados):
+    # Uma chave aleatória por envio. Repetir o mesmo conteúdo (a hora do envio não conta) logo
+    # em seguida reaproveita a chave do envio anterior; passada a janela, ou com qualquer campo
+    # diferente, é um envio novo (p.ex. o mesmo checklist no dia seguinte, viatura parada).
+    conteudo = hashlib.sha256(
+        json.dumps({k: v for k, v in dados.items() if k != "Data"}, sort_keys=True, ensure_ascii=False).encode()
+    ).hexdigest()
+    anterior = st.session_state.get(f"envio_{formulario}")
+    if anterior and anterior["conteudo"] == conteudo and time.time() - anterior["quando"] < JANELA_ENVIO_REPETIDO:
+        return anterior["chave"]
+    # Guardada antes de enfileirar: um toque que interrompe esta execução já encontra a chave
+    envio = {"chave": f"{formulario}:{uuid.uuid4().hex}", "conteudo": conteudo, "quando": time.time()}
+    st.session_state[f"envio_{formulario}"] = envio
+    return envio["chave"]
+
 # ---------------- Usuários ----------------
-def carregar_usuarios():
-    return [r.get("fields", {}) for r in usuarios_table.all()]
+ITERACOES_HASH_SENHA = 200_000
+PREFIXO_HASH_SENHA = "pbkdf2_sha256"
+INTERVALO_SYNC_USUARIOS = 30  # segundos entre sincronizações incrementais do diretório
+INTERVALO_RECARGA_USUARIOS = 300  # recarga completa, para que usuários apagados no Airtable deixem de entrar
+
+def gerar_hash_senha(senha):
+    sal = os.urandom(16)
+    derivada = hashlib.pbkdf2_hmac("sha256", senha.encode(), sal, ITERACOES_HASH_SENHA)
+    return f"{PREFIXO_HASH_SENHA}${ITERACOES_HASH_SENHA}${sal.hex()}${derivada.hex()}"
+
+def conferir_senha(senha, armazenada):
+    if not armazenada: return False
+    if not armazenada.startswith(PREFIXO_HASH_SENHA + "$"):
+        # Cadastros antigos guardam a senha em texto puro
+        return hmac.compare_digest(senha.encode(), armazenada.encode())
+    try:
+        _, iteracoes, sal, esperado = armazenada.split("$")
+        derivada = hashlib.pbkdf2_hmac("sha256", senha.encode(), bytes.fromhex(sal), int(iteracoes))
+    except Exception:
+        return False
+    return hmac.compare_digest(derivada.hex(), esperado)
+
+@st.cache_resource
+def obter_executor_senhas():
+    # PBKDF2 libera o GIL: as verificações rodam fora da thread do script sem travar as outras sessões
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="senhas")
+
+def _normalizar(valor):
+    return (valor or "").strip().lower()
+
+class DiretorioUsuarios:
+    def __init__(self, intervalo_sync, intervalo_recarga):
+        self.intervalo_sync = intervalo_sync
+        self.intervalo_recarga = intervalo_recarga
+        self._por_id = {}
+        self._por_usuario = {}
+        self._por_matricula = {}
+        self._marca_d_agua = None     # LAST_MODIFIED_TIME mais recente já lido (UTC)
+        self._ultima_sync = 0.0
+        self._ultima_recarga = 0.0
+        self._sincronizando = False
+        self._durante_recarga = {}    # id -> registro indexado enquanto a recarga completa busca
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _indexar(indices, registro):
+        por_id, por_usuario, por_matricula = indices
+        antigo = por_id.get(registro["id"])
+        if antigo:
+            por_usuario.pop(_normalizar(antigo["fields"].get("usuario")), None)
+            por_matricula.pop(_normalizar(antigo["fields"].get("matricula")), None)
+        por_id[registro["id"]] = registro
+        f = registro.get("fields", {})
+        if f.get("usuario"): por_usuario[_normalizar(f["usuario"])] = registro
+        if f.get("matricula"): por_matricula[_normalizar(f["matricula"])] = registro
+
+    def sincronizar(self, tabela, forcar=False):
+        # A requisição roda fora do lock: os logins seguem consultando o índice atual
+        # enquanto ela corre, e uma sessão só sincroniza por vez
+        with self._lock:
+            agora = time.monotonic()
+            if self._sincronizando: return
+            if not forcar and agora - self._ultima_sync < self.intervalo_sync: return
+            recarga = self._marca_d_agua is None or agora - self._ultima_recarga >= self.intervalo_recarga
+            marca = self._marca_d_agua
+            self._sincronizando = True
+            self._durante_recarga = {}
+        try:
+            inicio = datetime.now(timezone.utc)
+            if recarga:
+                registros = tabela.all()
+            else:
+                desde = (marca - timedelta(seconds=5)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+                registros = tabela.all(formula=f"IS_AFTER(LAST_MODIFIED_TIME(), '{desde}')")
+        except Exception:
+            with self._lock: self._sincronizando = False
+            raise
+        if recarga:
+            # Recarga completa: índices novos, sem os usuários apagados no Airtable
+            indices = ({}, {}, {})
+            for r in registros: self._indexar(indices, r)
+        with self._lock:
+            if recarga:
+                for r in self._durante_recarga.values(): self._indexar(indices, r)
+                self._por_id, self._por_usuario, self._por_matricula = indices
+                self._ultima_recarga = agora
+            else:
+                for r in registros: self._indexar(self._indices(), r)
+            self._marca_d_agua = inicio
+            self._ultima_sync = agora
+            self._sincronizando = False
+
+    def _indices(self):
+        return self._por_id, self._por_usuario, self._por_matricula
+
+    def _buscar(self, tabela, campo, valor):
+        with self._lock:
+            indice = self._por_usuario if campo == "usuario" else self._por_matricula
+            registro = indice.get(_normalizar(valor))
+        if registro: return registro
+        # Pode ter sido cadastrado por outra instância depois da última sincronização
+        from pyairtable import formulas
+        formula = f"LOWER(TRIM({{{campo}}}))={formulas.quoted(_normalizar(valor))}"
+        registro = tabela.first(formula=formula)
+        if registro: self.registrar(registro)
+        return registro
+
+    def por_usuario(self, tabela, usuario):
+        return self._buscar(tabela, "usuario", usuario)
+
+    def por_matricula(self, tabela, matricula):
+        return self._buscar(tabela, "matricula", matricula)
+
+    def registrar(self, registro):
+        with self._lock:
+            self._indexar(self._indices(), registro)
+            if self._sincronizando: self._durante_recarga[registro["id"]] = registro
+
+@st.cache_resource
+def obter_diretorio_usuarios():
+    return DiretorioUsuarios(INTERVALO_SYNC_USUARIOS, INTERVALO_RECARGA_USUARIOS)
 
 def salvar_usuario(usuario, senha, nome, matricula, telefone, is_admin=False):
-    existentes = carregar_usuarios()
+    diretorio = obter_diretorio_usuarios()
+    diretorio.sincronizar(usuarios_table)
 
-    if any(u.get("usuario", "").strip().lower() == usuario.strip().lower() for u in existentes):
+    if diretorio.por_usuario(usuarios_table, usuario):
         st.error("Já existe um usuário com esse login.")
         return
 
-    if any(u.get("matricula", "").strip().lower() == matricula.strip().lower() for u in existentes):
+    if diretorio.por_matricula(usuarios_table, matricula):
         st.error("Já existe um usuário com essa matrícula.")
         return
 
@@ -80,123 +1243,822 @@ def salvar_usuario(usuario, senha, nome, matricula, telefone, is_admin=False):
         st.error("Telefone inválido. Digite apenas os 11 números (DDD + celular).")
         return
 
-    usuarios_table.create({
+    senha_hash = obter_executor_senhas().submit(gerar_hash_senha, senha.strip()).result()
+    registro = usuarios_table.create({
         "usuario": usuario.strip(),
-        "senha": senha.strip(),
+        "senha": senha_hash,
         "nome": nome.strip(),
         "matricula": matricula.strip(),
         "telefone": telefone.strip(),
         "is_admin": bool(is_admin),
     })
+    diretorio.registrar(registro)
+    registrar_escrita("usuarios", [registro])
 
     st.success("Usuário cadastrado com sucesso!")
 
 def autenticar(usuario, senha):
-    for u in carregar_usuarios():
-        if u.get("usuario") == usuario and u.get("senha") == senha:
-            return {
-                "nome": u.get("nome"),
-                "matricula": u.get("matricula"),
-                "telefone": u.get("telefone", ""),
-                "admin": bool(u.get("is_admin", False))
-            }
-    return None
+    diretorio = obter_diretorio_usuarios()
+    diretorio.sincronizar(usuarios_table)
+    registro = diretorio.por_usuario(usuarios_table, usuario)
+    if not registro: return None
+    u = registro.get("fields", {})
+    if u.get("usuario") != usuario: return None
+    armazenada = u.get("senha", "")
+    if not obter_executor_senhas().submit(conferir_senha, senha, armazenada).result(): return None
+    if not armazenada.startswith(PREFIXO_HASH_SENHA + "$"):
+        # Migra a senha em texto puro para hash no primeiro login bem-sucedido
+        try:
+            novo_hash = obter_executor_senhas().submit(gerar_hash_senha, senha).result()
+            atualizado = usuarios_table.update(registro["id"], {"senha": novo_hash})
+            diretorio.registrar(atualizado)
+            registrar_escrita("usuarios", [atualizado])
+        except Exception:
+            pass
+    return {
+        "nome": u.get("nome"),
+        "matricula": u.get("matricula"),
+        "telefone": u.get("telefone", ""),
+        "admin": bool(u.get("is_admin", False))
+    }
 
 # ---------------- Viaturas ----------------
+# Cadastro compartilhado por todas as sessões: carrega uma vez, busca só o que mudou a cada
+# INTERVALO_SYNC_VIATURAS e recebe na hora as viaturas salvas por esta instância.
+INTERVALO_SYNC_VIATURAS = 60      # segundos entre sincronizações incrementais
+INTERVALO_RECARGA_VIATURAS = 600  # recarga completa, para refletir exclusões feitas no Airtable
+CAMPOS_VIATURA = ["Placa", "Prefixo", "Status", "TipoServico", "Observacoes"]
+
+def rotulo_viatura(v):
+    return f"{v.get('Prefixo','')} - {v.get('Placa','')}"
+
+class RegistroViaturas:
+    def __init__(self, intervalo_sync, intervalo_recarga):
+        self.intervalo_sync = intervalo_sync
+        self.intervalo_recarga = intervalo_recarga
+        self._por_id = {}             # id -> campos de CAMPOS_VIATURA
+        self._marca_d_agua = None     # LAST_MODIFIED_TIME mais recente já lido (UTC)
+        self._ultima_sync = 0.0
+        self._ultima_recarga = 0.0
+        self._lock = threading.Lock()
+        self.indice = self._montar_indice()
+
+    def _montar_indice(self):
+        # Índices e listas dos selectbox prontos; cada mudança troca o dicionário inteiro
+        todas = list(self._por_id.values())
+        ativas = [v for v in todas if v.get("Status") == "Ativa"]
+        ativas_por_tipo = {t: [v for v in ativas if v.get("TipoServico") == t] for t in TIPOS_SERVICO}
+        por_placa, por_rotulo = {}, {}
+        for v in todas:
+            if v.get("Placa"): por_placa.setdefault(v["Placa"], v)
+            por_rotulo.setdefault(rotulo_viatura(v), v)
+        return {
+            "todas": todas,
+            "ativas": ativas,
+            "por_placa": por_placa,
+            "por_rotulo": por_rotulo,
+            "opcoes_tipos": ["-- Selecione --"] + [t for t in TIPOS_SERVICO if ativas_por_tipo[t]],
+            "opcoes_por_tipo": {
+                t: ["-- Selecione --"] + [rotulo_viatura(v) for v in vs] for t, vs in ativas_por_tipo.items()
+            },
+            "opcoes_todas": ["-- Selecione --"] + [rotulo_viatura(v) for v in todas],
+        }
+
+    def _compactar(self, registro):
+        f = registro.get("fields", {})
+        return {campo: f[campo] for campo in CAMPOS_VIATURA if campo in f}
+
+    def sincronizar(self, tabela, forcar=False):
+        with self._lock:
+            agora = time.monotonic()
+            if not forcar and agora - self._ultima_sync < self.intervalo_sync: return
+            inicio = datetime.now(timezone.utc)
+            if self._marca_d_agua is None or agora - self._ultima_recarga >= self.intervalo_recarga:
+                registros = tabela.all(fields=CAMPOS_VIATURA)
+                self._por_id = {}
+                self._ultima_recarga = agora
+            else:
+                desde = (self._marca_d_agua - timedelta(seconds=5)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+                registros = tabela.all(formula=f"IS_AFTER(LAST_MODIFIED_TIME(), '{desde}')", fields=CAMPOS_VIATURA)
+            for r in registros: self._por_id[r["id"]] = self._compactar(r)
+            self._marca_d_agua = inicio
+            self._ultima_sync = agora
+            if registros or not self._por_id: self.indice = self._montar_indice()
+
+    def registrar(self, registro):
+        with self._lock:
+            self._por_id[registro["id"]] = self._compactar(registro)
+            self.indice = self._montar_indice()
+
+@st.cache_resource
+def obter_registro_viaturas():
+    return RegistroViaturas(INTERVALO_SYNC_VIATURAS, INTERVALO_RECARGA_VIATURAS)
+
+def indice_viaturas():
+    registro_viaturas = obter_registro_viaturas()
+    registro_viaturas.sincronizar(viaturas_table)
+    # Na troca de turno todas as viaturas são consultadas ao mesmo tempo: o LRU precisa caber a frota
+    cache_airtable.dimensionar(max(MAX_ENTRADAS_CACHE, ENTRADAS_CACHE_POR_VIATURA * len(registro_viaturas.indice["todas"])))
+    return registro_viaturas.indice
+
 def carregar_viaturas():
-    return [r.get("fields", {}) for r in viaturas_table.all()]
+    return indice_viaturas()["todas"]
 
 def salvar_viatura(placa, prefixo, status="Ativa", obs="", tipo_servico="SAMU"):
     if not placa or not prefixo:
-        st.sidebar.error("Placa e Prefixo são obrigatórios."); return
-    viaturas_table.create({
+        st.error("Placa e Prefixo são obrigatórios."); return False
+    registro = viaturas_table.create({
         "Placa": placa.strip().upper(),
         "Prefixo": prefixo.strip(),
         "Status": status,
         "Observacoes": (obs or "").strip(),
         "TipoServico": tipo_servico
     })
-    st.sidebar.success("Viatura cadastrada!")
+    obter_registro_viaturas().registrar(registro)
+    registrar_escrita("viaturas", [registro])
+    return True
+
+# ---------------- Snapshot da frota ----------------
+# Uma leitura por tabela por execução; os mapas por placa servem dashboard, alertas e histórico.
+_snapshot_frota = None
+
+CONSULTAS_SNAPSHOT = {
+    "trocaoleo": {"sort": ["-data"]},
+    "checklists": {"sort": ["-Data"]},
+    "abastecimentos": {"sort": ["-Data"]},
+}
+
+def _agrupar_por_placa(registros):
+    por_placa = {}
+    for f in registros:
+        placa = f.get("Placa")
+        if placa: por_placa.setdefault(placa, []).append(f)
+    return por_placa
+
+def _com_pendentes(nome, lidos):
+    # Registros ainda na fila de gravação intercalados por data com os do Airtable: a fila
+    # também recebe registros retroativos da importação, então pendente não quer dizer recente.
+    # Em datas iguais o pendente fica na frente, como em buscar_ultimo.
+    campo_data = CAMPO_DATA[nome]
+    return sorted(
+        fila_escrita.pendentes(nome) + [r.get("fields", {}) for r in lidos],
+        key=lambda f: str(f.get(campo_data, "")), reverse=True,
+    )
+
+def carregar_snapshot_frota():
+    global _snapshot_frota
+    if _snapshot_frota is None:
+        lidas = ler_tabelas_em_paralelo(CONSULTAS_SNAPSHOT)
+        trocas = _com_pendentes("trocaoleo", lidas["trocaoleo"])
+        checklists = _agrupar_por_placa(_com_pendentes("checklists", lidas["checklists"]))
+        trocas_por_placa = _agrupar_por_placa(trocas)
+        abastecimentos = (
+            _agrupar_por_placa(_com_pendentes("abastecimentos", lidas["abastecimentos"]))
+            if has_abastecimentos else {}
+        )
+        _snapshot_frota = {
+            "trocas": trocas,
+            "checklists_por_placa": checklists,
+            "trocas_por_placa": trocas_por_placa,
+            "abastecimentos_por_placa": abastecimentos,
+            "ultimo_km": {p: km_do_registro(regs[0], "Quilometragem") for p, regs in checklists.items()},
+            "ultima_troca": {p: km_do_registro(regs[0], "km") for p, regs in trocas_por_placa.items()},
+            "ultimo_km_abastecimento": {p: km_do_registro(regs[0], "Km") for p, regs in abastecimentos.items()},
+        }
+    return _snapshot_frota
+
+def invalidar_snapshot_frota():
+    global _snapshot_frota
+    _snapshot_frota = None
 
 # ---------------- Troca de óleo ----------------
 def obter_ultima_troca(placa):
-    registros = trocaoleo_table.all(sort=["-data"])
-    for r in registros:
-        f = r.get("fields", {})
-        if f.get("Placa") == placa:
-            try: return int(f.get("km", 0))
-            except Exception: return 0
-    return 0
+    if _snapshot_frota is not None:
+        return _snapshot_frota["ultima_troca"].get(placa, 0)
+    f = buscar_ultimo("trocaoleo", {"Placa": placa}, "data", ["km"])
+    return km_do_registro(f, "km") if f else 0
 
 def salvar_troca_oleo(placa, prefixo, km):
-    trocaoleo_table.create({
+    troca = {
         "Placa": placa,
         "Prefixo": prefixo,
         "km": int(km),
         "data": datetime.now().isoformat(),
-    })
+    }
+    fila_escrita.enfileirar("trocaoleo", troca)
+    invalidar_snapshot_frota()
+    atualizar_alertas("trocaoleo", [troca])
     st.success(f"Troca de óleo registrada para {placa} em {int(km)} km.")
 
 # ---------------- Checklists ----------------
-def salvar_checklist(dados):
-    checklists_table.create(dados, typecast=True)
+def salvar_checklist(dados, chave=None):
+    if not fila_escrita.enfileirar("checklists", dados, typecast=True, chave=chave): return False
+    invalidar_snapshot_frota()
+    atualizar_alertas("checklists", [dados])
+    obter_checklists_do_dia().registrar([dados])
+    return True
 
 def obter_ultimo_km_checklist(placa):
-    registros = checklists_table.all(sort=["-Data"])
-    for r in registros:
-        f = r.get("fields", {})
-        if f.get("Placa") == placa:
-            try: return int(f.get("Quilometragem", 0))
-            except Exception: return 0
-    return 0
+    if _snapshot_frota is not None:
+        return _snapshot_frota["ultimo_km"].get(placa, 0)
+    f = buscar_ultimo("checklists", {"Placa": placa}, "Data", ["Quilometragem"])
+    return km_do_registro(f, "Quilometragem") if f else 0
 
 def obter_ultimo_checklist_do_motorista_hoje(matricula: str):
-    hoje = date.today()
-    registros = checklists_table.all(sort=["-Data"])
-    for r in registros:
-        f = r.get("fields", {})
-        if f.get("Matricula") != matricula: continue
-        dt = parse_iso_datetime(f.get("Data", ""))
-        if dt and dt.date() == hoje: return f
-    return None
+    return obter_checklists_do_dia().obter(matricula)
+
+# ---------------- Checklists de hoje ----------------
+# Matrícula -> último checklist do dia, para o Abastecimento detectar a viatura sem consultar
+# o Airtable; uma única consulta limitada ao dia (re)monta o índice e cada save o atualiza.
+INTERVALO_SYNC_CHECKLISTS_DIA = 60  # segundos; só recarrega quando a matrícula não está no índice
+CAMPOS_CHECKLIST_DIA = ["Data", "Matricula", "Placa", "Prefixo", "Quilometragem", "TipoServico"]
+
+class ChecklistsDoDia:
+    def __init__(self, intervalo_sync):
+        self.intervalo_sync = intervalo_sync
+        self.dia = None
+        self._por_matricula = {}   # matrícula -> campos de CAMPOS_CHECKLIST_DIA
+        self._ultima_sync = 0.0
+        self._carga = None         # Event da carga em andamento
+        self._durante_carga = []   # registrados enquanto a carga consulta o Airtable
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _guardar(indice, f):
+        matricula = str(f.get("Matricula") or "").strip()
+        if not matricula: return
+        atual = indice.get(matricula)
+        if atual and str(atual.get("Data", "")) > str(f.get("Data", "")): return
+        indice[matricula] = {campo: f[campo] for campo in CAMPOS_CHECKLIST_DIA if campo in f}
+
+    def _buscar(self, hoje):
+        desde = datetime.combine(hoje, datetime.min.time())
+        if replica_pronta("checklists"):
+            registros = replica.listar("checklists", campo_data="Data", desde=desde, ordem="Data")
+        else:
+            registros = checklists_table.all(
+                formula=montar_formula(campo_data="Data", desde=desde), sort=["Data"], fields=CAMPOS_CHECKLIST_DIA,
+            )
+        indice = {}
+        for r in registros: self._guardar(indice, r.get("fields", {}))
+        # Gravações ainda na fila local (inclusive de outras sessões) entram por cima
+        for f in fila_escrita.pendentes("checklists"):
+            if str(f.get("Data", "")).startswith(hoje.isoformat()): self._guardar(indice, f)
+        return indice
+
+    def _carregar(self, hoje, carga):
+        # A consulta roda fora do lock: quem já está no índice não espera por ela
+        try:
+            indice = self._buscar(hoje)
+        except Exception:
+            with self._lock: self._carga = None
+            carga.set()
+            raise
+        with self._lock:
+            for f in self._durante_carga:
+                if str(f.get("Data", "")).startswith(hoje.isoformat()): self._guardar(indice, f)
+            self.dia, self._por_matricula = hoje, indice
+            self._ultima_sync = time.monotonic()
+            self._carga = None
+        carga.set()
+
+    def obter(self, matricula):
+        matricula = str(matricula or "").strip()
+        if not matricula: return None
+        hoje = date.today()
+        with self._lock:
+            if self.dia == hoje and (
+                # Fora do índice: pode ter feito o checklist em outra instância do app
+                matricula in self._por_matricula or time.monotonic() - self._ultima_sync < self.intervalo_sync
+            ):
+                return self._por_matricula.get(matricula)
+            carga, minha = self._carga, self._carga is None
+            if minha:
+                carga = self._carga = threading.Event()
+                self._durante_carga = []
+        # Uma carga por vez; as outras sessões que precisam dela esperam o resultado
+        if minha: self._carregar(hoje, carga)
+        else: carga.wait()
+        with self._lock:
+            return self._por_matricula.get(matricula) if self.dia == hoje else None
+
+    def registrar(self, lista_campos):
+        with self._lock:
+            if self._carga is not None: self._durante_carga.extend(lista_campos)
+            if self.dia is None: return  # ainda não carregado: a primeira consulta já traz o registro
+            for f in lista_campos:
+                if str(f.get("Data", "")).startswith(self.dia.isoformat()): self._guardar(self._por_matricula, f)
+
+@st.cache_resource
+def obter_checklists_do_dia():
+    return ChecklistsDoDia(INTERVALO_SYNC_CHECKLISTS_DIA)
 
 # ---------------- Abastecimentos ----------------
-def salvar_abastecimento(dados):
+def salvar_abastecimento(dados, chave=None):
     if not has_abastecimentos:
-        st.error("Tabela de Abastecimentos não configurada."); return
-    abastecimentos_table.create(dados, typecast=True)
+        st.error("Tabela de Abastecimentos não configurada."); return False
+    if not fila_escrita.enfileirar("abastecimentos", dados, typecast=True, chave=chave): return False
+    invalidar_snapshot_frota()
+    return True
 
 def obter_ultimo_km_abastecimento(placa):
     if not has_abastecimentos: return 0
-    registros = abastecimentos_table.all(sort=["-Data"])
-    for r in registros:
-        f = r.get("fields", {})
-        if f.get("Placa") == placa:
-            try: return int(f.get("Km", 0))
-            except Exception: return 0
-    return 0
+    if _snapshot_frota is not None:
+        return _snapshot_frota["ultimo_km_abastecimento"].get(placa, 0)
+    f = buscar_ultimo("abastecimentos", {"Placa": placa}, "Data", ["Km"])
+    return km_do_registro(f, "Km") if f else 0
+
+# ---------------- Consumo de combustível ----------------
+JANELA_MEDIA_CONSUMO = 5        # abastecimentos na média móvel de km/l
+LIMIAR_CONSUMO_SUSPEITO = 3.5   # desvios robustos (MAD) da mediana da própria viatura
+COLUNAS_ABASTECIMENTO = ["Data", "Placa", "Prefixo", "Condutor", "Matricula", "Km", "Litros", "Valor"]
+
+def relatorio_consumo(registros, arquivados=None):
+    df = pd.DataFrame.from_records(list(registros))
+    if arquivados is not None and arquivados.num_rows:
+        # Meses no arquivo histórico (pyarrow.Table) + Airtable; sem duplicar um arquivamento pela metade
+        df = pd.concat([arquivados.drop_columns(["id", "criado"]).to_pandas(), df], ignore_index=True)
+        df = df.drop_duplicates(subset=[c for c in ("Placa", "Data", "Km") if c in df.columns])
+    for coluna in COLUNAS_ABASTECIMENTO:
+        if coluna not in df.columns: df[coluna] = None
+    df["Data"] = pd.to_datetime(df["Data"], errors="coerce", utc=True, format="ISO8601").dt.tz_localize(None)
+    for coluna in ("Km", "Litros", "Valor"):
+        df[coluna] = pd.to_numeric(df[coluna], errors="coerce").astype("float64")
+    df = df.dropna(subset=["Placa", "Km"])
+    df["Placa"] = df["Placa"].astype("category")
+    df = df.sort_values(["Placa", "Km"], kind="mergesort").reset_index(drop=True)
+
+    # Uma passada vetorizada por coluna, com o deslocamento feito dentro de cada placa
+    por_placa = df.groupby("Placa", observed=True, sort=False)
+    df["Km anterior"] = por_placa["Km"].shift(1)
+    df["Km rodados"] = df["Km"] - df["Km anterior"]
+    df["Consumo (km/l)"] = (df["Km rodados"] / df["Litros"]).replace([float("inf"), -float("inf")], float("nan"))
+    df["R$/litro"] = (df["Valor"] / df["Litros"]).replace([float("inf"), -float("inf")], float("nan"))
+    df["R$/km"] = (df["Valor"] / df["Km rodados"]).replace([float("inf"), -float("inf")], float("nan"))
+    df["Média móvel (km/l)"] = (
+        por_placa["Consumo (km/l)"].rolling(JANELA_MEDIA_CONSUMO, min_periods=1).mean().reset_index(level=0, drop=True)
+    )
+
+    mediana = por_placa["Consumo (km/l)"].transform("median")
+    desvio = (df["Consumo (km/l)"] - mediana).abs()
+    mad = desvio.groupby(df["Placa"], observed=True).transform("median")
+    escore = 0.6745 * desvio / mad.where(mad > 0)
+    df["Suspeito"] = (escore > LIMIAR_CONSUMO_SUSPEITO) | (df["Consumo (km/l)"] <= 0)
+    return df
+
+def resumo_consumo_frota(df):
+    resumo = df.groupby("Placa", observed=True).agg(
+        Prefixo=("Prefixo", "last"),
+        Abastecimentos=("Km", "size"),
+        **{
+            "Km rodados": ("Km rodados", "sum"),
+            "Litros": ("Litros", "sum"),
+            "Valor (R$)": ("Valor", "sum"),
+            "Suspeitos": ("Suspeito", "sum"),
+        },
+    )
+    # km/l da frota: km total / litros dos abastecimentos que fecham um trecho (o primeiro não tem km anterior)
+    litros_com_trecho = df["Litros"].where(df["Km anterior"].notna()).groupby(df["Placa"], observed=True).sum()
+    resumo["Consumo médio (km/l)"] = (resumo["Km rodados"] / litros_com_trecho).round(2)
+    resumo["R$/km"] = (resumo["Valor (R$)"] / resumo["Km rodados"].where(resumo["Km rodados"] > 0)).round(2)
+    return resumo.reset_index()
+
+def resumo_agregados(linhas, por_placa):
+    df = pd.DataFrame(linhas, columns=["placa", "km", "litros", "valor", "checklists", "abastecimentos"])
+    df.insert(1, "tipo", df["placa"].map({p: v.get("TipoServico") for p, v in por_placa.items()}).fillna("—"))
+    df = df.rename(columns={
+        "placa": "Placa", "tipo": "Tipo", "km": "Km rodados", "litros": "Litros", "valor": "Valor (R$)",
+        "checklists": "Checklists", "abastecimentos": "Abastecimentos",
+    })
+    por_tipo = df.drop(columns="Placa").groupby("Tipo", as_index=False).sum()
+    for tabela in (df, por_tipo):
+        tabela["Consumo (km/l)"] = (tabela["Km rodados"] / tabela["Litros"].where(tabela["Litros"] > 0)).round(2)
+    return por_tipo, df.sort_values("Km rodados", ascending=False, ignore_index=True)
+
+# ---------------- Histórico paginado ----------------
+# O histórico de uma viatura é lido de 100 em 100 registros, do mais recente para o mais
+# antigo; páginas anteriores só são buscadas quando o admin pede.
+TAMANHO_PAGINA_HISTORICO = 100
+
+def _paginas_historico(nome, filtros, campo_data, desde, ate):
+    if not campo_data:
+        # Cadastros sem data (viaturas, usuários) são pequenos: uma leitura só
+        yield ler_tabela(nome); return
+    vistos = set()
+    for pagina in _paginas_vivas(nome, filtros, campo_data, desde, ate):
+        vistos.update(r["id"] for r in pagina)
+        yield pagina
+    # Depois do Airtable, os meses arquivados (mais antigos); um arquivamento interrompido
+    # pode deixar o mesmo registro nos dois lados
+    if arquivo_historico is not None and nome in TABELAS_ARQUIVO:
+        for pagina in arquivo_historico.paginas(nome, filtros.get("Placa"), desde, ate, TAMANHO_PAGINA_HISTORICO):
+            antigos = [r for r in pagina if r["id"] not in vistos]
+            if antigos: yield antigos
+
+def _paginas_vivas(nome, filtros, campo_data, desde, ate):
+    if replica_pronta(nome):
+        deslocamento = 0
+        while True:
+            pagina = replica.listar(
+                nome, filtros, campo_data, desde, ate, ordem=f"-{campo_data}",
+                limite=TAMANHO_PAGINA_HISTORICO, deslocamento=deslocamento,
+            )
+            if pagina: yield pagina
+            if len(pagina) < TAMANHO_PAGINA_HISTORICO: return
+            deslocamento += TAMANHO_PAGINA_HISTORICO
+    else:
+        yield from tabelas_airtable[nome].iterate(
+            formula=montar_formula(filtros, campo_data, desde, ate),
+            sort=[f"-{campo_data}"],
+            page_size=TAMANHO_PAGINA_HISTORICO,
+        )
+
+def _estado_historico(nome, filtros, campo_data, desde, ate):
+    # Só a visão em exibição (viatura + período) fica guardada na sessão
+    visao = (tuple(sorted(filtros.items())), desde, ate)
+    paginados = st.session_state.get("historico_paginado")
+    if not paginados or paginados["visao"] != visao:
+        paginados = st.session_state.historico_paginado = {"visao": visao, "tabelas": {}}
+    if nome not in paginados["tabelas"]:
+        paginados["tabelas"][nome] = {
+            "registros": fila_escrita.pendentes(nome, filtros),
+            "fim": False,
+            "paginas": _paginas_historico(nome, filtros, campo_data, desde, ate),
+        }
+        carregar_mais_historico(paginados["tabelas"][nome])
+    return paginados["tabelas"][nome]
+
+def carregar_mais_historico(estado):
+    # Uma página curta do Airtable pode ser seguida pelas do arquivo histórico
+    carregados = 0
+    try:
+        while carregados < TAMANHO_PAGINA_HISTORICO:
+            pagina = next(estado["paginas"])
+            estado["registros"].extend(r.get("fields", {}) for r in pagina)
+            carregados += len(pagina)
+    except StopIteration:
+        estado["fim"] = True
+    except requests.exceptions.HTTPError:
+        # O cursor de paginação do Airtable expira; recomeça do início na próxima execução
+        st.session_state.historico_paginado = None
+
+def mostrar_historico_paginado(nome, placa, campo_data, desde, ate, vazio, transformar=None):
+    estado = _estado_historico(nome, {"Placa": placa}, campo_data, desde, ate)
+    registros = estado["registros"]
+    if not registros:
+        st.info(vazio); return
+    df = pd.DataFrame(registros)
+    if transformar:
+        try: df = transformar(registros)
+        except Exception: pass
+    st.dataframe(df, use_container_width=True)
+    if estado["fim"]:
+        st.caption(f"{len(registros)} registro(s) — fim do histórico.")
+    else:
+        st.caption(f"{len(registros)} registro(s) carregados.")
+        st.button(
+            f"Carregar mais {TAMANHO_PAGINA_HISTORICO}", key=f"mais_{nome}",
+            on_click=carregar_mais_historico, args=(estado,),
+        )
+
+# ---------------- Importação e exportação ----------------
+# Planilhas são lidas em blocos e validadas coluna a coluna com as mesmas regras dos
+# formulários; as linhas aprovadas vão para a fila de gravação, que envia em lotes.
+TAMANHO_BLOCO_IMPORTACAO = 5000
+COLUNAS_CHECKLIST = [
+    "Data", "Condutor", "Matricula", "Placa", "Prefixo", "Quilometragem", "Combustivel",
+    "Oxigenio Grande 1", "Oxigenio Grande 2", "Oxigenio Portatil", "TipoServico",
+]
+REGRAS_IMPORTACAO = {
+    "checklists": {
+        "obrigatorias": ["Data", "Placa", "Quilometragem"],
+        "colunas": COLUNAS_CHECKLIST,
+        "km": "Quilometragem",
+        "positivos": ["Quilometragem"],
+        "oxigenio": list(CAMPOS_OXIGENIO),
+    },
+    "abastecimentos": {
+        "obrigatorias": ["Data", "Placa", "Km", "Litros", "Valor"],
+        "colunas": COLUNAS_ABASTECIMENTO,
+        "km": "Km",
+        "positivos": ["Km", "Litros", "Valor"],
+        "oxigenio": [],
+    },
+}
+COLUNAS_EXPORTACAO = {
+    "checklists": COLUNAS_CHECKLIST,
+    "abastecimentos": COLUNAS_ABASTECIMENTO,
+    "trocaoleo": ["data", "Placa", "Prefixo", "km"],
+    "viaturas": CAMPOS_VIATURA,
+    "usuarios": ["usuario", "nome", "matricula", "telefone", "is_admin"],  # nunca exporta a senha
+}
+
+def _ler_blocos(arquivo, nome_arquivo):
+    # Tudo vem como texto; a conversão de tipos é feita depois, já vetorizada
+    if nome_arquivo.lower().endswith(".xlsx"):
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise ValueError("Importar .xlsx requer o pacote openpyxl; envie um CSV ou instale-o.")
+        livro = load_workbook(arquivo, read_only=True, data_only=True)
+        try:
+            linhas = livro.active.iter_rows(values_only=True)
+            cabecalho = [str(c).strip() if c is not None else "" for c in next(linhas, ())]
+            bloco, inicio = [], 0
+            for linha in linhas:
+                bloco.append(linha[:len(cabecalho)])
+                if len(bloco) == TAMANHO_BLOCO_IMPORTACAO:
+                    yield pd.DataFrame(bloco, columns=cabecalho, index=pd.RangeIndex(inicio, inicio + len(bloco)), dtype=object)
+                    bloco, inicio = [], inicio + len(bloco)
+            if bloco:
+                yield pd.DataFrame(bloco, columns=cabecalho, index=pd.RangeIndex(inicio, inicio + len(bloco)), dtype=object)
+        finally:
+            livro.close()
+        return
+    amostra = arquivo.read(64 * 1024)
+    arquivo.seek(0)
+    try:
+        amostra.decode("utf-8"); codificacao = "utf-8-sig"
+    except UnicodeDecodeError:
+        codificacao = "latin-1"  # CSV salvo pelo Excel em português
+    primeira = amostra.split(b"\n", 1)[0]
+    separador = ";" if primeira.count(b";") > primeira.count(b",") else ","
+    yield from pd.read_csv(
+        arquivo, sep=separador, dtype=str, encoding=codificacao,
+        chunksize=TAMANHO_BLOCO_IMPORTACAO, skipinitialspace=True,
+    )
+
+def _converter_datas(serie):
+    # ISO (como o app grava) ou dd/mm/aaaa (planilhas em português)
+    iso = pd.to_datetime(serie, errors="coerce", format="ISO8601", utc=True)
+    br = pd.to_datetime(serie, errors="coerce", format="mixed", dayfirst=True, utc=True)
+    return iso.fillna(br).dt.tz_localize(None)
+
+def _converter_numeros(texto):
+    return pd.to_numeric(texto.str.replace(",", ".", regex=False), errors="coerce").astype("float64")
+
+def validar_bloco(nome, bloco, viaturas):
+    regras = REGRAS_IMPORTACAO[nome]
+    df = bloco.rename(columns=lambda c: str(c).strip())
+    ausentes = [c for c in regras["obrigatorias"] if c not in df.columns]
+    if ausentes: raise ValueError(f"Colunas obrigatórias ausentes: {', '.join(ausentes)}.")
+    df = df[[c for c in regras["colunas"] if c in df.columns]].astype("string").apply(lambda c: c.str.strip())
+    motivo = pd.Series(None, index=df.index, dtype=object)
+
+    def reprovar(mascara, texto):
+        motivo[mascara & motivo.isna()] = texto  # fica o primeiro motivo de cada linha
+
+    reprovar(~df["Placa"].str.upper().isin(list(viaturas["por_placa"])), "Placa não cadastrada")
+    df["Placa"] = df["Placa"].str.upper()
+    df["Data"] = _converter_datas(df["Data"])
+    reprovar(df["Data"].isna(), "Data inválida")
+    for coluna in regras["positivos"]:
+        df[coluna] = _converter_numeros(df[coluna])
+        reprovar(~(df[coluna] > 0), f"{coluna} deve ser maior que zero")
+    for coluna in regras["oxigenio"]:
+        # Em branco vale 0, como no formulário; texto ou PSI negativo/fracionado é recusado
+        texto = df[coluna] if coluna in df.columns else pd.Series(pd.NA, index=df.index, dtype="string")
+        psi = _converter_numeros(texto)
+        reprovar(texto.fillna("").ne("") & ~((psi >= 0) & (psi % 1 == 0)), f"{coluna} inválido (PSI)")
+        df[coluna] = psi.fillna(0)
+    if "Combustivel" in df.columns:
+        reprovar(df["Combustivel"].notna() & ~df["Combustivel"].isin(OPCOES_COMBUSTIVEL), "Combustível inválido")
+    for coluna in ("Prefixo", "TipoServico"):
+        if coluna not in regras["colunas"]: continue
+        do_cadastro = df["Placa"].map({p: v.get(coluna) for p, v in viaturas["por_placa"].items()})
+        df[coluna] = df[coluna].replace("", pd.NA).fillna(do_cadastro) if coluna in df.columns else do_cadastro
+    return df, motivo
+
+def _odometro_existente():
+    snapshot = carregar_snapshot_frota()
+    linhas = [
+        (placa, f.get("Data"), km_do_registro(f, campo))
+        for chave, campo in (("checklists_por_placa", "Quilometragem"), ("abastecimentos_por_placa", "Km"))
+        for placa, registros in snapshot[chave].items() for f in registros
+    ]
+    df = pd.DataFrame(linhas, columns=["Placa", "Data", "Km"])
+    df["Data"] = _converter_datas(df["Data"])
+    return df[df["Km"] > 0].dropna()
+
+def _km_fora_de_ordem(novos, existentes):
+    # Em cada viatura o km não pode cair com o passar das datas (checklists e abastecimentos
+    # juntos): cada linha nova precisa ser >= todo km anterior e <= todo km já gravado depois dela
+    todos = pd.concat([existentes.assign(linha=-1), novos], ignore_index=True)
+    todos = todos.sort_values(["Placa", "Data", "Km"], kind="mergesort", ignore_index=True)
+    nova = todos["linha"] >= 0
+    antes = todos.groupby("Placa", sort=False)["Km"].cummax().groupby(todos["Placa"], sort=False).shift(1)
+    gravado = todos["Km"].where(~nova).iloc[::-1]
+    placas = todos["Placa"].iloc[::-1]
+    depois = gravado.groupby(placas, sort=False).cummin().groupby(placas, sort=False).ffill().reindex(todos.index)
+    fora = nova & ((todos["Km"] < antes) | (todos["Km"] > depois))
+    return todos.loc[fora, ["linha", "Placa"]]
+
+def _ja_registradas(nome, novos):
+    # Mesma placa, data e km já gravada (no Airtable ou na fila) ou repetida no próprio arquivo:
+    # o mesmo extrato enviado de novo não duplica os registros
+    campo, colunas = REGRAS_IMPORTACAO[nome]["km"], ["Placa", "Data", "Km"]
+    existentes = pd.DataFrame(
+        [
+            (placa, f.get("Data"), km_do_registro(f, campo))
+            for placa, registros in carregar_snapshot_frota()[f"{nome}_por_placa"].items() for f in registros
+        ],
+        columns=colunas,
+    )
+    existentes["Data"] = _converter_datas(existentes["Data"])
+    existentes["Km"] = existentes["Km"].astype("float64")
+    gravadas = novos[colunas].merge(existentes.drop_duplicates(), how="left", on=colunas, indicator=True)
+    repetidas = gravadas["_merge"].eq("both").to_numpy() | novos.duplicated(colunas).to_numpy()
+    return novos[repetidas][["linha", "Placa"]]
+
+def _chave_importacao(nome, campos):
+    return f"importacao:{nome}:{campos['Placa']}:{campos['Data']}:{campos[REGRAS_IMPORTACAO[nome]['km']]}"
+
+def _campos_aprovados(nome, df):
+    df = df.copy()
+    df["Data"] = df["Data"].dt.strftime("%Y-%m-%dT%H:%M:%S")
+    for coluna in [REGRAS_IMPORTACAO[nome]["km"]] + REGRAS_IMPORTACAO[nome]["oxigenio"]:
+        df[coluna] = df[coluna].round().astype("int64")
+    return [{k: v for k, v in r.items() if not pd.isna(v)} for r in df.to_dict("records")]
+
+def importar_arquivo(nome, arquivo, nome_arquivo):
+    regras = REGRAS_IMPORTACAO[nome]
+    viaturas = indice_viaturas()
+    # 1ª passada: regras de cada linha e a série (placa, data, km) das linhas aprovadas
+    rejeitadas, serie = [], []
+    for bloco in _ler_blocos(arquivo, nome_arquivo):
+        df, motivo = validar_bloco(nome, bloco, viaturas)
+        reprovadas = motivo.notna()
+        rejeitadas.append(pd.DataFrame({"linha": df.index[reprovadas], "Placa": df["Placa"][reprovadas], "Motivo": motivo[reprovadas]}))
+        serie.append(pd.DataFrame({
+            "linha": df.index[~reprovadas], "Placa": df["Placa"][~reprovadas].astype(object),
+            "Data": df["Data"][~reprovadas], "Km": df[regras["km"]][~reprovadas],
+        }))
+    if not serie: return {"importados": 0, "oxigenio_baixo": 0, "rejeitadas": pd.DataFrame()}
+    serie = pd.concat(serie)
+    repetidas = _ja_registradas(nome, serie)
+    rejeitadas.append(repetidas.assign(Motivo="Já registrado (mesma placa, data e km)"))
+    serie = serie[~serie["linha"].isin(repetidas["linha"])]
+    fora = _km_fora_de_ordem(serie, _odometro_existente())
+    rejeitadas.append(fora.assign(Motivo=f"{regras['km']} fora de ordem para a viatura"))
+    recusadas = pd.concat([repetidas["linha"], fora["linha"]])
+
+    # 2ª passada: grava bloco a bloco só as linhas aprovadas. A chave de cada linha segura
+    # um segundo clique em "Importar" enquanto a primeira importação ainda enfileira.
+    arquivo.seek(0)
+    importados = oxigenio_baixo = 0
+    for bloco in _ler_blocos(arquivo, nome_arquivo):
+        df, motivo = validar_bloco(nome, bloco, viaturas)
+        aprovadas = df[motivo.isna() & ~df.index.isin(recusadas)]
+        if aprovadas.empty: continue
+        campos_aprovados = _campos_aprovados(nome, aprovadas)
+        campos_aprovados = fila_escrita.enfileirar_varios(
+            nome, campos_aprovados, typecast=True, chaves=[_chave_importacao(nome, c) for c in campos_aprovados],
+        )
+        if not campos_aprovados: continue
+        if regras["oxigenio"]:
+            oxigenio_baixo += sum(any(c.get(o, 0) < OXIGENIO_MIN_PSI for o in regras["oxigenio"]) for c in campos_aprovados)
+        atualizar_alertas(nome, campos_aprovados)
+        if nome == "checklists": obter_checklists_do_dia().registrar(campos_aprovados)
+        importados += len(campos_aprovados)
+    invalidar_snapshot_frota()
+
+    rejeitadas = pd.concat(rejeitadas, ignore_index=True).sort_values("linha")
+    rejeitadas.insert(0, "Linha", rejeitadas.pop("linha") + 2)  # + cabeçalho, contando a partir de 1
+    return {"importados": importados, "oxigenio_baixo": oxigenio_baixo, "rejeitadas": rejeitadas.reset_index(drop=True)}
+
+def exportar_csv(nome, desde=None, ate=None):
+    # Página por página direto para um arquivo temporário, sem montar a tabela inteira em memória
+    total = 0
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8-sig", newline="", suffix=".csv", delete=False) as arquivo:
+        escritor = csv.DictWriter(arquivo, fieldnames=COLUNAS_EXPORTACAO[nome], extrasaction="ignore", delimiter=";")
+        escritor.writeheader()
+        for pagina in _paginas_historico(nome, {}, CAMPO_DATA.get(nome), desde, ate):
+            escritor.writerows(r.get("fields", {}) for r in pagina)
+            total += len(pagina)
+    return arquivo.name, total
 
 # ---------------- Alertas ----------------
-def mostrar_alerta_troca(placa, km_atual, tipo_servico):
+ROTULOS_NIVEL = {"ok": "✅ OK", "atencao": "⚠️ Atenção", "urgente": "🚨 Urgente"}
+INTERVALO_RECONCILIAR_ALERTAS = 3600  # segundos; traz o que outras instâncias gravaram
+
+def status_troca(km_atual, ultima_troca, tipo_servico):
     intervalo = INTERVALOS_TROCA.get(tipo_servico, 10000)
+    if ultima_troca > 0: proxima = ultima_troca + intervalo
+    else: proxima = ((max(km_atual, 0) // intervalo) + 1) * intervalo
+    if km_atual < proxima - TOLERANCIA_ALERTA: nivel = "ok"
+    elif km_atual <= proxima + TOLERANCIA_ALERTA: nivel = "atencao"
+    else: nivel = "urgente"
+    return {"proxima": proxima, "faltam": proxima - km_atual, "nivel": nivel}
+
+def mostrar_alerta_troca(placa, km_atual, tipo_servico):
     ultima_troca_admin = obter_ultima_troca(placa)
+    status = status_troca(km_atual, ultima_troca_admin, tipo_servico)
+    proxima_troca = status["proxima"]
 
     if ultima_troca_admin > 0:
-        proxima_troca = ultima_troca_admin + intervalo
         contexto = f"Última troca: {ultima_troca_admin} km | Próxima: {proxima_troca} km."
     else:
-        proxima_troca = ((km_atual // intervalo) + 1) * intervalo
         contexto = f"Primeira troca prevista: {proxima_troca} km."
 
-    if km_atual < proxima_troca - TOLERANCIA_ALERTA:
-        st.info(f"ℹ️ Faltam {proxima_troca - km_atual} km para a troca de óleo. {contexto}")
-    elif proxima_troca - TOLERANCIA_ALERTA <= km_atual <= proxima_troca + TOLERANCIA_ALERTA:
+    if status["nivel"] == "ok":
+        st.info(f"ℹ️ Faltam {status['faltam']} km para a troca de óleo. {contexto}")
+    elif status["nivel"] == "atencao":
         st.warning(f"⚠️ {placa} está na FAIXA DE TROCA! Atual: {km_atual} km | {contexto}")
         tocar_alerta()
     else:
         st.error(f"🚨 URGENTE: {placa} já passou da troca! Prevista: {proxima_troca} km | Atual: {km_atual} km.")
         tocar_alerta()
 
+# Estado de alerta por viatura, mantido em memória para o processo todo: cada checklist ou
+# troca gravada reavalia só a própria viatura; a frota inteira só é lida na carga inicial
+# e na reconciliação periódica (a partir do snapshot da frota).
+class MotorAlertas:
+    def __init__(self, intervalo_reconciliar):
+        self.intervalo_reconciliar = intervalo_reconciliar
+        self._estado = {}    # placa -> {"data", "km", "ultima_troca", "oxigenio"}
+        self._alertas = {}   # (placa, "oleo" | "oxigenio") -> alerta ativo
+        self._ultima_carga = None
+        self._lock = threading.Lock()
+
+    def precisa_carregar(self):
+        return self._ultima_carga is None or time.monotonic() - self._ultima_carga >= self.intervalo_reconciliar
+
+    def _estado_da(self, placa):
+        return self._estado.setdefault(placa, {"data": "", "km": 0, "ultima_troca": 0, "oxigenio": {}})
+
+    def _aplicar_checklist(self, f):
+        estado = self._estado_da(f["Placa"])
+        if str(f.get("Data", "")) < estado["data"]: return False  # checklist retroativo (importação)
+        estado["data"] = str(f.get("Data", ""))
+        estado["km"] = km_do_registro(f, "Quilometragem")
+        estado["oxigenio"] = {campo: km_do_registro(f, campo) for campo in CAMPOS_OXIGENIO if campo in f}
+        return True
+
+    def _avaliar(self, placa, viatura):
+        estado = self._estado[placa]
+        novos = {}
+        status = status_troca(estado["km"], estado["ultima_troca"], viatura.get("TipoServico", "SAMU"))
+        if status["nivel"] == "atencao":
+            novos["oleo"] = ("atencao", f"Faixa de troca de óleo: {estado['km']} km (prevista {status['proxima']} km)")
+        elif status["nivel"] == "urgente":
+            novos["oleo"] = ("urgente", f"Troca de óleo vencida: {estado['km']} km (prevista {status['proxima']} km)")
+        baixos = [f"{CAMPOS_OXIGENIO[c]} {psi} PSI" for c, psi in estado["oxigenio"].items() if psi < OXIGENIO_MIN_PSI]
+        if baixos: novos["oxigenio"] = ("urgente", "Oxigênio baixo: " + ", ".join(baixos))
+
+        for tipo in ("oleo", "oxigenio"):
+            chave, atual = (placa, tipo), self._alertas.get((placa, tipo))
+            if tipo not in novos:
+                self._alertas.pop(chave, None); continue
+            nivel, mensagem = novos[tipo]
+            self._alertas[chave] = {
+                "nivel": nivel, "viatura": rotulo_viatura(viatura), "mensagem": mensagem,
+                "desde": atual["desde"] if atual and atual["nivel"] == nivel else datetime.now(),
+            }
+
+    def carregar(self, snapshot, por_placa):
+        with self._lock:
+            self._estado, self._alertas = {}, {}
+            for registros in snapshot["checklists_por_placa"].values(): self._aplicar_checklist(registros[0])
+            for placa, km in snapshot["ultima_troca"].items(): self._estado_da(placa)["ultima_troca"] = km
+            for placa in self._estado:
+                if placa in por_placa: self._avaliar(placa, por_placa[placa])
+            self._ultima_carga = time.monotonic()
+
+    def aplicar(self, nome, campos, por_placa):
+        placa = campos.get("Placa")
+        # Antes da carga inicial não há estado a atualizar; a carga já inclui a fila de gravação
+        if self._ultima_carga is None or not placa: return
+        with self._lock:
+            if nome == "checklists":
+                if not self._aplicar_checklist(campos): return
+            elif nome == "trocaoleo":
+                estado = self._estado_da(placa)
+                estado["ultima_troca"] = max(estado["ultima_troca"], km_do_registro(campos, "km"))
+            else:
+                return
+            if placa in por_placa: self._avaliar(placa, por_placa[placa])
+
+    def feed(self):
+        with self._lock:
+            alertas = list(self._alertas.values())
+        alertas.sort(key=lambda a: a["desde"], reverse=True)
+        return sorted(alertas, key=lambda a: a["nivel"] != "urgente")
+
+@st.cache_resource
+def obter_motor_alertas():
+    return MotorAlertas(INTERVALO_RECONCILIAR_ALERTAS)
+
+def alertas_da_frota():
+    motor = obter_motor_alertas()
+    if motor.precisa_carregar():
+        motor.carregar(carregar_snapshot_frota(), indice_viaturas()["por_placa"])
+    return motor.feed()
+
+def atualizar_alertas(nome, lista_campos):
+    motor = obter_motor_alertas()
+    por_placa = indice_viaturas()["por_placa"]
+    for campos in lista_campos: motor.aplicar(nome, campos, por_placa)
+
 # ---------------- UI ----------------
 st.set_page_config(page_title="Checklist SAMU", page_icon="🚑")
 st.title("🚑 Check List Ambulância SAMU/SOCIAL")
@@ -205,8 +2067,331 @@ if "usuario" not in st.session_state: st.session_state.usuario = None
 if "tela" not in st.session_state: st.session_state.tela = "login"
 if "viatura_atual" not in st.session_state: st.session_state.viatura_atual = None  # {"placa": "...", "prefixo": "..."}
 
+# ---------------- Fragmentos da tela principal ----------------
+# Formulários e painéis do admin com widgets próprios: editar um campo reexecuta só o
+# próprio trecho. Gravações feitas por um admin reexecutam a tela inteira, para os
+# painéis sem widgets (alertas, dashboard, consumo) refletirem o dado novo.
+def mostrar_checklist_salvo(dados):
+    st.success("Checklist registrado!")
+    mostrar_alerta_troca(dados["Placa"], dados["Quilometragem"], dados["TipoServico"])
+    for campo, rotulo in CAMPOS_OXIGENIO.items():
+        if dados[campo] < OXIGENIO_MIN_PSI:
+            st.error(f"🚨 {rotulo} muito baixo ({dados[campo]} PSI)."); tocar_alerta()
+
+@fragmento
+def formulario_checklist():
+    marcar_secao("Checklist")
+    st.subheader("✅ Checklist da viatura")
+    viaturas = indice_viaturas()
+
+    if not viaturas["ativas"]:
+        st.info("Cadastre viaturas ativas para continuar.")
+    else:
+        tipo_escolhido = st.selectbox("Tipo de serviço", viaturas["opcoes_tipos"])
+
+        placa, prefixo = None, None
+        if tipo_escolhido and tipo_escolhido != "-- Selecione --":
+            escolha = st.selectbox("Viatura", viaturas["opcoes_por_tipo"][tipo_escolhido])
+            if escolha and escolha != "-- Selecione --":
+                viatura = viaturas["por_rotulo"].get(escolha)
+                if viatura:
+                    placa = viatura.get("Placa")
+                    prefixo = viatura.get("Prefixo")
+
+        if placa and prefixo and tipo_escolhido and tipo_escolhido != "-- Selecione --":
+            ultimo_km_check = obter_ultimo_km_checklist(placa)
+            if ultimo_km_check > 0: st.info(f"Último km de checklist: {ultimo_km_check} km.")
+            ultima_troca_admin = obter_ultima_troca(placa)
+            if ultima_troca_admin > 0: st.info(f"Última troca de óleo: {ultima_troca_admin} km.")
+
+            km = st.number_input("Quilometragem atual (checklist)", min_value=0, step=1)
+            comb = st.radio("Nível de combustível", OPCOES_COMBUSTIVEL, horizontal=True)
+
+            st.markdown("#### Oxigênio")
+            ox1_str = st.text_input("Oxigênio Grande 1 (PSI)")
+            ox2_str = st.text_input("Oxigênio Grande 2 (PSI)")
+            oxp_str = st.text_input("Oxigênio Portátil (PSI)")
+            ox1 = int(ox1_str) if ox1_str.strip().isdigit() else 0
+            ox2 = int(ox2_str) if ox2_str.strip().isdigit() else 0
+            oxp = int(oxp_str) if oxp_str.strip().isdigit() else 0
+
+            salvo = st.session_state.pop("checklist_salvo", None)
+            if st.button("Salvar checklist"):
+                if km <= 0:
+                    st.error("Informe uma quilometragem válida!"); tocar_alerta()
+                elif ultimo_km_check and km < ultimo_km_check:
+                    st.error(f"A quilometragem informada ({km}) é menor que a última ({ultimo_km_check})."); tocar_alerta()
+                else:
+                    dados = {
+                        "Data": datetime.now().isoformat(),
+                        "Condutor": st.session_state.usuario["nome"],
+                        "Matricula": st.session_state.usuario["matricula"],
+                        "Placa": placa,
+                        "Prefixo": prefixo,
+                        "Quilometragem": int(km),
+                        "Combustivel": comb,
+                        "Oxigenio Grande 1": ox1,
+                        "Oxigenio Grande 2": ox2,
+                        "Oxigenio Portatil": oxp,
+                        "TipoServico": tipo_escolhido
+                    }
+                    if not salvar_checklist(dados, chave_idempotencia("checklist", dados)):
+                        st.info("Este checklist já foi registrado; o envio repetido foi ignorado.")
+                    else:
+                        st.session_state.viatura_atual = {"placa": placa, "prefixo": prefixo}
+                        if st.session_state.usuario.get("admin", False):
+                            # Painéis do admin (alertas, dashboard) refletem o novo checklist
+                            st.session_state.checklist_salvo = dados
+                            reexecutar()
+                        mostrar_checklist_salvo(dados)
+            elif salvo:
+                mostrar_checklist_salvo(salvo)
+
+            if st.session_state.usuario.get("admin", False):
+                st.markdown("---")
+                st.subheader("Troca de óleo")
+                if st.button("Registrar troca de óleo"):
+                    if km <= 0:
+                        st.error("Informe uma quilometragem válida para registrar a troca!")
+                    elif ultimo_km_check and km < ultimo_km_check:
+                        st.error(f"Não é possível registrar troca com km menor que o último checklist ({ultimo_km_check}).")
+                    else:
+                        salvar_troca_oleo(placa, prefixo, km)
+                        reexecutar()
+
+@fragmento
+def formulario_abastecimento():
+    marcar_secao("Abastecimento")
+    st.subheader("⛽ Registro de abastecimento")
+    if not has_abastecimentos:
+        st.info("Funcionalidade de abastecimento desativada: configure 'abastecimentos_table_id' nos secrets.")
+    else:
+        placa, prefixo = None, None
+        if st.session_state.viatura_atual:
+            placa = st.session_state.viatura_atual.get("placa")
+            prefixo = st.session_state.viatura_atual.get("prefixo")
+            st.info(f"Usando viatura da sessão: {prefixo} - {placa}")
+        else:
+            ultimo = obter_ultimo_checklist_do_motorista_hoje(st.session_state.usuario["matricula"])
+            if ultimo:
+                placa = ultimo.get("Placa")
+                prefixo = ultimo.get("Prefixo")
+                st.session_state.viatura_atual = {"placa": placa, "prefixo": prefixo}
+                st.info(f"Detectada última viatura do checklist de hoje: {prefixo} - {placa}")
+
+        if not placa or not prefixo:
+            st.warning("Nenhuma viatura detectada para hoje. Selecione abaixo:")
+            viaturas = indice_viaturas()
+            if not viaturas["ativas"]:
+                st.info("Cadastre viaturas ativas para continuar.")
+            else:
+                tipo_escolhido_abast = st.selectbox("Tipo de serviço", viaturas["opcoes_tipos"])
+                if tipo_escolhido_abast and tipo_escolhido_abast != "-- Selecione --":
+                    escolha = st.selectbox("Viatura", viaturas["opcoes_por_tipo"][tipo_escolhido_abast])
+                    if escolha and escolha != "-- Selecione --":
+                        v = viaturas["por_rotulo"].get(escolha)
+                        if v:
+                            placa = v.get("Placa"); prefixo = v.get("Prefixo")
+                            st.session_state.viatura_atual = {"placa": placa, "prefixo": prefixo}
+        else:
+            v_match = indice_viaturas()["por_placa"].get(placa)
+            tipo_escolhido_abast = v_match.get("TipoServico") if v_match else "SAMU"
+
+        if placa and prefixo:
+            st.success(f"Registrando abastecimento para: {prefixo} - {placa}")
+            ultimo_km_check = obter_ultimo_km_checklist(placa)
+            ultimo_km_abast = obter_ultimo_km_abastecimento(placa)
+            if ultimo_km_check > 0: st.info(f"Último km de checklist: {ultimo_km_check} km.")
+            if ultimo_km_abast > 0: st.info(f"Último km de abastecimento: {ultimo_km_abast} km.")
+
+            km_abast = st.number_input("Quilometragem no abastecimento", min_value=0, step=1)
+            litros   = st.number_input("Litros abastecidos", min_value=0.0, step=0.1, format="%.1f")
+            valor    = st.number_input("Valor total (R$)", min_value=0.0, step=0.01, format="%.2f")
+
+            salvo = st.session_state.pop("abastecimento_salvo", None)
+            if st.button("Salvar abastecimento"):
+                if km_abast <= 0 or litros <= 0 or valor <= 0:
+                    st.error("Informe valores válidos para km, litros e valor."); tocar_alerta()
+                elif ultimo_km_check and km_abast < ultimo_km_check:
+                    st.error(f"O km do abastecimento ({km_abast}) não pode ser menor que o último checklist ({ultimo_km_check})."); tocar_alerta()
+                elif ultimo_km_abast and km_abast < ultimo_km_abast:
+                    st.error(f"O km do abastecimento ({km_abast}) não pode ser menor que o último abastecimento ({ultimo_km_abast})."); tocar_alerta()
+                else:
+                    dados_abast = {
+                        "Data": datetime.now().isoformat(),
+                        "Placa": placa,
+                        "Prefixo": prefixo,
+                        "Condutor": st.session_state.usuario["nome"],
+                        "Matricula": st.session_state.usuario["matricula"],
+                        "Km": int(km_abast),
+                        "Litros": float(litros),
+                        "Valor": float(valor)
+                    }
+                    if not salvar_abastecimento(dados_abast, chave_idempotencia("abastecimento", dados_abast)):
+                        st.info("Este abastecimento já foi registrado; o envio repetido foi ignorado.")
+                    else:
+                        if st.session_state.usuario.get("admin", False):
+                            st.session_state.abastecimento_salvo = True
+                            reexecutar()
+                        st.success("Abastecimento registrado com sucesso!")
+            elif salvo:
+                st.success("Abastecimento registrado com sucesso!")
+
+@fragmento
+def formulario_viatura():
+    st.subheader("Gestão de viaturas")
+    placa_admin = st.text_input("Placa")
+    prefixo_admin = st.text_input("Prefixo")
+    status_admin = st.selectbox("Status", ["Ativa", "Inativa"])
+    tipo_servico_admin = st.selectbox("Tipo de serviço", TIPOS_SERVICO)
+    obs_admin = st.text_area("Observações")
+    if st.session_state.pop("viatura_salva", False): st.success("Viatura cadastrada!")
+    if st.button("Adicionar viatura"):
+        if salvar_viatura(placa_admin, prefixo_admin, status_admin, obs_admin, tipo_servico_admin):
+            # Listas de viaturas do formulário e do dashboard passam a incluir a nova
+            st.session_state.viatura_salva = True
+            reexecutar()
+
+@fragmento
+def painel_relatorio():
+    st.markdown("---")
+    marcar_secao("relatório")
+    st.subheader("📈 Relatório da frota")
+    if agregados is None:
+        st.info("Agregados diários desativados (configure 'agregados_sqlite' nos secrets).")
+    elif not agregados.pronto():
+        st.info("Montando os agregados diários pela primeira vez; volte em instantes.")
+    else:
+        hoje = date.today()
+        periodo_rel = st.date_input("Período do relatório", value=(hoje.replace(day=1), hoje), format="DD/MM/YYYY")
+        if len(periodo_rel) == 2:
+            por_tipo_rel, por_placa_rel = resumo_agregados(
+                agregados.totais_por_placa(*periodo_rel), indice_viaturas()["por_placa"]
+            )
+            if por_placa_rel.empty:
+                st.info("Nenhum checklist ou abastecimento no período.")
+            else:
+                st.markdown("**Por tipo de serviço**")
+                st.dataframe(por_tipo_rel, use_container_width=True)
+                st.markdown("**Por viatura**")
+                st.dataframe(por_placa_rel, use_container_width=True)
+                por_dia_rel = pd.DataFrame(agregados.totais_por_dia(*periodo_rel))
+                st.markdown("**Km rodados por dia**")
+                st.bar_chart(por_dia_rel.set_index("dia")["km"])
+    if agregados is not None:
+        st.caption(
+            "Agregados atualizados "
+            + (f"há {time.time() - agregados.ultima_sync:.0f}s" if agregados.ultima_sync else "(primeira carga em andamento)")
+            + (f" | erros: {agregados.erros}" if agregados.erros else "")
+        )
+        st.button("Reconstruir agregados", on_click=agregados.reconstruir)
+
+@fragmento
+def painel_historico():
+    st.markdown("---")
+    marcar_secao("histórico")
+    st.subheader("📜 Histórico de viaturas")
+    viaturas_hist = indice_viaturas()
+    escolha_hist = st.selectbox("Selecione a viatura", viaturas_hist["opcoes_todas"])
+    if escolha_hist and escolha_hist != "-- Selecione --":
+        viatura_sel = viaturas_hist["por_rotulo"].get(escolha_hist)
+        if viatura_sel:
+            placa_sel = viatura_sel.get("Placa")
+            periodo_hist = st.date_input("Período (opcional)", value=(), format="DD/MM/YYYY")
+            desde_hist, ate_hist = None, None
+            if len(periodo_hist) == 2:
+                desde_hist = datetime.combine(periodo_hist[0], datetime.min.time())
+                ate_hist = datetime.combine(periodo_hist[1], datetime.min.time()) + timedelta(days=1)
+
+            st.markdown("### ✅ Checklists")
+            mostrar_historico_paginado(
+                "checklists", placa_sel, "Data", desde_hist, ate_hist,
+                "Nenhum checklist registrado para esta viatura.",
+            )
+
+            st.markdown("### 🛢️ Trocas de óleo")
+            mostrar_historico_paginado(
+                "trocaoleo", placa_sel, "data", desde_hist, ate_hist,
+                "Nenhuma troca de óleo registrada para esta viatura.",
+            )
+
+            if has_abastecimentos:
+                st.markdown("### ⛽ Abastecimentos")
+                mostrar_historico_paginado(
+                    "abastecimentos", placa_sel, "Data", desde_hist, ate_hist,
+                    "Nenhum abastecimento registrado para esta viatura.", transformar=relatorio_consumo,
+                )
+            else:
+                st.info("Histórico de abastecimentos desativado (configure 'abastecimentos_table_id' nos secrets).")
+
+@fragmento
+def painel_importacao():
+    st.markdown("---")
+    marcar_secao("importação")
+    st.subheader("📦 Importação e exportação")
+
+    st.markdown("#### Importar planilha")
+    tabela_imp = st.selectbox("Importar para", ["checklists"] + (["abastecimentos"] if has_abastecimentos else []))
+    st.caption(
+        f"Colunas obrigatórias: {', '.join(REGRAS_IMPORTACAO[tabela_imp]['obrigatorias'])}. "
+        f"Opcionais: {', '.join(c for c in REGRAS_IMPORTACAO[tabela_imp]['colunas'] if c not in REGRAS_IMPORTACAO[tabela_imp]['obrigatorias'])}."
+    )
+    arquivo_imp = st.file_uploader("Arquivo CSV ou Excel (.xlsx)", type=["csv", "xlsx"])
+    if arquivo_imp is not None and st.button("Importar"):
+        try:
+            resultado_imp = importar_arquivo(tabela_imp, arquivo_imp, arquivo_imp.name)
+        except ValueError as e:
+            st.error(str(e))
+        else:
+            st.success(f"{resultado_imp['importados']} registro(s) enviados para a fila de gravação.")
+            if resultado_imp["oxigenio_baixo"]:
+                st.warning(f"{resultado_imp['oxigenio_baixo']} checklist(s) importados com oxigênio abaixo de {OXIGENIO_MIN_PSI} PSI.")
+            if not resultado_imp["rejeitadas"].empty:
+                st.error(f"{len(resultado_imp['rejeitadas'])} linha(s) recusadas:")
+                st.dataframe(resultado_imp["rejeitadas"], use_container_width=True)
+
+    st.markdown("#### Exportar CSV")
+    tabela_exp = st.selectbox("Exportar tabela", [n for n in COLUNAS_EXPORTACAO if tabelas_airtable.get(n) is not None])
+    desde_exp, ate_exp = None, None
+    if CAMPO_DATA.get(tabela_exp):
+        periodo_exp = st.date_input("Período da exportação (opcional)", value=(), format="DD/MM/YYYY")
+        if len(periodo_exp) == 2:
+            desde_exp = datetime.combine(periodo_exp[0], datetime.min.time())
+            ate_exp = datetime.combine(periodo_exp[1], datetime.min.time()) + timedelta(days=1)
+    if st.button("Gerar arquivo"):
+        anterior = st.session_state.get("exportacao")
+        if anterior and os.path.exists(anterior["caminho"]): os.remove(anterior["caminho"])
+        caminho_exp, total_exp = exportar_csv(tabela_exp, desde_exp, ate_exp)
+        st.session_state.exportacao = {"nome": f"{tabela_exp}.csv", "caminho": caminho_exp, "total": total_exp}
+    exportacao = st.session_state.get("exportacao")
+    if exportacao and os.path.exists(exportacao["caminho"]):
+        st.caption(f"{exportacao['nome']}: {exportacao['total']} registro(s).")
+        with open(exportacao["caminho"], "rb") as arquivo_exp:
+            st.download_button("⬇️ Baixar CSV", data=arquivo_exp, file_name=exportacao["nome"], mime="text/csv")
+
+@fragmento
+def painel_arquivo():
+    st.markdown("---")
+    marcar_secao("arquivo histórico")
+    st.subheader("🗄️ Arquivo histórico")
+    if arquivo_historico is None:
+        st.info("Arquivo histórico desativado (configure 'arquivo_historico' nos secrets com uma pasta em disco persistente).")
+    else:
+        for nome_arq, info_arq in arquivo_historico.resumo().items():
+            meses_arq = f" ({info_arq['meses'][0]} a {info_arq['meses'][1]})" if info_arq["meses"] else ""
+            st.caption(f"{nome_arq}: {info_arq['registros']} registro(s) arquivados{meses_arq}")
+        corte_arq = corte_arquivo()
+        confirmado_arq = st.checkbox(
+            f"Mover para o arquivo os registros anteriores a {corte_arq:%d/%m/%Y} "
+            "(são apagados do Airtable depois de gravados no arquivo)"
+        )
+        if st.button("Arquivar", disabled=not confirmado_arq or arquivo_historico.em_andamento):
+            arquivo_historico.iniciar(corte_arq)
+        if arquivo_historico.progresso: st.caption(arquivo_historico.progresso)
+
 # ---------------- Tela de Login ----------------
 if st.session_state.tela == "login" and not st.session_state.usuario:
+    marcar_secao("login")
     st.subheader("Login")
     usuario = st.text_input("Usuário")
     senha = st.text_input("Senha", type="password")
@@ -218,16 +2403,17 @@ if st.session_state.tela == "login" and not st.session_state.usuario:
             if u:
                 st.session_state.usuario = u
                 st.session_state.tela = "principal"
-                st.rerun()
+                reexecutar()
             else:
                 st.error("Usuário ou senha incorretos!")
     with c2:
         if st.button("Cadastro"):
             st.session_state.tela = "cadastro"
-            st.rerun()
+            reexecutar()
 
 # ---------------- Tela de Cadastro ----------------
 elif st.session_state.tela == "cadastro" and not st.session_state.usuario:
+    marcar_secao("cadastro")
     st.subheader("Cadastro de usuário")
 
     novo_user    = st.text_input("Novo usuário (login)")
@@ -257,7 +2443,7 @@ elif st.session_state.tela == "cadastro" and not st.session_state.usuario:
     with cc2:
         if st.button("Voltar para login"):
             st.session_state.tela = "login"
-            st.rerun()
+            reexecutar()
 # ---------------- Tela Principal ----------------
 elif st.session_state.usuario:
     st.success(f"Bem-vindo, {st.session_state.usuario['nome']} ({st.session_state.usuario['matricula']})")
@@ -265,256 +2451,165 @@ elif st.session_state.usuario:
 
     # Sidebar Admin
     if st.session_state.usuario.get("admin", False):
-        st.sidebar.subheader("Gestão de viaturas")
-        placa_admin = st.sidebar.text_input("Placa")
-        prefixo_admin = st.sidebar.text_input("Prefixo")
-        status_admin = st.sidebar.selectbox("Status", ["Ativa", "Inativa"])
-        tipo_servico_admin = st.sidebar.selectbox("Tipo de serviço", TIPOS_SERVICO)
-        obs_admin = st.sidebar.text_area("Observações")
-        if st.sidebar.button("Adicionar viatura"):
-            salvar_viatura(placa_admin, prefixo_admin, status_admin, obs_admin, tipo_servico_admin)
+        marcar_secao("dashboard")
+        carregar_snapshot_frota()
+        st.sidebar.subheader("🚨 Alertas da frota")
+        alertas = alertas_da_frota()
+        if alertas:
+            st.sidebar.dataframe(
+                pd.DataFrame([
+                    {"Nível": ROTULOS_NIVEL[a["nivel"]], "Viatura": a["viatura"], "Alerta": a["mensagem"],
+                     "Desde": a["desde"].strftime("%d/%m %H:%M")}
+                    for a in alertas
+                ]),
+                use_container_width=True,
+            )
+        else:
+            st.sidebar.success("Nenhum alerta ativo na frota.")
 
         st.sidebar.markdown("---")
+        with st.sidebar:
+            formulario_viatura()
+        st.sidebar.markdown("---")
         st.sidebar.subheader("Histórico de trocas de óleo")
-        trocas = [r.get("fields", {}) for r in trocaoleo_table.all(sort=["-data"])]
+        trocas = carregar_snapshot_frota()["trocas"]
         if trocas: st.sidebar.dataframe(pd.DataFrame(trocas), use_container_width=True)
         else: st.sidebar.info("Nenhuma troca registrada ainda.")
 
-    # Checklist
+        st.sidebar.markdown("---")
+        st.sidebar.subheader("Cache do Airtable")
+        est_cache = cache_airtable.estatisticas()
+        st.sidebar.caption(
+            f"Acertos: {est_cache['acertos']} | Falhas: {est_cache['falhas']} | "
+            f"Taxa: {est_cache['taxa_acerto']:.0%} | Entradas: {est_cache['entradas']} | "
+            f"Invalidações: {est_cache['invalidacoes']}"
+        )
+        st.sidebar.markdown("---")
+        st.sidebar.subheader("Fila de gravação")
+        est_fila = fila_escrita.estatisticas()
+        st.sidebar.caption(
+            f"Pendentes: {est_fila['profundidade']} | Gravados: {est_fila['gravados']} | "
+            f"Repetidos ignorados: {est_fila['duplicados']} | "
+            + (f"Latência média: {est_fila['latencia_media']:.1f}s (máx {est_fila['latencia_max']:.1f}s)"
+               if est_fila["latencia_media"] is not None else "Nenhuma gravação ainda")
+        )
+        if est_fila["falhas"]:
+            st.sidebar.error(f"{est_fila['falhas']} registro(s) recusados pelo Airtable após {MAX_TENTATIVAS_ESCRITA} tentativas.")
+        if replica is not None:
+            ultima_sync_replica = min(replica.ultima_sync.values()) if replica.ultima_sync else None
+            st.sidebar.caption(
+                f"Réplica local: {len(replica.ultima_sync)} tabelas | "
+                + (f"sincronizada há {time.time() - ultima_sync_replica:.0f}s" if ultima_sync_replica else "sincronizando...")
+                + (f" | erros: {replica.erros}" if replica.erros else "")
+            )
+
+    # Checklist / Abastecimento
     if opcao == "Checklist":
-        st.subheader("✅ Checklist da viatura")
-        viaturas = carregar_viaturas()
-        viaturas_ativas = [v for v in viaturas if v.get("Status") == "Ativa"]
-
-        if not viaturas_ativas:
-            st.info("Cadastre viaturas ativas para continuar.")
-        else:
-            tipos_disponiveis = [t for t in TIPOS_SERVICO if any(v.get("TipoServico") == t for v in viaturas_ativas)]
-            tipo_escolhido = st.selectbox("Tipo de serviço", ["-- Selecione --"] + tipos_disponiveis)
-
-            placa, prefixo = None, None
-            if tipo_escolhido and tipo_escolhido != "-- Selecione --":
-                viaturas_filtradas = [v for v in viaturas_ativas if v.get("TipoServico") == tipo_escolhido]
-                opcoes = [f"{v.get('Prefixo','')} - {v.get('Placa','')}" for v in viaturas_filtradas]
-                escolha = st.selectbox("Viatura", ["-- Selecione --"] + opcoes)
-                if escolha and escolha != "-- Selecione --":
-                    viatura = next((v for v in viaturas_filtradas if f"{v.get('Prefixo','')} - {v.get('Placa','')}" == escolha), None)
-                    if viatura:
-                        placa = viatura.get("Placa")
-                        prefixo = viatura.get("Prefixo")
-
-            if placa and prefixo and tipo_escolhido and tipo_escolhido != "-- Selecione --":
-                ultimo_km_check = obter_ultimo_km_checklist(placa)
-                if ultimo_km_check > 0: st.info(f"Último km de checklist: {ultimo_km_check} km.")
-                ultima_troca_admin = obter_ultima_troca(placa)
-                if ultima_troca_admin > 0: st.info(f"Última troca de óleo: {ultima_troca_admin} km.")
-
-                km = st.number_input("Quilometragem atual (checklist)", min_value=0, step=1)
-                comb = st.radio("Nível de combustível", OPCOES_COMBUSTIVEL, horizontal=True)
-
-                st.markdown("#### Oxigênio")
-                ox1_str = st.text_input("Oxigênio Grande 1 (PSI)")
-                ox2_str = st.text_input("Oxigênio Grande 2 (PSI)")
-                oxp_str = st.text_input("Oxigênio Portátil (PSI)")
-                ox1 = int(ox1_str) if ox1_str.strip().isdigit() else 0
-                ox2 = int(ox2_str) if ox2_str.strip().isdigit() else 0
-                oxp = int(oxp_str) if oxp_str.strip().isdigit() else 0
-
-                if st.button("Salvar checklist"):
-                    if km <= 0:
-                        st.error("Informe uma quilometragem válida!"); tocar_alerta()
-                    elif ultimo_km_check and km < ultimo_km_check:
-                        st.error(f"A quilometragem informada ({km}) é menor que a última ({ultimo_km_check})."); tocar_alerta()
-                    else:
-                        dados = {
-                            "Data": datetime.now().isoformat(),
-                            "Condutor": st.session_state.usuario["nome"],
-                            "Matricula": st.session_state.usuario["matricula"],
-                            "Placa": placa,
-                            "Prefixo": prefixo,
-                            "Quilometragem": int(km),
-                            "Combustivel": comb,
-                            "Oxigenio Grande 1": ox1,
-                            "Oxigenio Grande 2": ox2,
-                            "Oxigenio Portatil": oxp,
-                            "TipoServico": tipo_escolhido
-                        }
-                        salvar_checklist(dados)
-                        st.success("Checklist registrado!")
-                        st.session_state.viatura_atual = {"placa": placa, "prefixo": prefixo}
-
-                        mostrar_alerta_troca(placa, int(km), tipo_escolhido)
-                        if ox1 < OXIGENIO_MIN_PSI:
-                            st.error(f"🚨 Oxigênio Grande 1 muito baixo ({ox1} PSI)."); tocar_alerta()
-                        if ox2 < OXIGENIO_MIN_PSI:
-                            st.error(f"🚨 Oxigênio Grande 2 muito baixo ({ox2} PSI)."); tocar_alerta()
-                        if oxp < OXIGENIO_MIN_PSI:
-                            st.error(f"🚨 Oxigênio Portátil muito baixo ({oxp} PSI)."); tocar_alerta()
-
-                if st.session_state.usuario.get("admin", False):
-                    st.markdown("---")
-                    st.subheader("Troca de óleo")
-                    if st.button("Registrar troca de óleo"):
-                        if km <= 0:
-                            st.error("Informe uma quilometragem válida para registrar a troca!")
-                        elif ultimo_km_check and km < ultimo_km_check:
-                            st.error(f"Não é possível registrar troca com km menor que o último checklist ({ultimo_km_check}).")
-                        else:
-                            salvar_troca_oleo(placa, prefixo, km)
-                            st.rerun()
-
-    # Abastecimento
+        formulario_checklist()
     elif opcao == "Abastecimento":
-        st.subheader("⛽ Registro de abastecimento")
-        if not has_abastecimentos:
-            st.info("Funcionalidade de abastecimento desativada: configure 'abastecimentos_table_id' nos secrets.")
-        else:
-            placa, prefixo = None, None
-            if st.session_state.viatura_atual:
-                placa = st.session_state.viatura_atual.get("placa")
-                prefixo = st.session_state.viatura_atual.get("prefixo")
-                st.info(f"Usando viatura da sessão: {prefixo} - {placa}")
-            else:
-                ultimo = obter_ultimo_checklist_do_motorista_hoje(st.session_state.usuario["matricula"])
-                if ultimo:
-                    placa = ultimo.get("Placa")
-                    prefixo = ultimo.get("Prefixo")
-                    st.session_state.viatura_atual = {"placa": placa, "prefixo": prefixo}
-                    st.info(f"Detectada última viatura do checklist de hoje: {prefixo} - {placa}")
-
-            if not placa or not prefixo:
-                st.warning("Nenhuma viatura detectada para hoje. Selecione abaixo:")
-                viaturas = carregar_viaturas()
-                viaturas_ativas = [v for v in viaturas if v.get("Status") == "Ativa"]
-                if not viaturas_ativas:
-                    st.info("Cadastre viaturas ativas para continuar.")
-                else:
-                    tipos_disponiveis = [t for t in TIPOS_SERVICO if any(v.get("TipoServico") == t for v in viaturas_ativas)]
-                    tipo_escolhido_abast = st.selectbox("Tipo de serviço", ["-- Selecione --"] + tipos_disponiveis)
-                    if tipo_escolhido_abast and tipo_escolhido_abast != "-- Selecione --":
-                        viaturas_filtradas = [v for v in viaturas_ativas if v.get("TipoServico") == tipo_escolhido_abast]
-                        opcoes = [f"{v.get('Prefixo','')} - {v.get('Placa','')}" for v in viaturas_filtradas]
-                        escolha = st.selectbox("Viatura", ["-- Selecione --"] + opcoes)
-                        if escolha and escolha != "-- Selecione --":
-                            v = next((x for x in viaturas_filtradas if f"{x.get('Prefixo','')} - {x.get('Placa','')}" == escolha), None)
-                            if v:
-                                placa = v.get("Placa"); prefixo = v.get("Prefixo")
-                                st.session_state.viatura_atual = {"placa": placa, "prefixo": prefixo}
-            else:
-                viaturas = carregar_viaturas()
-                v_match = next((v for v in viaturas if v.get("Placa") == placa), None)
-                tipo_escolhido_abast = v_match.get("TipoServico") if v_match else "SAMU"
-
-            if placa and prefixo:
-                st.success(f"Registrando abastecimento para: {prefixo} - {placa}")
-                ultimo_km_check = obter_ultimo_km_checklist(placa)
-                ultimo_km_abast = obter_ultimo_km_abastecimento(placa)
-                if ultimo_km_check > 0: st.info(f"Último km de checklist: {ultimo_km_check} km.")
-                if ultimo_km_abast > 0: st.info(f"Último km de abastecimento: {ultimo_km_abast} km.")
-
-                km_abast = st.number_input("Quilometragem no abastecimento", min_value=0, step=1)
-                litros   = st.number_input("Litros abastecidos", min_value=0.0, step=0.1, format="%.1f")
-                valor    = st.number_input("Valor total (R$)", min_value=0.0, step=0.01, format="%.2f")
-
-                if st.button("Salvar abastecimento"):
-                    if km_abast <= 0 or litros <= 0 or valor <= 0:
-                        st.error("Informe valores válidos para km, litros e valor."); tocar_alerta()
-                    elif ultimo_km_check and km_abast < ultimo_km_check:
-                        st.error(f"O km do abastecimento ({km_abast}) não pode ser menor que o último checklist ({ultimo_km_check})."); tocar_alerta()
-                    elif ultimo_km_abast and km_abast < ultimo_km_abast:
-                        st.error(f"O km do abastecimento ({km_abast}) não pode ser menor que o último abastecimento ({ultimo_km_abast})."); tocar_alerta()
-                    else:
-                        dados_abast = {
-                            "Data": datetime.now().isoformat(),
-                            "Placa": placa,
-                            "Prefixo": prefixo,
-                            "Condutor": st.session_state.usuario["nome"],
-                            "Matricula": st.session_state.usuario["matricula"],
-                            "Km": int(km_abast),
-                            "Litros": float(litros),
-                            "Valor": float(valor)
-                        }
-                        salvar_abastecimento(dados_abast)
-                        st.success("Abastecimento registrado com sucesso!")
+        formulario_abastecimento()
 
     # Dashboard Manutenção (Admin)
     if st.session_state.usuario.get("admin", False):
         st.markdown("---")
+        marcar_secao("dashboard")
         st.subheader("📊 Dashboard de manutenção")
         viaturas_dash = carregar_viaturas()
+        snapshot = carregar_snapshot_frota()
         dados_dashboard = []
         for v in viaturas_dash:
             placa_v = v.get("Placa"); prefixo_v = v.get("Prefixo"); tipo_v = v.get("TipoServico", "SAMU")
             if not placa_v: continue
-            ultimo_km_v = obter_ultimo_km_checklist(placa_v)
-            ultima_troca_v = obter_ultima_troca(placa_v)
-            intervalo_v = INTERVALOS_TROCA.get(tipo_v, 10000)
-            proxima_troca_v = (ultima_troca_v + intervalo_v) if ultima_troca_v > 0 else ((max(ultimo_km_v, 0) // intervalo_v) + 1) * intervalo_v
-            faltam_v = proxima_troca_v - ultimo_km_v
-            if ultimo_km_v < proxima_troca_v - TOLERANCIA_ALERTA: status_oleo = "✅ OK"
-            elif proxima_troca_v - TOLERANCIA_ALERTA <= ultimo_km_v <= proxima_troca_v + TOLERANCIA_ALERTA: status_oleo = "⚠️ Atenção"
-            else: status_oleo = "🚨 Urgente"
+            ultimo_km_v = snapshot["ultimo_km"].get(placa_v, 0)
+            ultima_troca_v = snapshot["ultima_troca"].get(placa_v, 0)
+            status_v = status_troca(ultimo_km_v, ultima_troca_v, tipo_v)
             dados_dashboard.append({
                 "Prefixo": prefixo_v, "Placa": placa_v, "Tipo": tipo_v,
                 "Último KM": ultimo_km_v,
                 "Última troca": ultima_troca_v if ultima_troca_v > 0 else "—",
-                "Próxima troca": proxima_troca_v,
-                "Faltam (km)": faltam_v,
-                "Status óleo": status_oleo
+                "Próxima troca": status_v["proxima"],
+                "Faltam (km)": status_v["faltam"],
+                "Status óleo": ROTULOS_NIVEL[status_v["nivel"]]
             })
         if dados_dashboard: st.dataframe(pd.DataFrame(dados_dashboard), use_container_width=True)
         else: st.info("Nenhuma viatura cadastrada ainda.")
 
+    # Consumo da frota (Admin)
+    if st.session_state.usuario.get("admin", False) and has_abastecimentos:
+        st.markdown("---")
+        marcar_secao("consumo")
+        st.subheader("⛽ Consumo da frota")
+        abastecimentos_frota = [f for regs in carregar_snapshot_frota()["abastecimentos_por_placa"].values() for f in regs]
+        abastecimentos_arquivados = arquivo_historico.tabela("abastecimentos") if arquivo_historico is not None else None
+        if abastecimentos_frota or abastecimentos_arquivados is not None:
+            df_consumo = relatorio_consumo(abastecimentos_frota, abastecimentos_arquivados)
+            st.dataframe(resumo_consumo_frota(df_consumo), use_container_width=True)
+            suspeitos = df_consumo[df_consumo["Suspeito"]]
+            if not suspeitos.empty:
+                st.warning(f"{len(suspeitos)} abastecimento(s) com consumo fora do padrão da viatura.")
+                st.dataframe(suspeitos.sort_values("Data", ascending=False), use_container_width=True)
+        else:
+            st.info("Nenhum abastecimento registrado ainda.")
+
+    # Relatório da frota (Admin)
+    if st.session_state.usuario.get("admin", False):
+        painel_relatorio()
+
     # Histórico de Viaturas (Admin)
     if st.session_state.usuario.get("admin", False):
-        st.markdown("---")
-        st.subheader("📜 Histórico de viaturas")
-        viaturas_hist = carregar_viaturas()
-        opcoes_hist = [f"{v.get('Prefixo','')} - {v.get('Placa','')}" for v in viaturas_hist]
-        escolha_hist = st.selectbox("Selecione a viatura", ["-- Selecione --"] + opcoes_hist)
-        if escolha_hist and escolha_hist != "-- Selecione --":
-            viatura_sel = next((v for v in viaturas_hist if f"{v.get('Prefixo','')} - {v.get('Placa','')}" == escolha_hist), None)
-            if viatura_sel:
-                placa_sel = viatura_sel.get("Placa")
-                st.markdown("### ✅ Checklists")
-                registros_check = [r.get("fields", {}) for r in checklists_table.all(sort=["-Data"]) if r.get("fields", {}).get("Placa") == placa_sel]
-                st.dataframe(pd.DataFrame(registros_check), use_container_width=True) if registros_check else st.info("Nenhum checklist registrado para esta viatura.")
-
-                st.markdown("### 🛢️ Trocas de óleo")
-                registros_troca = [r.get("fields", {}) for r in trocaoleo_table.all(sort=["-data"]) if r.get("fields", {}).get("Placa") == placa_sel]
-                st.dataframe(pd.DataFrame(registros_troca), use_container_width=True) if registros_troca else st.info("Nenhuma troca de óleo registrada para esta viatura.")
-
-                if has_abastecimentos:
-                    st.markdown("### ⛽ Abastecimentos")
-                    registros_abast = [r.get("fields", {}) for r in abastecimentos_table.all(sort=["-Data"]) if r.get("fields", {}).get("Placa") == placa_sel]
-                    if registros_abast:
-                        df_abast = pd.DataFrame(registros_abast)
-                        try:
-                            df_abast_sorted = df_abast.sort_values(by="Km")
-                            df_abast_sorted["Km anterior"] = df_abast_sorted["Km"].shift(1)
-                            df_abast_sorted["Km rodados"] = df_abast_sorted["Km"] - df_abast_sorted["Km anterior"]
-                            df_abast_sorted["Consumo (km/l)"] = df_abast_sorted["Km rodados"] / df_abast_sorted["Litros"]
-                            df_abast_sorted["R$/litro"] = df_abast_sorted["Valor"] / df_abast_sorted["Litros"]
-                            df_abast_sorted["R$/km"] = df_abast_sorted["Valor"] / df_abast_sorted["Km rodados"]
-                            st.dataframe(df_abast_sorted, use_container_width=True)
-                        except Exception:
-                            st.dataframe(df_abast, use_container_width=True)
-                    else:
-                        st.info("Nenhum abastecimento registrado para esta viatura.")
-                else:
-                    st.info("Histórico de abastecimentos desativado (configure 'abastecimentos_table_id' nos secrets).")
+        painel_historico()
+
+    # Importação e exportação (Admin)
+    if st.session_state.usuario.get("admin", False):
+        painel_importacao()
+
+    # Arquivo histórico (Admin)
+    if st.session_state.usuario.get("admin", False):
+        painel_arquivo()
+
+    if st.session_state.usuario.get("admin", False):
+        st.caption(f"🔌 Requisições ao Airtable nesta renderização: {total_requisicoes()}")
+
+    # Painel de desempenho (Admin, oculto: abrir com ?desempenho=1 na URL)
+    if st.session_state.usuario.get("admin", False) and st.query_params.get("desempenho") == "1":
+        metricas = obter_metricas_airtable()
+        with st.sidebar.expander("⏱️ Desempenho do Airtable", expanded=True):
+            st.caption(
+                f"Esta execução: {len(chamadas_airtable)} chamadas, {total_requisicoes()} requisições, "
+                f"{sum(c['ms'] for c in chamadas_airtable):.0f} ms"
+            )
+            if metricas.partida:
+                p50_exec, p95_exec = metricas.percentis_execucao()
+                st.caption(
+                    f"Partida do processo ({metricas.partida['quando']}): importações "
+                    f"{metricas.partida['importacoes_ms']:.0f} ms, primeira tela {metricas.partida['primeira_tela_ms']:.0f} ms · "
+                    f"execuções do script p50 {p50_exec:.0f} ms, p95 {p95_exec:.0f} ms"
+                )
+            if chamadas_airtable:
+                st.markdown("**Chamadas mais lentas**")
+                st.dataframe(
+                    pd.DataFrame(sorted(chamadas_airtable, key=lambda c: c["ms"], reverse=True)[:10]),
+                    use_container_width=True,
+                )
+                tempo_secoes = {}
+                for c in chamadas_airtable: tempo_secoes[c["secao"]] = tempo_secoes.get(c["secao"], 0.0) + c["ms"]
+                st.markdown("**Tempo de Airtable por seção (esta execução)**")
+                st.dataframe(
+                    pd.DataFrame([{"Seção": s, "ms": round(ms, 1)} for s, ms in tempo_secoes.items()]),
+                    use_container_width=True,
+                )
+            st.markdown("**Todas as sessões (p50/p95)**")
+            st.dataframe(pd.DataFrame(metricas.percentis_por_secao()), use_container_width=True)
+            st.dataframe(pd.DataFrame(metricas.percentis_por_chamada()), use_container_width=True)
+            st.download_button(
+                "Exportar JSONL", metricas.jsonl(), file_name="metricas_airtable.jsonl", mime="application/x-ndjson"
+            )
 
     st.markdown("---")
     if st.button("Sair"):
         st.session_state.usuario = None
         st.session_state.tela = "login"
         st.session_state.viatura_atual = None
-        st.rerun()
-
-
-
-
-
-
-
+        reexecutar()
 
+registrar_fim_execucao()
@@ -0,0 +1,271 @@
+import argparse
+import json
+import math
+import os
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+import streamlit as st
+from streamlit import logger as streamlit_logger
+from streamlit.testing.v1 import AppTest
+
+import mock_airtable
+
+# Mede latência e nº de requisições ao Airtable dos fluxos reais do app.py
+# (login/autenticar, checklist, abastecimento, dashboard e histórico), rodando o
+# script com AppTest contra o Airtable local (mock_airtable.py).
+#
+#   python benchmark.py --tamanhos 1000,10000,100000 --estrategias sem_cache,cache_quente,replica
+#   python benchmark.py --saida atual.json --comparar base.json   # falha se houver regressão
+#   python benchmark.py --partida 5 --tamanhos 1000               # partida a frio (importações + primeira tela)
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+USUARIO_EQUIPE = ("user1", "senha1")
+USUARIO_ADMIN = ("user0", "senha0")
+
+# Cada estratégia vira secrets do app; a réplica espera a primeira sincronização antes de medir
+ESTRATEGIAS = {
+    "sem_cache": {"cache_leitura": False},
+    "cache_frio": {},
+    "cache_quente": {},
+    "replica": {"cache_leitura": False, "replica": True},
+}
+
+def _widget(widgets, rotulo):
+    return next(w for w in widgets if w.label == rotulo)
+
+def secrets_bench(url, pasta, extras=None, limite=0):
+    secrets = mock_airtable.secrets_para(url)
+    airtable = secrets["connections"]["airtable"]
+    airtable["fila_escrita"] = os.path.join(pasta, "fila_escrita.db")
+    airtable["limite_requisicoes"] = limite
+    airtable["agregados_sqlite"] = ""  # a carga inicial em segundo plano poluiria a contagem
+    airtable["arquivo_historico"] = os.path.join(pasta, "arquivo_historico")
+    for chave, valor in (extras or {}).items():
+        if chave == "replica":
+            airtable["replica_sqlite"] = os.path.join(pasta, "replica.db")
+            airtable["replica_intervalo"] = 3600  # só a carga inicial, para não poluir a contagem
+        else:
+            airtable[chave] = valor
+    return secrets
+
+def nova_sessao(url, app=APP, secrets=None):
+    at = AppTest.from_file(app, default_timeout=600)
+    at.secrets.update(secrets or mock_airtable.secrets_para(url))
+    at.run()
+    return at
+
+def entrar(at, usuario, senha):
+    _widget(at.text_input, "Usuário").input(usuario)
+    _widget(at.text_input, "Senha").input(senha)
+    _widget(at.button, "Entrar").click().run()
+    if at.exception: raise RuntimeError(at.exception[0].message)
+    return at
+
+def selecionar_viatura(at, tipo="SAMU"):
+    _widget(at.selectbox, "Tipo de serviço").select(tipo).run()
+    viatura = _widget(at.selectbox, "Viatura")
+    viatura.select(viatura.options[1]).run()
+    return at
+
+# Cada fluxo: (usuário, preparar(at) antes da medição, executar(at) medido)
+def _preencher_login(usuario, senha):
+    def preparar(at):
+        _widget(at.text_input, "Usuário").input(usuario)
+        _widget(at.text_input, "Senha").input(senha)
+    return preparar
+
+def _abrir_historico(at):
+    historico = _widget(at.selectbox, "Selecione a viatura")
+    return historico.select(historico.options[1]).run()
+
+FLUXOS = {
+    "login (autenticar)": (None, _preencher_login(*USUARIO_EQUIPE), lambda at: _widget(at.button, "Entrar").click().run()),
+    "checklist (último km + troca)": (USUARIO_EQUIPE, None, selecionar_viatura),
+    "abastecimento (checklist de hoje)": (
+        USUARIO_EQUIPE, None,
+        lambda at: _widget(at.radio, "Escolha o que deseja fazer:").set_value("Abastecimento").run(),
+    ),
+    "dashboard admin (tela completa)": (USUARIO_ADMIN, None, lambda at: at.run()),
+    "histórico de viatura": (USUARIO_ADMIN, None, _abrir_historico),
+}
+
+def _esperar_replica(pasta, tabelas=3, limite=600):
+    caminho = os.path.join(pasta, "replica.db")
+    inicio = time.time()
+    while time.time() - inicio < limite:
+        if os.path.exists(caminho):
+            with sqlite3.connect(caminho) as conexao:
+                try:
+                    if conexao.execute("SELECT COUNT(*) FROM marcas").fetchone()[0] >= tabelas: return
+                except sqlite3.OperationalError:
+                    pass
+        time.sleep(0.2)
+    raise TimeoutError("réplica não sincronizou a tempo")
+
+def _sessao_pronta(url, secrets, usuario, preparar):
+    at = nova_sessao(url, secrets=secrets)
+    if usuario: entrar(at, *usuario)
+    if preparar: preparar(at)
+    return at
+
+def medir(airtable, url, fluxo, estrategia, repeticoes, pasta, limite=0):
+    usuario, preparar, executar = fluxo
+    secrets = secrets_bench(url, pasta, ESTRATEGIAS[estrategia], limite)
+    tempos, requisicoes = [], []
+    for _ in range(repeticoes):
+        if estrategia == "cache_quente":
+            executar(_sessao_pronta(url, secrets, usuario, preparar))
+        at = _sessao_pronta(url, secrets, usuario, preparar)
+        if estrategia == "cache_frio":
+            st.cache_resource.clear()
+        airtable.zerar_estatisticas()
+        inicio = time.perf_counter()
+        executar(at)
+        tempos.append(time.perf_counter() - inicio)
+        if at.exception: raise RuntimeError(at.exception[0].message)
+        requisicoes.append(airtable.estatisticas["requisicoes"])
+    tempos.sort()
+    return {
+        "mediana_ms": round(statistics.median(tempos) * 1000, 1),
+        "p95_ms": round(tempos[min(len(tempos) - 1, math.ceil(0.95 * len(tempos)) - 1)] * 1000, 1),
+        "requisicoes": statistics.median(requisicoes),
+    }
+
+# Partida a frio: cada repetição sobe um interpretador novo, abre a tela de login e lê o
+# registro de partida que o próprio app grava no JSONL de métricas
+CODIGO_PARTIDA = """
+import os, sys
+from streamlit import logger
+logger.set_log_level("error")
+from benchmark import nova_sessao, secrets_bench
+url, pasta = sys.argv[1:3]
+nova_sessao(url, secrets=secrets_bench(url, pasta, {"metricas_jsonl": os.path.join(pasta, "metricas.jsonl")}))
+"""
+
+def _resumo(valores):
+    valores = sorted(valores)
+    return round(statistics.median(valores), 1), round(valores[min(len(valores) - 1, math.ceil(0.95 * len(valores)) - 1)], 1)
+
+def medir_partida(airtable, url, repeticoes):
+    medidas = {"importações": [], "primeira tela": [], "processo": []}
+    requisicoes = []
+    for _ in range(repeticoes):
+        airtable.zerar_estatisticas()
+        with tempfile.TemporaryDirectory() as pasta:
+            inicio = time.perf_counter()
+            subprocess.run(
+                [sys.executable, "-c", CODIGO_PARTIDA, url, pasta],
+                cwd=os.path.dirname(APP), check=True, capture_output=True,
+            )
+            medidas["processo"].append((time.perf_counter() - inicio) * 1000)
+            with open(os.path.join(pasta, "metricas.jsonl"), encoding="utf-8") as f:
+                partida = next(r for r in map(json.loads, f) if r.get("tipo") == "partida")
+        medidas["importações"].append(partida["importacoes_ms"])
+        medidas["primeira tela"].append(partida["primeira_tela_ms"])
+        requisicoes.append(airtable.estatisticas["requisicoes"])
+        if partida["modulos_carregados"]:
+            print(f"aviso: a tela de login carregou {', '.join(partida['modulos_carregados'])}")
+    resultados = []
+    for fluxo, valores in medidas.items():
+        mediana, p95 = _resumo(valores)
+        resultados.append({"mediana_ms": mediana, "p95_ms": p95, "requisicoes": statistics.median(requisicoes), "fluxo": fluxo})
+    return resultados
+
+def rodar(tamanho, estrategias, fluxos, args):
+    airtable = mock_airtable.semear_frota(
+        mock_airtable.AirtableLocal(args.latencia_ms / 1000, args.limite or None), tamanho, args.viaturas
+    )
+    resultados = []
+    for estrategia in estrategias:
+        # Servidor e processo "limpos" por estratégia: threads de sync antigas ficam sem servidor
+        st.cache_resource.clear()
+        servidor, url = mock_airtable.iniciar(airtable)
+        with tempfile.TemporaryDirectory() as pasta:
+            try:
+                if estrategia == "partida":
+                    for r in medir_partida(airtable, url, args.partida):
+                        resultados.append({"registros": tamanho, "estrategia": estrategia, **r})
+                        print(
+                            f"{tamanho:>8} {estrategia:<13} {r['fluxo']:<36} {r['mediana_ms']:>10.0f} "
+                            f"{r['p95_ms']:>9.0f} {r['requisicoes']:>12.0f}", flush=True,
+                        )
+                    continue
+                if ESTRATEGIAS[estrategia].get("replica"):
+                    nova_sessao(url, secrets=secrets_bench(url, pasta, ESTRATEGIAS[estrategia], args.limite))
+                    _esperar_replica(pasta)
+                for nome in fluxos:
+                    r = medir(airtable, url, FLUXOS[nome], estrategia, args.repeticoes, pasta, args.limite)
+                    resultados.append({"registros": tamanho, "estrategia": estrategia, "fluxo": nome, **r})
+                    print(
+                        f"{tamanho:>8} {estrategia:<13} {nome:<36} {r['mediana_ms']:>10.0f} "
+                        f"{r['p95_ms']:>9.0f} {r['requisicoes']:>12.0f}", flush=True,
+                    )
+            finally:
+                servidor.shutdown()
+                servidor.server_close()
+    return resultados
+
+def comparar(resultados, arquivo_base, tolerancia):
+    with open(arquivo_base, encoding="utf-8") as f:
+        base = {(r["registros"], r["estrategia"], r["fluxo"]): r for r in json.load(f)}
+    regressoes = []
+    for r in resultados:
+        anterior = base.get((r["registros"], r["estrategia"], r["fluxo"]))
+        if not anterior: continue
+        if r["requisicoes"] > anterior["requisicoes"]:
+            regressoes.append(f"{r['fluxo']} @ {r['registros']} ({r['estrategia']}): requisições {anterior['requisicoes']:.0f} -> {r['requisicoes']:.0f}")
+        if r["mediana_ms"] > anterior["mediana_ms"] * (1 + tolerancia):
+            regressoes.append(f"{r['fluxo']} @ {r['registros']} ({r['estrategia']}): mediana {anterior['mediana_ms']:.0f} -> {r['mediana_ms']:.0f} ms")
+    return regressoes
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dos fluxos do app contra o Airtable local")
+    parser.add_argument("--tamanhos", default="1000,10000,100000", help="nº de registros sintéticos, separados por vírgula")
+    parser.add_argument("--viaturas", type=int, default=60)
+    parser.add_argument("--estrategias", default="sem_cache,cache_quente", help=f"opções: {', '.join(ESTRATEGIAS)}")
+    parser.add_argument("--fluxos", default=",".join(FLUXOS), help="subconjunto dos fluxos, separados por vírgula")
+    parser.add_argument("--latencia-ms", type=float, default=20, help="latência simulada por requisição")
+    parser.add_argument("--repeticoes", type=int, default=3)
+    parser.add_argument(
+        "--limite", type=int, default=0,
+        help="requisições/s por base no mock e no limitador do app (5 = Airtable real; 0 = sem limite)",
+    )
+    parser.add_argument(
+        "--partida", type=int, default=0,
+        help="mede a partida a frio (N interpretadores novos) em vez dos fluxos",
+    )
+    parser.add_argument("--saida", help="grava os resultados em JSON")
+    parser.add_argument("--comparar", help="JSON de uma execução anterior; sai com erro se houver regressão")
+    parser.add_argument("--tolerancia", type=float, default=0.25, help="aumento de latência aceito na comparação")
+    args = parser.parse_args()
+
+    # Avisos de depreciação (use_container_width) só poluem a tabela
+    warnings.filterwarnings("ignore", category=DeprecationWarning)
+    streamlit_logger.set_log_level("error")
+    estrategias = ["partida"] if args.partida else [e for e in args.estrategias.split(",") if e]
+    fluxos = [f for f in args.fluxos.split(",") if f]
+    print(
+        f"latência simulada {args.latencia_ms:.0f} ms | limite {args.limite or 'nenhum'} req/s | "
+        f"{args.viaturas} viaturas | {args.repeticoes} repetições"
+    )
+    print(f"{'registros':>8} {'estratégia':<13} {'fluxo':<36} {'mediana ms':>10} {'p95 ms':>9} {'requisições':>12}")
+    resultados = []
+    for tamanho in (int(t) for t in args.tamanhos.split(",")):
+        resultados += rodar(tamanho, estrategias, fluxos, args)
+
+    if args.saida:
+        with open(args.saida, "w", encoding="utf-8") as f:
+            json.dump(resultados, f, ensure_ascii=False, indent=2)
+    if args.comparar:
+        regressoes = comparar(resultados, args.comparar, args.tolerancia)
+        for r in regressoes: print(f"REGRESSÃO: {r}")
+        if regressoes: raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,396 @@
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+import websockets
+from streamlit.proto.Alert_pb2 import Alert
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+import mock_airtable
+from benchmark import APP, USUARIO_ADMIN, secrets_bench
+
+# Teste de carga: sobe um app.py de verdade (streamlit run) contra o Airtable local e
+# abre N sessões simultâneas pelo mesmo websocket do navegador. Cada equipe virtual faz
+# login (autenticar), escolhe a viatura, salva um checklist e um abastecimento; admins
+# ficam atualizando o dashboard. A cada nível de concorrência mede vazão, percentis de
+# latência por fluxo e por interação, requisições ao Airtable e CPU do servidor.
+#
+#   pip install -r requirements-dev.txt   # websockets, usado pelo cliente
+#   python carga.py --equipes 1,5,10,20 --admins 1 --ciclos 3
+#   python carga.py --equipes 10 --limite 0 --latencia-ms 0   # só o servidor como gargalo
+#
+# AppTest não serve aqui: cada execução troca st.secrets e o Runtime do processo, então
+# sessões simultâneas no mesmo processo se atropelam. O cliente fala o protocolo do
+# streamlit instalado (selectbox/radio por rótulo, number_input em double).
+
+FLUXOS_CARGA = [
+    "abrir app",
+    "login (autenticar)",
+    "seleção de viatura",
+    "checklist (preencher + salvar)",
+    "abastecimento (preencher + salvar)",
+    "dashboard admin",
+]
+ESPERA_SERVIDOR = 60   # segundos para o streamlit responder no /_stcore/health
+ESPERA_FILA = 300      # segundos para a fila de gravação esvaziar no fim do nível
+PRIMEIRO_KM = 10_000_000  # acima de qualquer km da frota sintética
+PAUSA_ADMIN = 0.5      # segundos entre duas atualizações do dashboard, mesmo com --pausa-ms 0
+
+FIM_DA_EXECUCAO = {"FINISHED_SUCCESSFULLY", "FINISHED_FRAGMENT_RUN_SUCCESSFULLY", "FINISHED_WITH_COMPILE_ERROR"}
+
+class ErroSessao(Exception):
+    pass
+
+class Sessao:
+    # Uma aba do navegador: guarda o estado dos widgets e os elementos da última execução
+    def __init__(self, url):
+        self.url = url
+        self.estado = {}       # id do widget -> (campo do WidgetState, valor)
+        self.elementos = []    # (fragment_id, tipo, proto do elemento)
+        self.interacoes = []   # segundos de cada ida e volta ao servidor
+        self._ws = None
+
+    async def abrir(self):
+        self._ws = await websockets.connect(
+            self.url.replace("http", "ws", 1) + "/_stcore/stream",
+            subprotocols=["streamlit"], max_size=None, open_timeout=ESPERA_SERVIDOR,
+        )
+        await self._executar()
+
+    async def fechar(self):
+        if self._ws is not None: await self._ws.close()
+
+    async def _executar(self, fragment_id=""):
+        msg = BackMsg()
+        msg.rerun_script.query_string = ""
+        msg.rerun_script.fragment_id = fragment_id
+        for widget_id, (campo, valor) in self.estado.items():
+            w = msg.rerun_script.widget_states.widgets.add()
+            w.id = widget_id
+            setattr(w, campo, valor)
+        # Botões valem só para a execução em que foram clicados, como no navegador
+        self.estado = {k: v for k, v in self.estado.items() if v[0] != "trigger_value"}
+        if fragment_id:
+            self.elementos = [e for e in self.elementos if e[0] != fragment_id]
+        else:
+            self.elementos = []
+        inicio = time.perf_counter()
+        await self._ws.send(msg.SerializeToString())
+        while True:
+            recebida = ForwardMsg()
+            recebida.ParseFromString(await self._ws.recv())
+            tipo = recebida.WhichOneof("type")
+            if tipo == "new_session" and not recebida.new_session.fragment_ids_this_run:
+                self.elementos = []  # st.rerun() do app: execução completa nova
+            elif tipo == "delta" and recebida.delta.WhichOneof("type") == "new_element":
+                elemento = recebida.delta.new_element
+                nome = elemento.WhichOneof("type")
+                self.elementos.append((recebida.delta.fragment_id, nome, getattr(elemento, nome)))
+            elif tipo == "script_finished":
+                status = ForwardMsg.ScriptFinishedStatus.Name(recebida.script_finished)
+                if status in FIM_DA_EXECUCAO: break
+        self.interacoes.append(time.perf_counter() - inicio)
+        excecoes = [e[2].message for e in self.elementos if e[1] == "exception"]
+        if excecoes: raise ErroSessao(excecoes[0])
+
+    def _widget(self, tipo, rotulo):
+        encontrados = [e for e in self.elementos if e[1] == tipo and e[2].label == rotulo]
+        if not encontrados: raise ErroSessao(f"{tipo} '{rotulo}' não está na tela")
+        return encontrados[-1]
+
+    def opcoes(self, rotulo):
+        return list(self._widget("selectbox", rotulo)[2].options)
+
+    async def _mudar(self, tipo, rotulo, campo, valor):
+        fragment_id, _, proto = self._widget(tipo, rotulo)
+        self.estado[proto.id] = (campo, valor)
+        await self._executar(fragment_id)
+
+    async def digitar(self, rotulo, texto):
+        await self._mudar("text_input", rotulo, "string_value", texto)
+
+    async def numero(self, rotulo, valor):
+        await self._mudar("number_input", rotulo, "double_value", float(valor))
+
+    async def escolher(self, rotulo, opcao, tipo="selectbox"):
+        await self._mudar(tipo, rotulo, "string_value", opcao)
+
+    async def atualizar(self):
+        await self._executar()
+
+    async def clicar(self, rotulo):
+        await self._mudar("button", rotulo, "trigger_value", True)
+
+    def avisos(self, formato):
+        codigo = Alert.Format.Value(formato)
+        return [e[2].body for e in self.elementos if e[1] == "alert" and e[2].format == codigo]
+
+async def _medir(medidas, fluxo, passo):
+    inicio = time.perf_counter()
+    await passo
+    medidas[fluxo].append(time.perf_counter() - inicio)
+
+async def _entrar(sessao, usuario, senha):
+    await sessao.digitar("Usuário", usuario)
+    await sessao.digitar("Senha", senha)
+    await sessao.clicar("Entrar")
+    if not any(a.startswith("Bem-vindo") for a in sessao.avisos("SUCCESS")):
+        raise ErroSessao(f"login de {usuario} falhou: {sessao.avisos('ERROR')}")
+
+async def _selecionar(sessao, indice):
+    tipo = mock_airtable.TIPOS[indice % len(mock_airtable.TIPOS)]
+    await sessao.escolher("Tipo de serviço", tipo)
+    opcoes = sessao.opcoes("Viatura")[1:]  # a primeira é "-- Selecione --"
+    # Equipes diferentes em viaturas diferentes enquanto houver viatura do tipo
+    await sessao.escolher("Viatura", opcoes[(indice // len(mock_airtable.TIPOS)) % len(opcoes)])
+
+async def _checklist(sessao, km):
+    await sessao.numero("Quilometragem atual (checklist)", km)
+    for rotulo in ["Oxigênio Grande 1 (PSI)", "Oxigênio Grande 2 (PSI)", "Oxigênio Portátil (PSI)"]:
+        await sessao.digitar(rotulo, "1800")
+    await sessao.clicar("Salvar checklist")
+    if "Checklist registrado!" not in sessao.avisos("SUCCESS"):
+        raise ErroSessao(f"checklist não registrado: {sessao.avisos('ERROR') or sessao.avisos('INFO')[-1:]}")
+
+async def _abastecimento(sessao, km):
+    await sessao.escolher("Escolha o que deseja fazer:", "Abastecimento", tipo="radio")
+    await sessao.numero("Quilometragem no abastecimento", km)
+    await sessao.numero("Litros abastecidos", 42.0)
+    await sessao.numero("Valor total (R$)", 252.0)
+    await sessao.clicar("Salvar abastecimento")
+    if "Abastecimento registrado com sucesso!" not in sessao.avisos("SUCCESS"):
+        raise ErroSessao(f"abastecimento não registrado: {sessao.avisos('ERROR') or sessao.avisos('INFO')[-1:]}")
+
+async def equipe(url, indice, ciclos, pausa, km, medidas, interacoes, erros):
+    # user0 é o admin da frota sintética; as equipes usam user1..user79
+    usuario = 1 + indice % 79
+    concluidos = 0
+    for _ in range(ciclos):
+        sessao = Sessao(url)
+        try:
+            await _medir(medidas, "abrir app", sessao.abrir())
+            await asyncio.sleep(pausa)
+            await _medir(medidas, "login (autenticar)", _entrar(sessao, f"user{usuario}", f"senha{usuario}"))
+            await asyncio.sleep(pausa)
+            await _medir(medidas, "seleção de viatura", _selecionar(sessao, indice))
+            await asyncio.sleep(pausa)
+            km_ciclo = next(km)
+            await _medir(medidas, "checklist (preencher + salvar)", _checklist(sessao, km_ciclo))
+            await asyncio.sleep(pausa)
+            await _medir(medidas, "abastecimento (preencher + salvar)", _abastecimento(sessao, km_ciclo))
+            concluidos += 1
+        except (ErroSessao, websockets.WebSocketException, OSError) as e:
+            erros.append(f"equipe {indice}: {e}")
+        finally:
+            interacoes.extend(sessao.interacoes)
+            await sessao.fechar()
+    return concluidos
+
+async def admin(url, pausa, parar, medidas, interacoes, erros):
+    sessao = Sessao(url)
+    do_login = 0
+    try:
+        await sessao.abrir()
+        await _entrar(sessao, *USUARIO_ADMIN)
+        do_login = len(sessao.interacoes)
+        while not parar.is_set():
+            await _medir(medidas, "dashboard admin", sessao.atualizar())
+            await asyncio.sleep(max(pausa, PAUSA_ADMIN))
+    except (ErroSessao, websockets.WebSocketException, OSError) as e:
+        erros.append(f"admin: {e}")
+    finally:
+        interacoes.extend(sessao.interacoes[do_login:])
+        await sessao.fechar()
+
+# ---------------- Servidor ----------------
+def _porta_livre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _escrever_secrets(secrets, pasta):
+    os.makedirs(os.path.join(pasta, ".streamlit"), exist_ok=True)
+    with open(os.path.join(pasta, ".streamlit", "secrets.toml"), "w", encoding="utf-8") as f:
+        f.write("[connections.airtable]\n")
+        for chave, valor in secrets["connections"]["airtable"].items():
+            f.write(f"{chave} = {json.dumps(valor, ensure_ascii=False)}\n")
+
+def iniciar_servidor(url_airtable, pasta, limite):
+    _escrever_secrets(secrets_bench(url_airtable, pasta, limite=limite), pasta)
+    porta = _porta_livre()
+    processo = subprocess.Popen(
+        [
+            sys.executable, "-m", "streamlit", "run", APP, "--server.headless=true", f"--server.port={porta}",
+            "--server.address=127.0.0.1", "--server.fileWatcherType=none", "--browser.gatherUsageStats=false",
+        ],
+        cwd=pasta, stdout=subprocess.DEVNULL, stderr=open(os.path.join(pasta, "servidor.log"), "w"),
+    )
+    url = f"http://127.0.0.1:{porta}"
+    inicio = time.time()
+    while time.time() - inicio < ESPERA_SERVIDOR:
+        try:
+            if requests.get(url + "/_stcore/health", timeout=1).ok: return processo, url
+        except requests.exceptions.ConnectionError:
+            pass
+        if processo.poll() is not None: break
+        time.sleep(0.2)
+    processo.kill()
+    raise RuntimeError(f"streamlit não subiu; veja {os.path.join(pasta, 'servidor.log')}")
+
+def cpu_do_processo(pid):
+    # Segundos de CPU (usuário + sistema) do servidor; só em Linux
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            campos = f.read().rsplit(")", 1)[1].split()
+        return (int(campos[11]) + int(campos[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+def _esperar_fila(pasta):
+    caminho = os.path.join(pasta, "fila_escrita.db")
+    inicio = time.time()
+    while time.time() - inicio < ESPERA_FILA:
+        with sqlite3.connect(caminho) as conexao:
+            if conexao.execute("SELECT COUNT(*) FROM fila").fetchone()[0] == 0: return time.time() - inicio
+        time.sleep(0.2)
+    return None
+
+# ---------------- Níveis de concorrência ----------------
+def _percentil(valores, p):
+    return valores[min(len(valores) - 1, math.ceil(p * len(valores)) - 1)]
+
+def _resumo(valores):
+    valores = sorted(valores)
+    if not valores: return {"n": 0, "mediana_ms": None, "p95_ms": None, "p99_ms": None}
+    return {
+        "n": len(valores),
+        "mediana_ms": round(statistics.median(valores) * 1000, 1),
+        "p95_ms": round(_percentil(valores, 0.95) * 1000, 1),
+        "p99_ms": round(_percentil(valores, 0.99) * 1000, 1),
+    }
+
+async def _rodar_sessoes(url, n_equipes, n_admins, args, km):
+    medidas = {fluxo: [] for fluxo in FLUXOS_CARGA}
+    interacoes, erros = [], []
+    parar = asyncio.Event()
+    pausa = args.pausa_ms / 1000
+    admins = [asyncio.create_task(admin(url, pausa, parar, medidas, interacoes, erros)) for _ in range(n_admins)]
+    concluidos = await asyncio.gather(*(
+        equipe(url, i, args.ciclos, pausa, km, medidas, interacoes, erros) for i in range(n_equipes)
+    ))
+    parar.set()
+    await asyncio.gather(*admins)
+    return medidas, interacoes, erros, sum(concluidos)
+
+async def _aquecer(url):
+    # Compila o script e enche caches de usuários e viaturas, como um servidor que já
+    # está no ar há algum tempo
+    sessao = Sessao(url)
+    await sessao.abrir()
+    await _entrar(sessao, *USUARIO_ADMIN)
+    await sessao.fechar()
+
+def rodar_nivel(airtable, url_airtable, n_equipes, args, km):
+    with tempfile.TemporaryDirectory() as pasta:
+        processo, url = iniciar_servidor(url_airtable, pasta, args.limite)
+        try:
+            asyncio.run(_aquecer(url))
+            _esperar_fila(pasta)
+            airtable.zerar_estatisticas()
+            cpu_antes = cpu_do_processo(processo.pid)
+            inicio = time.perf_counter()
+            medidas, interacoes, erros, ciclos = asyncio.run(_rodar_sessoes(url, n_equipes, args.admins, args, km))
+            duracao = time.perf_counter() - inicio
+            cpu_depois = cpu_do_processo(processo.pid)
+            drenagem = _esperar_fila(pasta)
+            estatisticas = json.loads(json.dumps(airtable.estatisticas))
+        finally:
+            processo.terminate()
+            processo.wait(timeout=30)
+    return {
+        "equipes": n_equipes,
+        "admins": args.admins,
+        "duracao_s": round(duracao, 2),
+        "ciclos": ciclos,
+        "ciclos_por_s": round(ciclos / duracao, 2),
+        "interacoes_por_s": round(len(interacoes) / duracao, 2),
+        "cpu_servidor": round((cpu_depois - cpu_antes) / duracao, 2) if cpu_antes is not None and cpu_depois is not None else None,
+        "fila_drenada_s": round(drenagem, 1) if drenagem is not None else None,
+        "requisicoes": estatisticas["requisicoes"],
+        "requisicoes_por_ciclo": round(estatisticas["requisicoes"] / ciclos, 1) if ciclos else None,
+        "recusadas_429": estatisticas["recusadas_429"],
+        "por_tabela": estatisticas["por_tabela"],
+        "erros": erros,
+        "interacao": _resumo(interacoes),
+        "fluxos": {fluxo: _resumo(valores) for fluxo, valores in medidas.items()},
+    }
+
+def _ms(valor):
+    return f"{valor:>9.0f}" if valor is not None else f"{'-':>9}"
+
+def imprimir(r):
+    cpu = f"{r['cpu_servidor']:.0%}" if r["cpu_servidor"] is not None else "-"
+    print(
+        f"\n{r['equipes']} equipe(s) + {r['admins']} admin(s): {r['ciclos']} ciclos em {r['duracao_s']:.1f}s | "
+        f"{r['ciclos_por_s']:.2f} ciclos/s | {r['interacoes_por_s']:.1f} interações/s | CPU do servidor {cpu} | "
+        f"Airtable: {r['requisicoes']} req ({r['requisicoes_por_ciclo'] or '-'}/ciclo), {r['recusadas_429']} × 429 | "
+        f"fila drenada em {r['fila_drenada_s'] if r['fila_drenada_s'] is not None else '?'}s | {len(r['erros'])} erro(s)"
+    )
+    print(f"  {'fluxo':<36} {'n':>5} {'mediana ms':>10} {'p95 ms':>9} {'p99 ms':>9}")
+    for fluxo, s in list(r["fluxos"].items()) + [("(cada interação)", r["interacao"])]:
+        if not s["n"]: continue
+        print(f"  {fluxo:<36} {s['n']:>5} {_ms(s['mediana_ms']):>10} {_ms(s['p95_ms'])} {_ms(s['p99_ms'])}")
+    for erro in r["erros"][:5]: print(f"  erro: {erro}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Teste de carga do app com sessões simultâneas contra o Airtable local")
+    parser.add_argument("--equipes", default="1,5,10", help="equipes simultâneas por nível, separadas por vírgula")
+    parser.add_argument("--admins", type=int, default=1, help="sessões de admin atualizando o dashboard em cada nível")
+    parser.add_argument("--ciclos", type=int, default=2, help="turnos (login → checklist → abastecimento) por equipe")
+    parser.add_argument("--pausa-ms", type=float, default=0, help="tempo de \"pensar\" entre um passo e outro")
+    parser.add_argument("--registros", type=int, default=10000, help="nº de registros sintéticos")
+    parser.add_argument("--viaturas", type=int, default=60)
+    parser.add_argument("--latencia-ms", type=float, default=20, help="latência simulada por requisição")
+    parser.add_argument(
+        "--limite", type=int, default=5,
+        help="requisições/s por base no mock e no limitador do app (5 = Airtable real; 0 = sem limite)",
+    )
+    parser.add_argument("--saida", help="grava os resultados em JSON")
+    args = parser.parse_args()
+
+    airtable = mock_airtable.semear_frota(
+        mock_airtable.AirtableLocal(args.latencia_ms / 1000, args.limite or None), args.registros, args.viaturas
+    )
+    servidor, url_airtable = mock_airtable.iniciar(airtable)
+    # Km sempre crescente entre níveis e equipes, para passar na validação do formulário
+    km = itertools.count(PRIMEIRO_KM, 1000)
+    print(
+        f"latência simulada {args.latencia_ms:.0f} ms | limite {args.limite or 'nenhum'} req/s | "
+        f"{args.registros} registros | {args.viaturas} viaturas | {args.ciclos} ciclos por equipe"
+    )
+    resultados = []
+    try:
+        for n_equipes in (int(n) for n in args.equipes.split(",")):
+            resultados.append(rodar_nivel(airtable, url_airtable, n_equipes, args, km))
+            imprimir(resultados[-1])
+    finally:
+        servidor.shutdown()
+        servidor.server_close()
+    if args.saida:
+        with open(args.saida, "w", encoding="utf-8") as f:
+            json.dump(resultados, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2 @@
+# test_airtable.py é um script do Streamlit (streamlit run) para checar a conexão, não um teste
+collect_ignore = ["test_airtable.py"]
@@ -0,0 +1,238 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import deque
+
+import requests
+
+# Fila de gravação do app.py: checklists, abastecimentos e trocas de óleo são confirmados
+# assim que entram nesta fila local (SQLite); FilaEscrita.executar, numa thread, envia ao
+# Airtable em lotes com batch_create. Fica fora do app.py para ser testada sem o Streamlit.
+
+TAMANHO_LOTE_ESCRITA = 10
+MAX_TENTATIVAS_ESCRITA = 5
+ESPERA_MAX_ESCRITA = 30  # segundos; o Airtable bloqueia por 30s quem passa do limite
+# Chaves de idempotência: cada chave identifica um envio; o mesmo envio repetido (toque duplo,
+# rede lenta) carrega a mesma chave e é descartado aqui, esteja o original na fila ou no Airtable.
+RETENCAO_CHAVES = 7 * 24 * 3600  # segundos que a chave de um registro já gravado é lembrada
+INTERVALO_LIMPEZA_CHAVES = 3600
+
+SQL_FILA = """
+CREATE TABLE IF NOT EXISTS fila (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    tabela TEXT NOT NULL,
+    campos TEXT NOT NULL,
+    typecast INTEGER NOT NULL,
+    enfileirado REAL NOT NULL,
+    tentativas INTEGER NOT NULL DEFAULT 0,
+    ultimo_erro TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_fila_tabela ON fila (tabela, seq);
+CREATE TABLE IF NOT EXISTS falhas (
+    seq INTEGER PRIMARY KEY,
+    tabela TEXT NOT NULL,
+    campos TEXT NOT NULL,
+    enfileirado REAL NOT NULL,
+    erro TEXT,
+    falhou REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chaves (
+    chave TEXT PRIMARY KEY,
+    tabela TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    registro TEXT,
+    criada REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_chaves_seq ON chaves (seq);
+"""
+
+class FilaEscrita:
+    def __init__(self, caminho, tabelas, ao_gravar):
+        self.tabelas = tabelas
+        self.ao_gravar = ao_gravar
+        self.latencias = deque(maxlen=200)  # segundos entre enfileirar e confirmar no Airtable
+        self.ultima_gravacao = None
+        self.gravados = 0
+        self.erros = 0
+        self.ultimo_erro = None
+        self.duplicados = 0
+        self._ultima_limpeza = 0.0
+        self._conexao = sqlite3.connect(caminho, check_same_thread=False)
+        self._conexao.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        self._acordar = threading.Event()
+        self._versao = 0           # muda a cada linha que entra ou sai da fila
+        self._pendentes = {}       # (tabela, filtros) -> registros decodificados, nesta versão
+        self._versao_pendentes = 0
+        with self._lock, self._conexao:
+            self._conexao.execute("PRAGMA journal_mode=WAL")
+            self._conexao.execute("PRAGMA synchronous=FULL")
+            self._conexao.executescript(SQL_FILA)
+
+    def enfileirar(self, nome, campos, typecast=False, chave=None):
+        # Devolve False quando a chave já foi vista: o envio repetido não vira outra linha.
+        # A checagem e o INSERT ficam sob o mesmo lock, então envios simultâneos da mesma
+        # chave (duas sessões, ou um rerun interrompendo o anterior) resultam em uma gravação só.
+        agora = time.time()
+        with self._lock, self._conexao:
+            if chave is not None and self._conexao.execute("SELECT 1 FROM chaves WHERE chave = ?", (chave,)).fetchone():
+                self.duplicados += 1
+                return False
+            seq = self._conexao.execute(
+                "INSERT INTO fila (tabela, campos, typecast, enfileirado) VALUES (?, ?, ?, ?)",
+                (nome, json.dumps(campos, ensure_ascii=False), int(typecast), agora),
+            ).lastrowid
+            if chave is not None:
+                self._conexao.execute("INSERT INTO chaves (chave, tabela, seq, criada) VALUES (?, ?, ?, ?)", (chave, nome, seq, agora))
+            self._versao += 1
+        self._acordar.set()
+        return True
+
+    def enfileirar_varios(self, nome, lista_campos, typecast=False, chaves=None):
+        # Devolve os registros que entraram na fila; com `chaves` (uma por registro), os de
+        # chave já vista ficam de fora, como em enfileirar
+        agora = time.time()
+        aceitos = []
+        with self._lock, self._conexao:
+            for campos, chave in zip(lista_campos, chaves or [None] * len(lista_campos)):
+                if chave is not None and self._conexao.execute("SELECT 1 FROM chaves WHERE chave = ?", (chave,)).fetchone():
+                    self.duplicados += 1
+                    continue
+                seq = self._conexao.execute(
+                    "INSERT INTO fila (tabela, campos, typecast, enfileirado) VALUES (?, ?, ?, ?)",
+                    (nome, json.dumps(campos, ensure_ascii=False), int(typecast), agora),
+                ).lastrowid
+                if chave is not None:
+                    self._conexao.execute("INSERT INTO chaves (chave, tabela, seq, criada) VALUES (?, ?, ?, ?)", (chave, nome, seq, agora))
+                aceitos.append(campos)
+            self._versao += 1
+        self._acordar.set()
+        return aceitos
+
+    def pendentes(self, nome, filtros=None):
+        # Filtros (campo = valor) aplicados no SQLite e resultado guardado até a fila mudar:
+        # com milhares de linhas de uma importação na fila, as telas não decodificam tudo a cada vez
+        filtros = tuple(sorted((filtros or {}).items()))
+        with self._lock:
+            if self._versao_pendentes != self._versao:
+                self._pendentes, self._versao_pendentes = {}, self._versao
+            if (nome, filtros) not in self._pendentes:
+                sql, parametros = "SELECT campos FROM fila WHERE tabela = ?", [nome]
+                for campo, valor in filtros:
+                    sql += " AND json_extract(campos, ?) = ?"
+                    parametros += [f'$."{campo}"', valor]
+                linhas = self._conexao.execute(sql + " ORDER BY seq DESC", parametros).fetchall()
+                self._pendentes[(nome, filtros)] = [json.loads(l["campos"]) for l in linhas]
+            return list(self._pendentes[(nome, filtros)])
+
+    def estatisticas(self):
+        with self._lock:
+            profundidade = self._conexao.execute("SELECT COUNT(*) FROM fila").fetchone()[0]
+            falhas = self._conexao.execute("SELECT COUNT(*) FROM falhas").fetchone()[0]
+        latencias = sorted(self.latencias)
+        return {
+            "profundidade": profundidade,
+            "falhas": falhas,
+            "gravados": self.gravados,
+            "duplicados": self.duplicados,
+            "latencia_media": (sum(latencias) / len(latencias)) if latencias else None,
+            "latencia_max": latencias[-1] if latencias else None,
+            "ultima_gravacao": self.ultima_gravacao,
+        }
+
+    def _proximo_lote(self):
+        with self._lock:
+            primeira = self._conexao.execute("SELECT tabela, typecast FROM fila ORDER BY seq LIMIT 1").fetchone()
+            if primeira is None: return []
+            return self._conexao.execute(
+                "SELECT * FROM fila WHERE tabela = ? AND typecast = ? ORDER BY seq LIMIT ?",
+                (primeira["tabela"], primeira["typecast"], TAMANHO_LOTE_ESCRITA),
+            ).fetchall()
+
+    def _enviar(self, lote):
+        nome = lote[0]["tabela"]
+        criados = self.tabelas[nome].batch_create(
+            [json.loads(l["campos"]) for l in lote], typecast=bool(lote[0]["typecast"])
+        )
+        agora = time.time()
+        with self._lock, self._conexao:
+            self._conexao.executemany("DELETE FROM fila WHERE seq = ?", [(l["seq"],) for l in lote])
+            self._versao += 1
+            self._conexao.executemany(
+                "UPDATE chaves SET registro = ? WHERE seq = ?", [(r["id"], l["seq"]) for l, r in zip(lote, criados)]
+            )
+        self.latencias.extend(agora - l["enfileirado"] for l in lote)
+        self.gravados += len(lote)
+        self.ultima_gravacao = agora
+        try:
+            self.ao_gravar(nome, criados)
+        except Exception as e:
+            # Os registros já estão no Airtable e fora da fila; só os caches ficam para trás
+            self.erros += 1; self.ultimo_erro = f"ao_gravar: {e}"
+
+    def _registrar_erro(self, linha, erro):
+        with self._lock, self._conexao:
+            if linha["tentativas"] + 1 >= MAX_TENTATIVAS_ESCRITA:
+                self._conexao.execute(
+                    "INSERT OR REPLACE INTO falhas VALUES (?, ?, ?, ?, ?, ?)",
+                    (linha["seq"], linha["tabela"], linha["campos"], linha["enfileirado"], erro, time.time()),
+                )
+                self._conexao.execute("DELETE FROM fila WHERE seq = ?", (linha["seq"],))
+                self._versao += 1
+                # Recusado de vez: a equipe pode corrigir e enviar de novo
+                self._conexao.execute("DELETE FROM chaves WHERE seq = ?", (linha["seq"],))
+            else:
+                self._conexao.execute(
+                    "UPDATE fila SET tentativas = tentativas + 1, ultimo_erro = ? WHERE seq = ?", (erro, linha["seq"])
+                )
+
+    def _limpar_chaves(self):
+        limite = time.time() - RETENCAO_CHAVES
+        with self._lock, self._conexao:
+            self._conexao.execute("DELETE FROM chaves WHERE criada < ? AND seq NOT IN (SELECT seq FROM fila)", (limite,))
+        self._ultima_limpeza = time.monotonic()
+
+    @staticmethod
+    def _erro_de_dados(erro):
+        # 4xx (menos 429) é problema do registro; limite, 5xx e rede passam com o tempo
+        if not isinstance(erro, requests.exceptions.HTTPError) or erro.response is None: return False
+        return 400 <= erro.response.status_code < 500 and erro.response.status_code != 429
+
+    def _processar(self, lote, espera):
+        try:
+            self._enviar(lote)
+            return 1
+        except Exception as e:
+            self.erros += 1; self.ultimo_erro = str(e)
+            if not self._erro_de_dados(e): return self._esperar(espera)
+        # Erro de dados (422 etc.): reenvia um a um para isolar o registro inválido. Só esse
+        # erro gasta tentativa; limite, 5xx ou rede no meio do caminho voltam para o backoff.
+        for linha in lote:
+            try:
+                self._enviar([linha])
+            except Exception as e_linha:
+                self.erros += 1; self.ultimo_erro = str(e_linha)
+                if not self._erro_de_dados(e_linha): return self._esperar(espera)
+                self._registrar_erro(linha, str(e_linha))
+        return espera
+
+    @staticmethod
+    def _esperar(espera):
+        time.sleep(espera)
+        return min(espera * 2, ESPERA_MAX_ESCRITA)
+
+    def executar(self):
+        espera = 1
+        while True:
+            lote = self._proximo_lote()
+            if not lote:
+                if time.monotonic() - self._ultima_limpeza >= INTERVALO_LIMPEZA_CHAVES: self._limpar_chaves()
+                self._acordar.wait(5); self._acordar.clear()
+                continue
+            try:
+                espera = self._processar(lote, espera)
+            except Exception as e:
+                # Nada derruba a thread: a equipe já viu "registrado" e a fila só anda com ela viva
+                self.erros += 1; self.ultimo_erro = str(e)
+                espera = self._esperar(espera)
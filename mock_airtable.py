@@ -0,0 +1,451 @@
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Servidor local que imita a API REST do Airtable (listagem, criação, paginação,
+# ordenação e filterByFormula) para medir o app sem tocar na base real.
+#
+#   python mock_airtable.py --registros 50000 --porta 8787
+#
+# e aponte os secrets do app para ele com endpoint_url = "http://127.0.0.1:8787".
+
+BASE_ID = "appMockSamu"
+TABELAS = {
+    "usuarios": "tblUsuarios",
+    "checklists": "tblChecklists",
+    "trocaoleo": "tblTrocaOleo",
+    "viaturas": "tblViaturas",
+    "abastecimentos": "tblAbastecimentos",
+}
+TAMANHO_PAGINA = 100
+
+# ---------------- Fórmulas ----------------
+_TOKENS = re.compile(r"""\s*(?:(\{[^}]*\})|('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")|(-?\d+(?:\.\d+)?)|(!=|<=|>=|[=<>(),&])|([A-Za-z_][A-Za-z_0-9]*))""")
+
+def _tokenizar(formula):
+    tokens, pos = [], 0
+    formula = formula.strip()
+    while pos < len(formula):
+        m = _TOKENS.match(formula, pos)
+        if not m or m.end() == pos:
+            raise ValueError(f"Fórmula inválida perto de: {formula[pos:pos + 20]!r}")
+        campo, texto, numero, op, nome = m.groups()
+        if campo: tokens.append(("campo", campo[1:-1]))
+        elif texto: tokens.append(("valor", bytes(texto[1:-1], "utf-8").decode("unicode_escape")))
+        elif numero: tokens.append(("valor", float(numero) if "." in numero else int(numero)))
+        elif op: tokens.append(("op", op))
+        else: tokens.append(("nome", nome.upper()))
+        pos = m.end()
+    return tokens
+
+def _data(valor):
+    if isinstance(valor, datetime): return valor
+    try: return datetime.fromisoformat(str(valor).replace("Z", "")[:26])
+    except Exception: return None
+
+def _texto(valor):
+    if valor is None: return ""
+    if isinstance(valor, bool): return "1" if valor else "0"
+    if isinstance(valor, datetime): return valor.isoformat()
+    return str(valor)
+
+def _comparar(op, a, b):
+    if isinstance(a, (int, float)) and not isinstance(b, (int, float)):
+        try: b = float(b)
+        except Exception: a = _texto(a)
+    elif isinstance(b, (int, float)) and not isinstance(a, (int, float)):
+        try: a = float(a) if a not in (None, "") else 0
+        except Exception: b = _texto(b)
+    if not isinstance(a, (int, float)) or not isinstance(b, (int, float)):
+        a, b = _texto(a), _texto(b)
+    if op == "=": return a == b
+    if op == "!=": return a != b
+    if op == "<": return a < b
+    if op == ">": return a > b
+    if op == "<=": return a <= b
+    return a >= b
+
+_FUNCOES = {
+    "AND": lambda *a: all(a),
+    "OR": lambda *a: any(a),
+    "NOT": lambda a: not a,
+    "TRUE": lambda: True,
+    "FALSE": lambda: False,
+    "BLANK": lambda: None,
+    "LOWER": lambda a: _texto(a).lower(),
+    "UPPER": lambda a: _texto(a).upper(),
+    "TRIM": lambda a: _texto(a).strip(),
+    "LEFT": lambda a, n: _texto(a)[:int(n)],
+    "IS_AFTER": lambda a, b: bool(_data(a) and _data(b) and _data(a) > _data(b)),
+    "IS_BEFORE": lambda a, b: bool(_data(a) and _data(b) and _data(a) < _data(b)),
+    "IS_SAME": lambda a, b, unidade="day": bool(
+        _data(a) and _data(b) and (_data(a).date() == _data(b).date() if unidade == "day" else _data(a) == _data(b))
+    ),
+}
+
+class _Parser:
+    def __init__(self, tokens):
+        self.tokens, self.pos = tokens, 0
+
+    def _ver(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def _consumir(self, esperado=None):
+        tok = self._ver()
+        if esperado and tok != ("op", esperado):
+            raise ValueError(f"Esperado {esperado!r}, encontrado {tok[1]!r}")
+        self.pos += 1
+        return tok
+
+    def expressao(self):
+        esquerda = self.termo()
+        tipo, valor = self._ver()
+        if tipo == "op" and valor in ("=", "!=", "<", ">", "<=", ">="):
+            self._consumir()
+            direita = self.termo()
+            return lambda r, c: _comparar(valor, esquerda(r, c), direita(r, c))
+        if tipo == "op" and valor == "&":
+            self._consumir()
+            direita = self.expressao()
+            return lambda r, c: _texto(esquerda(r, c)) + _texto(direita(r, c))
+        return esquerda
+
+    def termo(self):
+        tipo, valor = self._consumir()
+        if tipo == "campo":
+            return lambda r, c: r["fields"].get(valor)
+        if tipo == "valor":
+            return lambda r, c: valor
+        if tipo == "op" and valor == "(":
+            interno = self.expressao()
+            self._consumir(")")
+            return interno
+        if tipo == "nome":
+            self._consumir("(")
+            args = []
+            while self._ver() != ("op", ")"):
+                args.append(self.expressao())
+                if self._ver() == ("op", ","): self._consumir()
+            self._consumir(")")
+            if valor == "LAST_MODIFIED_TIME":
+                return lambda r, c: r["_modificado"]
+            if valor == "CREATED_TIME":
+                return lambda r, c: r["createdTime"]
+            if valor == "NOW":
+                return lambda r, c: datetime.utcnow()
+            if valor == "TODAY":
+                return lambda r, c: datetime.combine(datetime.utcnow().date(), datetime.min.time())
+            if valor not in _FUNCOES:
+                raise ValueError(f"Função não suportada: {valor}")
+            funcao = _FUNCOES[valor]
+            return lambda r, c: funcao(*(a(r, c) for a in args))
+        raise ValueError(f"Token inesperado: {valor!r}")
+
+def compilar_formula(formula):
+    if not formula: return lambda r: True
+    parser = _Parser(_tokenizar(formula))
+    avaliar = parser.expressao()
+    if parser.pos != len(parser.tokens):
+        raise ValueError("Fórmula com sobra de tokens")
+    return lambda r: bool(avaliar(r, None))
+
+# ---------------- Armazenamento ----------------
+def _chave_ordenacao(valor):
+    if valor is None: return (0, 0, "")
+    if isinstance(valor, (int, float)) and not isinstance(valor, bool): return (1, valor, "")
+    return (2, 0, _texto(valor))
+
+class AirtableLocal:
+    def __init__(self, latencia=0.0, limite_por_segundo=None):
+        self.tabelas = {tid: [] for tid in TABELAS.values()}
+        self.latencia = latencia
+        self.limite_por_segundo = limite_por_segundo
+        self.lock = threading.Lock()
+        self._consultas = {}
+        self._janela = []
+        self._seq = 0
+        self._seq_consultas = 0
+        self.zerar_estatisticas()
+
+    def zerar_estatisticas(self):
+        self.estatisticas = {"requisicoes": 0, "por_tabela": {}, "registros_enviados": 0, "recusadas_429": 0}
+
+    def _registrar(self, tabela, metodo):
+        with self.lock:
+            self.estatisticas["requisicoes"] += 1
+            chave = f"{tabela} {metodo}"
+            self.estatisticas["por_tabela"][chave] = self.estatisticas["por_tabela"].get(chave, 0) + 1
+
+    def _limitar(self):
+        if not self.limite_por_segundo: return False
+        with self.lock:
+            agora = time.monotonic()
+            self._janela = [t for t in self._janela if agora - t < 1.0]
+            if len(self._janela) >= self.limite_por_segundo:
+                self.estatisticas["recusadas_429"] += 1
+                return True
+            self._janela.append(agora)
+            return False
+
+    def _novo_id(self):
+        with self.lock:
+            self._seq += 1
+            return f"rec{self._seq:014d}"
+
+    def inserir(self, tabela_id, campos, criado=None):
+        agora = criado or datetime.utcnow()
+        registro = {
+            "id": self._novo_id(),
+            "createdTime": agora.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            "fields": {k: v for k, v in campos.items() if v is not None},
+            "_modificado": agora,
+        }
+        with self.lock:
+            self.tabelas[tabela_id].append(registro)
+        return registro
+
+    def atualizar(self, tabela_id, registro_id, campos):
+        with self.lock:
+            for r in self.tabelas[tabela_id]:
+                if r["id"] == registro_id:
+                    r["fields"].update(campos)
+                    r["_modificado"] = datetime.utcnow()
+                    return r
+        return None
+
+    def remover(self, tabela_id, ids):
+        ids = set(ids)
+        with self.lock:
+            self.tabelas[tabela_id] = [r for r in self.tabelas[tabela_id] if r["id"] not in ids]
+
+    def listar(self, tabela_id, opcoes):
+        offset = opcoes.get("offset")
+        if offset:
+            consulta_id, _, pos = offset.partition("/")
+            resultado = self._consultas.get(consulta_id)
+            if resultado is None:
+                raise LookupError("LIST_RECORDS_ITERATOR_NOT_AVAILABLE")
+            inicio = int(pos)
+        else:
+            filtro = compilar_formula(opcoes.get("filterByFormula"))
+            with self.lock:
+                resultado = [r for r in self.tabelas[tabela_id] if filtro(r)]
+            for campo, direcao in reversed(opcoes.get("sort") or []):
+                resultado.sort(key=lambda r: _chave_ordenacao(r["fields"].get(campo)), reverse=direcao == "desc")
+            if opcoes.get("maxRecords"):
+                resultado = resultado[:int(opcoes["maxRecords"])]
+            with self.lock:
+                self._seq_consultas += 1
+                consulta_id = f"itr{self._seq_consultas}"
+                self._consultas[consulta_id] = resultado
+                # Como no Airtable, um iterador de paginação só vale por um tempo limitado
+                while len(self._consultas) > 256: self._consultas.pop(next(iter(self._consultas)))
+            inicio = 0
+        tamanho = min(int(opcoes.get("pageSize") or TAMANHO_PAGINA), TAMANHO_PAGINA)
+        pagina = resultado[inicio:inicio + tamanho]
+        campos = opcoes.get("fields")
+        resposta = {"records": [self._publico(r, campos) for r in pagina]}
+        if inicio + tamanho < len(resultado):
+            resposta["offset"] = f"{consulta_id}/{inicio + tamanho}"
+        with self.lock:
+            self.estatisticas["registros_enviados"] += len(pagina)
+        return resposta
+
+    @staticmethod
+    def _publico(registro, campos=None):
+        fields = registro["fields"]
+        if campos: fields = {k: v for k, v in fields.items() if k in campos}
+        return {"id": registro["id"], "createdTime": registro["createdTime"], "fields": dict(fields)}
+
+# ---------------- HTTP ----------------
+def _opcoes_de_query(query):
+    params = parse_qs(query)
+    opcoes = {k: v[0] for k, v in params.items() if not k.startswith(("sort[", "fields"))}
+    if "fields[]" in params: opcoes["fields"] = params["fields[]"]
+    ordenacao = {}
+    for chave, valores in params.items():
+        m = re.match(r"sort\[(\d+)\]\[(field|direction)\]", chave)
+        if m: ordenacao.setdefault(int(m.group(1)), {})[m.group(2)] = valores[0]
+    opcoes["sort"] = [(s["field"], s.get("direction", "asc")) for _, s in sorted(ordenacao.items())]
+    return opcoes
+
+def _opcoes_de_json(corpo):
+    opcoes = dict(corpo)
+    opcoes["sort"] = [(s["field"], s.get("direction", "asc")) for s in corpo.get("sort", [])]
+    return opcoes
+
+def criar_handler(airtable):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _responder(self, status, corpo):
+            dados = json.dumps(corpo).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(dados)))
+            self.end_headers()
+            self.wfile.write(dados)
+
+        def _corpo(self):
+            tamanho = int(self.headers.get("Content-Length") or 0)
+            return json.loads(self.rfile.read(tamanho) or b"{}") if tamanho else {}
+
+        def _rota(self):
+            url = urlparse(self.path)
+            partes = [p for p in url.path.split("/") if p]
+            if len(partes) >= 3 and partes[0] == "v0" and partes[2] in airtable.tabelas:
+                return url, partes[2], partes[3:]
+            return url, None, partes
+
+        def _preparar(self, tabela, metodo):
+            if airtable.latencia: time.sleep(airtable.latencia)
+            if tabela: airtable._registrar(tabela, metodo)
+            if airtable._limitar():
+                self._responder(429, {"errors": [{"error": "RATE_LIMIT_REACHED"}]})
+                return False
+            return True
+
+        def do_GET(self):
+            url, tabela, resto = self._rota()
+            if resto == ["__estatisticas"]:
+                return self._responder(200, airtable.estatisticas)
+            if not tabela:
+                return self._responder(404, {"error": "NOT_FOUND"})
+            if not self._preparar(tabela, "GET"): return
+            try:
+                self._responder(200, airtable.listar(tabela, _opcoes_de_query(url.query)))
+            except (ValueError, LookupError) as e:
+                self._responder(422, {"error": {"type": "INVALID_FILTER_BY_FORMULA", "message": str(e)}})
+
+        def do_POST(self):
+            url, tabela, resto = self._rota()
+            if resto == ["__zerar"]:
+                airtable.zerar_estatisticas()
+                return self._responder(200, {})
+            if not tabela:
+                return self._responder(404, {"error": "NOT_FOUND"})
+            corpo = self._corpo()
+            if resto == ["listRecords"]:
+                if not self._preparar(tabela, "GET"): return
+                try:
+                    return self._responder(200, airtable.listar(tabela, _opcoes_de_json(corpo)))
+                except (ValueError, LookupError) as e:
+                    return self._responder(422, {"error": {"type": "INVALID_FILTER_BY_FORMULA", "message": str(e)}})
+            if not self._preparar(tabela, "POST"): return
+            if "records" in corpo:
+                if len(corpo["records"]) > 10:
+                    return self._responder(422, {"error": {"type": "INVALID_RECORDS"}})
+                criados = [airtable.inserir(tabela, r.get("fields", {})) for r in corpo["records"]]
+                return self._responder(200, {"records": [airtable._publico(r) for r in criados]})
+            self._responder(200, airtable._publico(airtable.inserir(tabela, corpo.get("fields", {}))))
+
+        def do_PATCH(self):
+            url, tabela, resto = self._rota()
+            if not tabela:
+                return self._responder(404, {"error": "NOT_FOUND"})
+            if not self._preparar(tabela, "PATCH"): return
+            corpo = self._corpo()
+            if resto:
+                registro = airtable.atualizar(tabela, resto[0], corpo.get("fields", {}))
+                if registro is None: return self._responder(404, {"error": "NOT_FOUND"})
+                return self._responder(200, airtable._publico(registro))
+            atualizados = [airtable.atualizar(tabela, r["id"], r.get("fields", {})) for r in corpo.get("records", [])]
+            self._responder(200, {"records": [airtable._publico(r) for r in atualizados if r]})
+
+        def do_DELETE(self):
+            url, tabela, resto = self._rota()
+            if not tabela:
+                return self._responder(404, {"error": "NOT_FOUND"})
+            if not self._preparar(tabela, "DELETE"): return
+            ids = resto[:1] or parse_qs(url.query).get("records[]", [])
+            airtable.remover(tabela, ids)
+            if resto: return self._responder(200, {"id": resto[0], "deleted": True})
+            self._responder(200, {"records": [{"id": i, "deleted": True} for i in ids]})
+
+    return Handler
+
+def iniciar(airtable, porta=0):
+    servidor = ThreadingHTTPServer(("127.0.0.1", porta), criar_handler(airtable))
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor, f"http://127.0.0.1:{servidor.server_address[1]}"
+
+# ---------------- Frota sintética ----------------
+TIPOS = ["SAMU", "Remocao", "Van Hemodialise", "Moto"]
+
+def semear_frota(airtable, n_registros=1000, n_viaturas=60, n_usuarios=80, semente=42):
+    rnd = random.Random(semente)
+    t = TABELAS
+    for i in range(n_usuarios):
+        airtable.inserir(t["usuarios"], {
+            "usuario": f"user{i}", "senha": f"senha{i}", "nome": f"Condutor {i} Silva",
+            "matricula": f"M{i:05d}", "telefone": f"119{i:08d}", "is_admin": i == 0,
+        })
+    viaturas = []
+    for i in range(n_viaturas):
+        tipo = TIPOS[i % len(TIPOS)]
+        v = {"Placa": f"SAM{i:04d}", "Prefixo": f"USA-{i:02d}", "Status": "Ativa", "TipoServico": tipo}
+        airtable.inserir(t["viaturas"], v)
+        viaturas.append({**v, "km": rnd.randint(1000, 80000)})
+    # checklists ~ 70%, abastecimentos ~ 25%, trocas ~ 5% dos registros
+    inicio = datetime.now() - timedelta(days=3 * 365)
+    passo = (datetime.now() - inicio) / max(n_registros, 1)
+    for i in range(n_registros):
+        quando = inicio + passo * i
+        v = viaturas[rnd.randrange(n_viaturas)]
+        v["km"] += rnd.randint(20, 250)
+        u = rnd.randrange(n_usuarios)
+        sorteio = rnd.random()
+        if sorteio < 0.70:
+            airtable.inserir(t["checklists"], {
+                "Data": quando.isoformat(), "Condutor": f"Condutor {u} Silva", "Matricula": f"M{u:05d}",
+                "Placa": v["Placa"], "Prefixo": v["Prefixo"], "Quilometragem": v["km"],
+                "Combustivel": rnd.choice(["1/4", "1/2", "3/4", "Cheio"]),
+                "Oxigenio Grande 1": rnd.randint(30, 2200), "Oxigenio Grande 2": rnd.randint(30, 2200),
+                "Oxigenio Portatil": rnd.randint(30, 2200), "TipoServico": v["TipoServico"],
+            }, criado=quando)
+        elif sorteio < 0.95:
+            litros = round(rnd.uniform(20, 70), 1)
+            airtable.inserir(t["abastecimentos"], {
+                "Data": quando.isoformat(), "Placa": v["Placa"], "Prefixo": v["Prefixo"],
+                "Condutor": f"Condutor {u} Silva", "Matricula": f"M{u:05d}", "Km": v["km"],
+                "Litros": litros, "Valor": round(litros * rnd.uniform(5.5, 6.5), 2),
+            }, criado=quando)
+        else:
+            airtable.inserir(t["trocaoleo"], {
+                "Placa": v["Placa"], "Prefixo": v["Prefixo"], "km": v["km"], "data": quando.isoformat(),
+            }, criado=quando)
+    return airtable
+
+def secrets_para(url):
+    return {"connections": {"airtable": {
+        "personal_access_token": "patMock", "base_id": BASE_ID, "endpoint_url": url,
+        "usuarios_table_id": TABELAS["usuarios"], "checklists_table_id": TABELAS["checklists"],
+        "trocaoleo_table_id": TABELAS["trocaoleo"], "viaturas_table_id": TABELAS["viaturas"],
+        "abastecimentos_table_id": TABELAS["abastecimentos"],
+    }}}
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Airtable local para testes de desempenho")
+    parser.add_argument("--porta", type=int, default=8787)
+    parser.add_argument("--registros", type=int, default=1000)
+    parser.add_argument("--viaturas", type=int, default=60)
+    parser.add_argument("--latencia-ms", type=float, default=0)
+    parser.add_argument("--limite", type=int, default=None, help="requisições/s por base (429 acima disso)")
+    args = parser.parse_args()
+    airtable = semear_frota(AirtableLocal(args.latencia_ms / 1000, args.limite), args.registros, args.viaturas)
+    servidor, url = iniciar(airtable, args.porta)
+    print(f"Airtable local em {url} (base {BASE_ID})")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        servidor.shutdown()
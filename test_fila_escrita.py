@@ -0,0 +1,168 @@
+import os
+import tempfile
+import threading
+import time
+
+import pytest
+import requests
+
+import fila_escrita
+from fila_escrita import MAX_TENTATIVAS_ESCRITA, FilaEscrita
+
+def _http(status):
+    resposta = requests.Response()
+    resposta.status_code = status
+    return requests.exceptions.HTTPError(f"{status}", response=resposta)
+
+class TabelaFalsa:
+    # batch_create roteirizado: cada chamada consome o próximo item de `roteiro`
+    # (uma exceção a levantar, ou None para gravar); esgotado, grava sempre
+    def __init__(self, roteiro=()):
+        self.roteiro = list(roteiro)
+        self.gravados = []
+        self._seq = 0
+
+    def batch_create(self, campos, typecast=False):
+        passo = self.roteiro.pop(0) if self.roteiro else None
+        if callable(passo): passo = passo(campos)
+        if passo is not None: raise passo
+        criados = []
+        for f in campos:
+            self._seq += 1
+            criados.append({"id": f"rec{self._seq}", "fields": f})
+        self.gravados.extend(criados)
+        return criados
+
+@pytest.fixture
+def caminho():
+    with tempfile.TemporaryDirectory() as pasta:
+        yield os.path.join(pasta, "fila.db")
+
+@pytest.fixture(autouse=True)
+def sem_espera(monkeypatch):
+    monkeypatch.setattr(fila_escrita.time, "sleep", lambda segundos: None)
+
+def _rodar(fila, ate, limite=5):
+    thread = threading.Thread(target=fila.executar, daemon=True)
+    thread.start()
+    inicio = time.time()
+    while not ate() and time.time() - inicio < limite: time.sleep(0.01)
+    return thread
+
+def _contar(fila, tabela):
+    with fila._lock:
+        return fila._conexao.execute(f"SELECT COUNT(*) FROM {tabela}").fetchone()[0]
+
+def test_erro_de_rede_no_reenvio_um_a_um_nao_derruba_a_thread(caminho):
+    # Lote recusado com 422, o reenvio do primeiro registro cai por rede; depois tudo passa
+    tabela = TabelaFalsa([_http(422), requests.exceptions.ConnectionError("caiu")])
+    fila = FilaEscrita(caminho, {"checklists": tabela}, lambda nome, criados: None)
+    fila.enfileirar_varios("checklists", [{"Placa": "A"}, {"Placa": "B"}])
+    thread = _rodar(fila, lambda: len(tabela.gravados) == 2)
+    assert thread.is_alive()
+    assert [r["fields"]["Placa"] for r in tabela.gravados] == ["A", "B"]
+    assert _contar(fila, "fila") == 0 and _contar(fila, "falhas") == 0
+
+def test_erro_no_callback_nao_derruba_a_thread(caminho):
+    tabela = TabelaFalsa()
+    chamadas = []
+    def ao_gravar(nome, criados):
+        chamadas.append(criados)
+        if len(chamadas) == 1: raise RuntimeError("cache indisponível")
+    fila = FilaEscrita(caminho, {"checklists": tabela}, ao_gravar)
+    fila.enfileirar("checklists", {"Placa": "A"})
+    thread = _rodar(fila, lambda: len(chamadas) == 1)
+    fila.enfileirar("checklists", {"Placa": "B"})
+    _rodar(fila, lambda: len(chamadas) == 2)
+    assert thread.is_alive()
+    assert len(tabela.gravados) == 2 and _contar(fila, "fila") == 0
+    assert "cache indisponível" in fila.ultimo_erro
+
+def test_limite_no_reenvio_um_a_um_nao_gasta_tentativa(caminho):
+    # Lote sempre recusado com 422; cada registro sozinho leva 429 mais vezes que
+    # MAX_TENTATIVAS_ESCRITA antes de passar
+    limitados = [2 * MAX_TENTATIVAS_ESCRITA]
+    def responder(campos):
+        if len(campos) > 1: return _http(422)
+        if limitados[0]:
+            limitados[0] -= 1
+            return _http(429)
+    tabela = TabelaFalsa([responder] * 100)
+    fila = FilaEscrita(caminho, {"checklists": tabela}, lambda nome, criados: None)
+    fila.enfileirar_varios("checklists", [{"Placa": "A"}, {"Placa": "B"}])
+    _rodar(fila, lambda: len(tabela.gravados) == 2)
+    assert _contar(fila, "falhas") == 0
+    assert sorted(r["fields"]["Placa"] for r in tabela.gravados) == ["A", "B"]
+
+def test_registro_invalido_vai_para_falhas_e_os_outros_seguem(caminho):
+    invalido = lambda campos: _http(422) if any(f["Placa"] == "X" for f in campos) else None
+    tabela = TabelaFalsa([invalido] * (2 * MAX_TENTATIVAS_ESCRITA + 2))
+    fila = FilaEscrita(caminho, {"checklists": tabela}, lambda nome, criados: None)
+    fila.enfileirar_varios("checklists", [{"Placa": "A"}, {"Placa": "X"}])
+    thread = _rodar(fila, lambda: _contar(fila, "falhas") == 1)
+    assert thread.is_alive()
+    assert [r["fields"]["Placa"] for r in tabela.gravados] == ["A"]
+    assert _contar(fila, "fila") == 0
+
+def test_pendentes_filtra_no_sqlite_e_acompanha_a_fila(caminho):
+    fila = FilaEscrita(caminho, {"checklists": TabelaFalsa()}, lambda nome, criados: None)
+    fila.enfileirar_varios("checklists", [{"Placa": "A", "Km": 1}, {"Placa": "B", "Km": 2}, {"Placa": "A", "Km": 3}])
+    assert [f["Km"] for f in fila.pendentes("checklists", {"Placa": "A"})] == [3, 1]
+    assert len(fila.pendentes("checklists")) == 3
+    # A cópia devolvida pode ser alterada sem mexer no que fica guardado
+    fila.pendentes("checklists", {"Placa": "A"}).append({"Placa": "Z"})
+    fila.enfileirar("checklists", {"Placa": "A", "Km": 4})
+    assert [f["Km"] for f in fila.pendentes("checklists", {"Placa": "A"})] == [4, 3, 1]
+    fila._enviar(fila._proximo_lote())
+    assert fila.pendentes("checklists", {"Placa": "A"}) == []
+
+def test_enfileirar_varios_com_chaves_ignora_as_ja_vistas(caminho):
+    fila = FilaEscrita(caminho, {"checklists": TabelaFalsa()}, lambda nome, criados: None)
+    primeiro = fila.enfileirar_varios("checklists", [{"Placa": "A"}, {"Placa": "B"}], chaves=["a", "b"])
+    # Segunda importação do mesmo arquivo enquanto a primeira ainda está na fila
+    segundo = fila.enfileirar_varios("checklists", [{"Placa": "A"}, {"Placa": "B"}, {"Placa": "C"}, {"Placa": "C"}], chaves=["a", "b", "c", "c"])
+    assert [f["Placa"] for f in primeiro] == ["A", "B"]
+    assert [f["Placa"] for f in segundo] == ["C"]
+    assert _contar(fila, "fila") == 3 and fila.duplicados == 3
+
+def test_chave_repetida_nao_vira_outra_linha(caminho):
+    fila = FilaEscrita(caminho, {"checklists": TabelaFalsa()}, lambda nome, criados: None)
+    assert fila.enfileirar("checklists", {"Placa": "A"}, chave="k1")
+    assert not fila.enfileirar("checklists", {"Placa": "A"}, chave="k1")
+    assert _contar(fila, "fila") == 1 and fila.duplicados == 1
+
+def test_chave_continua_valendo_depois_do_envio(caminho):
+    tabela = TabelaFalsa()
+    fila = FilaEscrita(caminho, {"checklists": tabela}, lambda nome, criados: None)
+    fila.enfileirar("checklists", {"Placa": "A"}, chave="k1")
+    fila._enviar(fila._proximo_lote())
+    assert _contar(fila, "fila") == 0
+    with fila._lock:
+        assert fila._conexao.execute("SELECT registro FROM chaves WHERE chave = 'k1'").fetchone()[0] == "rec1"
+    assert not fila.enfileirar("checklists", {"Placa": "A"}, chave="k1")
+    assert len(tabela.gravados) == 1
+
+def test_recusa_definitiva_libera_a_chave(caminho):
+    fila = FilaEscrita(caminho, {"checklists": TabelaFalsa()}, lambda nome, criados: None)
+    fila.enfileirar("checklists", {"Placa": "X"}, chave="k1")
+    for _ in range(MAX_TENTATIVAS_ESCRITA - 1):
+        fila._registrar_erro(fila._proximo_lote()[0], "422")
+        assert not fila.enfileirar("checklists", {"Placa": "X"}, chave="k1")
+    fila._registrar_erro(fila._proximo_lote()[0], "422")
+    assert _contar(fila, "falhas") == 1 and _contar(fila, "fila") == 0
+    # A equipe corrige e envia de novo com a mesma chave
+    assert fila.enfileirar("checklists", {"Placa": "X"}, chave="k1")
+
+def test_limpeza_mantem_chaves_de_registros_na_fila(caminho):
+    fila = FilaEscrita(caminho, {"checklists": TabelaFalsa()}, lambda nome, criados: None)
+    fila.enfileirar("checklists", {"Placa": "A"}, chave="gravada")
+    fila._enviar(fila._proximo_lote())
+    fila.enfileirar("checklists", {"Placa": "B"}, chave="na_fila")
+    antiga = time.time() - fila_escrita.RETENCAO_CHAVES - 60
+    with fila._lock, fila._conexao:
+        fila._conexao.execute("UPDATE chaves SET criada = ?", (antiga,))
+    fila._limpar_chaves()
+    with fila._lock:
+        restantes = [l[0] for l in fila._conexao.execute("SELECT chave FROM chaves")]
+    assert restantes == ["na_fila"]
+    assert fila.enfileirar("checklists", {"Placa": "A"}, chave="gravada")